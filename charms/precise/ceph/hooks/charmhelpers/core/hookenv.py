@@ -5,10 +5,17 @@
 #  Charm Helpers Developers <juju@lists.ubuntu.com>
 
 import os
+import sys
 import json
 import yaml
+import atexit
+import tempfile
+import time
 import subprocess
+import logging
 import UserDict
+from collections import OrderedDict
+from functools import wraps
 from subprocess import CalledProcessError
 
 CRITICAL = "CRITICAL"
@@ -18,10 +25,63 @@ INFO = "INFO"
 DEBUG = "DEBUG"
 MARKER = object()
 
+# Memoized results, one Memo per function decorated with @cached
 cache = {}
 
 
-def cached(func):
+class Memo(object):
+    """Memoized results of a single function
+
+    Entries are keyed by the (args, kwargs) tuple of each call and, when
+    maxsize is set, the least recently used entry is evicted once the memo
+    grows beyond it. Every argument value is indexed so that flush() can
+    drop the entries for a given unit or relation id directly.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def arguments(key):
+        args, kwargs = key
+        return args + tuple(value for _, value in kwargs)
+
+    def get(self, key):
+        value = self.entries[key]
+        if self.maxsize:
+            # Move to the most recently used end
+            del self.entries[key]
+            self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = value
+        for arg in self.arguments(key):
+            self.index.setdefault(arg, set()).add(key)
+        if self.maxsize and len(self.entries) > self.maxsize:
+            self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        if self.entries.pop(key, MARKER) is MARKER:
+            return
+        for arg in self.arguments(key):
+            keys = self.index.get(arg)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.index[arg]
+
+    def flush(self, arg):
+        for key in list(self.index.get(arg, ())):
+            self.discard(key)
+
+
+def cached(func=None, maxsize=None):
     """Cache return values for multiple executions of func + args
 
     For example:
@@ -33,37 +93,432 @@ def cached(func):
         unit_get('test')
 
     will cache the result of unit_get + 'test' for future calls.
+    Use @cached(maxsize=N) to keep only the N most recently used results.
     """
+    if func is None:
+        return lambda func: cached(func, maxsize)
+
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        global cache
-        key = str((func, args, kwargs))
+        memo = cache.get(func)
+        if memo is None:
+            memo = cache[func] = Memo(maxsize)
+        key = (args, tuple(sorted(kwargs.items())))
         try:
-            return cache[key]
+            return memo.get(key)
         except KeyError:
-            res = func(*args, **kwargs)
-            cache[key] = res
-            return res
+            memo.misses += 1
+        except TypeError:
+            # Unhashable arguments (e.g. a list of keys) are not cached
+            return func(*args, **kwargs)
+        res = func(*args, **kwargs)
+        memo.set(key, res)
+        return res
     return wrapper
 
 
 def flush(key):
-    """Flushes any entries from function cache where the
-    key is found in the function+args """
-    flush_list = []
-    for item in cache:
-        if key in item:
-            flush_list.append(item)
-    for item in flush_list:
-        del cache[item]
+    """Flushes any entries from function cache where key (typically a
+    unit name or relation id) is one of the arguments"""
+    for memo in cache.values():
+        memo.flush(key)
+
+
+def cache_stats():
+    """Hit and miss counters of every cached function, by function name"""
+    stats = {}
+    for func, memo in cache.items():
+        stats[func.__name__] = {
+            'hits': memo.hits,
+            'misses': memo.misses,
+            'size': len(memo.entries),
+        }
+    return stats
+
+
+def log_cache_stats(level=DEBUG):
+    """Write the cache_stats() counters to the juju log"""
+    for name, stats in sorted(cache_stats().items()):
+        log('cache {}: {hits} hits, {misses} misses, {size} entries'.format(
+            name, **stats), level=level)
+
+
+class PersistentCache(object):
+    """Hook tool results persisted in $CHARM_DIR across hook executions
+
+    Configuration, relation ids, relation units and relation settings are
+    stored on disk so that later hooks do not need to fork the hook tools
+    again. Entries are dropped once per hook context (JUJU_CONTEXT_ID) when
+    the hook being run tells us the underlying data may have changed, see
+    invalidate_for_hook(), and when this unit changes its own settings
+    with relation_set().
+    """
 
+    def __init__(self, path):
+        self.path = path
+        self.data = None
+        self.dirty = False
 
-def log(message, level=None):
-    """Write a message to the juju log"""
+    @staticmethod
+    def scope():
+        return [os.environ.get('JUJU_ENV_UUID'),
+                os.environ.get('JUJU_UNIT_NAME')]
+
+    def load(self):
+        if self.data is not None:
+            return self.data
+        data = {}
+        try:
+            with open(self.path) as cachefile:
+                data = json.load(cachefile)
+        except (IOError, ValueError):
+            pass
+        if not isinstance(data, dict) or data.get('scope') != self.scope():
+            data = {}
+        self.data = {
+            'scope': self.scope(),
+            'context': data.get('context'),
+            'config': data.get('config', {}),
+            'relation-ids': data.get('relation-ids', {}),
+            'relations': data.get('relations', {}),
+        }
+        atexit.register(self.save)
+        context = os.environ.get('JUJU_CONTEXT_ID')
+        if context is None or context != self.data['context']:
+            self.data['context'] = context
+            self.dirty = True
+            self.invalidate_for_hook(hook_name())
+        return self.data
+
+    def save(self):
+        """Atomically write the cache back to disk if it changed"""
+        if not self.dirty or self.data is None:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                       prefix='.hookenv-cache')
+            with os.fdopen(fd, 'w') as cachefile:
+                json.dump(self.data, cachefile)
+            os.rename(tmp, self.path)
+            self.dirty = False
+        except (IOError, OSError):
+            pass
+
+    def get(self, section, *keys):
+        value = self.load()[section]
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value
+
+    def set(self, value, section, *keys):
+        target = self.load()[section]
+        for key in keys[:-1]:
+            target = target.setdefault(key, {})
+        target[keys[-1]] = value
+        self.dirty = True
+
+    def drop(self, section, *keys):
+        target = self.load()[section]
+        for key in keys[:-1]:
+            target = target.get(key)
+            if not isinstance(target, dict):
+                return
+        if keys and keys[-1] in target:
+            del target[keys[-1]]
+            self.dirty = True
+        elif not keys and target:
+            target.clear()
+            self.dirty = True
+
+    def drop_unit(self, rid, unit):
+        """Forget the settings of unit on relation rid"""
+        self.drop('relations', rid, 'settings', unit)
+
+    def invalidate_for_hook(self, hook):
+        """Drop whatever the hook being run may have made stale"""
+        if hook in ('install', 'upgrade-charm'):
+            for section in ('config', 'relation-ids', 'relations'):
+                self.drop(section)
+            return
+        if hook == 'config-changed':
+            self.drop('config')
+            return
+        rid = os.environ.get('JUJU_RELATION_ID')
+        reltype = os.environ.get('JUJU_RELATION')
+        unit = os.environ.get('JUJU_REMOTE_UNIT')
+        if not rid or not reltype:
+            return
+        if hook.endswith('-relation-broken'):
+            self.drop('relations', rid)
+            self.drop('relation-ids', reltype)
+        elif hook.endswith('-relation-joined'):
+            self.drop('relations', rid, 'units')
+            self.drop('relation-ids', reltype)
+            if unit:
+                self.drop_unit(rid, unit)
+        elif hook.endswith('-relation-departed'):
+            self.drop('relations', rid, 'units')
+            if unit:
+                self.drop_unit(rid, unit)
+        elif hook.endswith('-relation-changed') and unit:
+            self.drop_unit(rid, unit)
+
+
+_persistent_cache = None
+PERSISTENT_CACHE_FILE = '.hookenv-cache.json'
+
+
+def persistent_cache():
+    """The PersistentCache for the current charm, or None outside hooks"""
+    global _persistent_cache
+    charmdir = charm_dir()
+    if not charmdir or 'JUJU_UNIT_NAME' not in os.environ:
+        return None
+    path = os.path.join(charmdir, PERSISTENT_CACHE_FILE)
+    if _persistent_cache is None or _persistent_cache.path != path:
+        _persistent_cache = PersistentCache(path)
+    return _persistent_cache
+
+
+LOG_LEVELS = {
+    DEBUG: logging.DEBUG,
+    INFO: logging.INFO,
+    WARNING: logging.WARNING,
+    ERROR: logging.ERROR,
+    CRITICAL: logging.CRITICAL,
+}
+
+
+def _juju_log(message, level=None):
     command = ['juju-log']
     if level:
         command += ['-l', level]
     command += [message]
-    subprocess.call(command)
+    _run_hook_tool(subprocess.call, command)
+
+
+class LogBuffer(object):
+    """Collects juju log messages in memory and writes them in batches
+
+    Messages below level are dropped. Consecutive messages of the same
+    level are written with a single juju-log call when the buffer is
+    flushed: at exit, or straight away when an ERROR or CRITICAL message
+    is logged.
+    """
+
+    def __init__(self, level=None):
+        self.level = LOG_LEVELS.get(level or DEBUG, logging.DEBUG)
+        self.messages = []
+
+    def write(self, message, level=None):
+        severity = LOG_LEVELS.get(level or INFO, logging.INFO)
+        if severity < self.level:
+            return
+        self.messages.append((level, message))
+        if severity >= logging.ERROR:
+            self.flush()
+
+    def flush(self):
+        messages, self.messages = self.messages, []
+        batch = []
+        for i, (level, message) in enumerate(messages):
+            batch.append(message)
+            if i + 1 == len(messages) or messages[i + 1][0] != level:
+                _juju_log('\n'.join(batch), level)
+                batch = []
+
+
+log_buffer = None
+
+
+def buffer_logs(level=None):
+    """Buffer log() messages of at least level until flush_logs()
+
+    Buffering is also enabled on import when CHARM_HELPERS_LOG_BUFFER is
+    set, using CHARM_HELPERS_LOG_LEVEL as the minimum level.
+    """
+    global log_buffer
+    flush_logs()
+    log_buffer = LogBuffer(level)
+    return log_buffer
+
+
+def flush_logs():
+    """Write any buffered log messages to the juju log"""
+    if log_buffer is not None:
+        log_buffer.flush()
+
+
+def log(message, level=None):
+    """Write a message to the juju log"""
+    if log_buffer is not None:
+        log_buffer.write(message, level)
+    else:
+        _juju_log(message, level)
+
+
+class JujuLogHandler(logging.Handler):
+    """A logging handler writing records through log()
+
+    For example, to send existing logging calls to the juju log:
+
+        logging.getLogger().addHandler(JujuLogHandler())
+    """
+
+    def emit(self, record):
+        try:
+            level = record.levelname
+            if level not in LOG_LEVELS:
+                level = None
+            log(self.format(record), level)
+        except Exception:
+            self.handleError(record)
+
+
+PROFILE_DIR = '/var/lib/juju/hook-profiles'
+profiler = None
+
+
+class HookProfiler(object):
+    """Wall clock timings of the expensive calls made while running a hook
+
+    Time spent in hook tools, apt, template rendering and service control
+    is accumulated by name through timed() and written out as a JSON
+    report, one file per hook execution, by write().
+    """
+
+    def __init__(self, hook):
+        self.hook = hook
+        self.start = time.time()
+        self.timings = {}
+
+    def record(self, name, elapsed):
+        timing = self.timings.setdefault(
+            name, {'calls': 0, 'total': 0.0, 'max': 0.0})
+        timing['calls'] += 1
+        timing['total'] += elapsed
+        timing['max'] = max(timing['max'], elapsed)
+
+    def report(self):
+        return {
+            'unit': os.environ.get('JUJU_UNIT_NAME'),
+            'hook': self.hook,
+            'start': self.start,
+            'duration': time.time() - self.start,
+            'timings': self.timings,
+        }
+
+    def write(self, directory=None):
+        """Write the report to directory, returning the file written"""
+        directory = directory or PROFILE_DIR
+        report = self.report()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        unit = (report['unit'] or 'unknown').replace('/', '-')
+        path = os.path.join(directory, '{}-{}-{:.0f}.json'.format(
+            unit, self.hook, self.start))
+        with open(path, 'w') as out:
+            json.dump(report, out, indent=2)
+        return path
+
+
+class timed(object):
+    """Record the time spent in a block or function with the profiler
+
+    For example:
+
+        with timed('relation-get'):
+            ...
+
+        @timed('apt_install')
+        def apt_install(packages):
+            ...
+
+    Nothing is recorded outside of hooks run by Hooks.execute().
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = []
+
+    def __enter__(self):
+        self.started.append(time.time())
+
+    def __exit__(self, *exc_info):
+        start = self.started.pop()
+        if profiler is not None:
+            profiler.record(self.name, time.time() - start)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+def _run_hook_tool(call, cmd):
+    with timed(cmd[0]):
+        return call(cmd)
+
+
+def profiling_enabled():
+    """Whether Hooks.execute() should write the profile of its hook
+
+    CHARM_HELPERS_PROFILE, when set in the hook environment, decides on its
+    own ('0' disables profiling). Otherwise the profile-hooks charm option
+    is used, as long as the hook already read the charm config: deciding
+    never runs an extra config-get.
+    """
+    value = os.environ.get('CHARM_HELPERS_PROFILE')
+    if value is not None:
+        return value not in ('', '0')
+    settings = _known_config()
+    return bool(settings and settings.get('profile-hooks'))
+
+
+def _known_config():
+    """The whole charm config, if already fetched without a hook tool"""
+    for func, memo in cache.items():
+        if func.__name__ == 'config' and func.__module__ == __name__:
+            settings = memo.entries.get(((), ()))
+            if settings is not None:
+                return settings
+    pcache = persistent_cache()
+    if pcache is not None:
+        return pcache.get('config', '')
+    return None
+
+
+def start_profiling(hook):
+    """Start recording timed() calls for hook"""
+    global profiler
+    profiler = HookProfiler(hook)
+    return profiler
+
+
+def stop_profiling(write=True):
+    """Stop profiling and, if write, write the report, returning its path"""
+    global profiler
+    current, profiler = profiler, None
+    if current is None or not write:
+        return None
+    try:
+        path = current.write()
+    except (IOError, OSError) as e:
+        log('Unable to write hook profile: {}'.format(e), level=WARNING)
+        return None
+    log('Hook profile written to {}'.format(path), level=DEBUG)
+    return path
+
+
+atexit.register(flush_logs)
+if os.environ.get('CHARM_HELPERS_LOG_BUFFER'):
+    buffer_logs(os.environ.get('CHARM_HELPERS_LOG_LEVEL'))
+if os.environ.get('CHARM_HELPERS_CACHE_STATS'):
+    atexit.register(log_cache_stats)
 
 
 class Serializable(UserDict.IterableUserDict):
@@ -134,6 +589,11 @@ def relation_id():
     return os.environ.get('JUJU_RELATION_ID', None)
 
 
+def hook_name():
+    """The name of the currently executing hook"""
+    return os.path.basename(sys.argv[0])
+
+
 def local_unit():
     """Local unit ID"""
     return os.environ['JUJU_UNIT_NAME']
@@ -152,19 +612,46 @@ def service_name():
 @cached
 def config(scope=None):
     """Juju charm configuration"""
+    pcache = persistent_cache()
+    if pcache is not None:
+        value = pcache.get('config', scope or '')
+        if value is not None:
+            return value
     config_cmd_line = ['config-get']
     if scope is not None:
         config_cmd_line.append(scope)
     config_cmd_line.append('--format=json')
     try:
-        return json.loads(subprocess.check_output(config_cmd_line))
+        value = json.loads(
+            _run_hook_tool(subprocess.check_output, config_cmd_line))
     except ValueError:
         return None
+    if pcache is not None and value is not None:
+        pcache.set(value, 'config', scope or '')
+    return value
 
 
 @cached
 def relation_get(attribute=None, unit=None, rid=None):
     """Get relation information"""
+    pcache = persistent_cache()
+    cache_rid = rid or relation_id()
+    cache_unit = unit or os.environ.get('JUJU_REMOTE_UNIT')
+    if pcache is not None and cache_rid and cache_unit:
+        settings = pcache.get('relations', cache_rid, 'settings', cache_unit)
+        if settings is None:
+            settings = _relation_get(None, cache_unit, cache_rid)
+            if settings is None:
+                return None
+            pcache.set(settings, 'relations', cache_rid, 'settings',
+                       cache_unit)
+        if attribute:
+            return settings.get(attribute)
+        return dict(settings)
+    return _relation_get(attribute, unit, rid)
+
+
+def _relation_get(attribute=None, unit=None, rid=None):
     _args = ['relation-get', '--format=json']
     if rid:
         _args.append('-r')
@@ -173,7 +660,7 @@ def relation_get(attribute=None, unit=None, rid=None):
     if unit:
         _args.append(unit)
     try:
-        return json.loads(subprocess.check_output(_args))
+        return json.loads(_run_hook_tool(subprocess.check_output, _args))
     except ValueError:
         return None
     except CalledProcessError, e:
@@ -192,9 +679,16 @@ def relation_set(relation_id=None, relation_settings={}, **kwargs):
             relation_cmd_line.append('{}='.format(k))
         else:
             relation_cmd_line.append('{}={}'.format(k, v))
-    subprocess.check_call(relation_cmd_line)
+    _run_hook_tool(subprocess.check_call, relation_cmd_line)
     # Flush cache of any relation-gets for local unit
     flush(local_unit())
+    pcache = persistent_cache()
+    if pcache is not None:
+        rids = [relation_id or os.environ.get('JUJU_RELATION_ID')]
+        if rids == [None]:
+            rids = pcache.load()['relations'].keys()
+        for rid in rids:
+            pcache.drop_unit(rid, local_unit())
 
 
 @cached
@@ -203,8 +697,17 @@ def relation_ids(reltype=None):
     reltype = reltype or relation_type()
     relid_cmd_line = ['relation-ids', '--format=json']
     if reltype is not None:
+        pcache = persistent_cache()
+        if pcache is not None:
+            relids = pcache.get('relation-ids', reltype)
+            if relids is not None:
+                return list(relids)
         relid_cmd_line.append(reltype)
-        return json.loads(subprocess.check_output(relid_cmd_line)) or []
+        relids = json.loads(
+            _run_hook_tool(subprocess.check_output, relid_cmd_line)) or []
+        if pcache is not None:
+            pcache.set(relids, 'relation-ids', reltype)
+        return relids
     return []
 
 
@@ -213,9 +716,18 @@ def related_units(relid=None):
     """A list of related units"""
     relid = relid or relation_id()
     units_cmd_line = ['relation-list', '--format=json']
+    pcache = persistent_cache()
     if relid is not None:
+        if pcache is not None:
+            units = pcache.get('relations', relid, 'units')
+            if units is not None:
+                return list(units)
         units_cmd_line.extend(('-r', relid))
-    return json.loads(subprocess.check_output(units_cmd_line)) or []
+    units = json.loads(
+        _run_hook_tool(subprocess.check_output, units_cmd_line)) or []
+    if pcache is not None and relid is not None:
+        pcache.set(units, 'relations', relid, 'units')
+    return units
 
 
 @cached
@@ -285,6 +797,23 @@ def relations():
     return rels
 
 
+def relation_snapshot(reltype=None):
+    """Get the settings of every unit related over reltype
+
+    Each unit's settings are fetched whole, with a single relation-get,
+    instead of once per key. Returns an ordered mapping of relation id to
+    an ordered mapping of unit name to that unit's settings:
+
+        {'amqp:0': {'rabbitmq-server/0': {'password': ...}}}
+    """
+    snapshot = OrderedDict()
+    for rid in relation_ids(reltype):
+        units = snapshot[rid] = OrderedDict()
+        for unit in related_units(rid):
+            units[unit] = relation_get(unit=unit, rid=rid) or {}
+    return snapshot
+
+
 @cached
 def is_relation_made(relation, keys='private-address'):
     '''
@@ -309,14 +838,14 @@ def open_port(port, protocol="TCP"):
     """Open a service network port"""
     _args = ['open-port']
     _args.append('{}/{}'.format(port, protocol))
-    subprocess.check_call(_args)
+    _run_hook_tool(subprocess.check_call, _args)
 
 
 def close_port(port, protocol="TCP"):
     """Close a service network port"""
     _args = ['close-port']
     _args.append('{}/{}'.format(port, protocol))
-    subprocess.check_call(_args)
+    _run_hook_tool(subprocess.check_call, _args)
 
 
 @cached
@@ -324,7 +853,7 @@ def unit_get(attribute):
     """Get the unit ID for the remote unit"""
     _args = ['unit-get', '--format=json', attribute]
     try:
-        return json.loads(subprocess.check_output(_args))
+        return json.loads(_run_hook_tool(subprocess.check_output, _args))
     except ValueError:
         return None
 
@@ -372,7 +901,14 @@ class Hooks(object):
         """Execute a registered hook based on args[0]"""
         hook_name = os.path.basename(args[0])
         if hook_name in self._hooks:
-            self._hooks[hook_name]()
+            # Timings are cheap to record: whether to write them out is only
+            # decided once the hook has read the charm config.
+            start_profiling(hook_name)
+            try:
+                self._hooks[hook_name]()
+            finally:
+                stop_profiling(write=profiling_enabled())
+                flush_logs()
         else:
             raise UnregisteredHookError(hook_name)
 
@@ -17,9 +17,7 @@ from charmhelpers.core.hookenv import (
     config,
     local_unit,
     log,
-    relation_get,
-    relation_ids,
-    related_units,
+    relation_snapshot,
     unit_get,
     unit_private_ip,
     ERROR,
@@ -70,6 +68,9 @@ def context_complete(ctxt):
 
 class OSContextGenerator(object):
     interfaces = []
+    # Template variables provided by the generator, if known.  Renderers
+    # skip the generator for templates referencing none of them.
+    keys = None
 
     def __call__(self):
         raise NotImplementedError
@@ -77,6 +78,7 @@ class OSContextGenerator(object):
 
 class SharedDBContext(OSContextGenerator):
     interfaces = ['shared-db']
+    keys = ['database_host', 'database', 'database_user', 'database_password']
 
     def __init__(self, database=None, user=None, relation_prefix=None):
         '''
@@ -102,15 +104,13 @@ class SharedDBContext(OSContextGenerator):
         if self.relation_prefix:
             password_setting = self.relation_prefix + '_password'
 
-        for rid in relation_ids('shared-db'):
-            for unit in related_units(rid):
-                passwd = relation_get(password_setting, rid=rid, unit=unit)
+        for units in relation_snapshot('shared-db').itervalues():
+            for settings in units.itervalues():
                 ctxt = {
-                    'database_host': relation_get('db_host', rid=rid,
-                                                  unit=unit),
+                    'database_host': settings.get('db_host'),
                     'database': self.database,
                     'database_user': self.user,
-                    'database_password': passwd,
+                    'database_password': settings.get(password_setting),
                 }
                 if context_complete(ctxt):
                     return ctxt
@@ -119,26 +119,24 @@ class SharedDBContext(OSContextGenerator):
 
 class IdentityServiceContext(OSContextGenerator):
     interfaces = ['identity-service']
+    keys = ['service_port', 'service_host', 'auth_host', 'auth_port',
+            'admin_tenant_name', 'admin_user', 'admin_password',
+            'service_protocol', 'auth_protocol']
 
     def __call__(self):
         log('Generating template context for identity-service')
         ctxt = {}
 
-        for rid in relation_ids('identity-service'):
-            for unit in related_units(rid):
+        for units in relation_snapshot('identity-service').itervalues():
+            for settings in units.itervalues():
                 ctxt = {
-                    'service_port': relation_get('service_port', rid=rid,
-                                                 unit=unit),
-                    'service_host': relation_get('service_host', rid=rid,
-                                                 unit=unit),
-                    'auth_host': relation_get('auth_host', rid=rid, unit=unit),
-                    'auth_port': relation_get('auth_port', rid=rid, unit=unit),
-                    'admin_tenant_name': relation_get('service_tenant',
-                                                      rid=rid, unit=unit),
-                    'admin_user': relation_get('service_username', rid=rid,
-                                               unit=unit),
-                    'admin_password': relation_get('service_password', rid=rid,
-                                                   unit=unit),
+                    'service_port': settings.get('service_port'),
+                    'service_host': settings.get('service_host'),
+                    'auth_host': settings.get('auth_host'),
+                    'auth_port': settings.get('auth_port'),
+                    'admin_tenant_name': settings.get('service_tenant'),
+                    'admin_user': settings.get('service_username'),
+                    'admin_password': settings.get('service_password'),
                     # XXX: Hard-coded http.
                     'service_protocol': 'http',
                     'auth_protocol': 'http',
@@ -150,6 +148,8 @@ class IdentityServiceContext(OSContextGenerator):
 
 class AMQPContext(OSContextGenerator):
     interfaces = ['amqp']
+    keys = ['clustered', 'rabbitmq_host', 'rabbitmq_hosts', 'rabbitmq_user',
+            'rabbitmq_password', 'rabbitmq_virtual_host']
 
     def __call__(self):
         log('Generating template context for amqp')
@@ -163,29 +163,24 @@ class AMQPContext(OSContextGenerator):
             raise OSContextError
 
         ctxt = {}
-        for rid in relation_ids('amqp'):
-            for unit in related_units(rid):
-                if relation_get('clustered', rid=rid, unit=unit):
+        for units in relation_snapshot('amqp').itervalues():
+            for settings in units.itervalues():
+                if settings.get('clustered'):
                     ctxt['clustered'] = True
-                    ctxt['rabbitmq_host'] = relation_get('vip', rid=rid,
-                                                         unit=unit)
+                    ctxt['rabbitmq_host'] = settings.get('vip')
                 else:
-                    ctxt['rabbitmq_host'] = relation_get('private-address',
-                                                         rid=rid, unit=unit)
+                    ctxt['rabbitmq_host'] = settings.get('private-address')
                 ctxt.update({
                     'rabbitmq_user': username,
-                    'rabbitmq_password': relation_get('password', rid=rid,
-                                                      unit=unit),
+                    'rabbitmq_password': settings.get('password'),
                     'rabbitmq_virtual_host': vhost,
                 })
                 if context_complete(ctxt):
                     # Sufficient information found = break out!
                     break
             # Used for active/active rabbitmq >= grizzly
-            ctxt['rabbitmq_hosts'] = []
-            for unit in related_units(rid):
-                ctxt['rabbitmq_hosts'].append(relation_get('private-address',
-                                                           rid=rid, unit=unit))
+            ctxt['rabbitmq_hosts'] = [settings.get('private-address')
+                                      for settings in units.itervalues()]
         if not context_complete(ctxt):
             return {}
         else:
@@ -197,18 +192,18 @@ class CephContext(OSContextGenerator):
 
     def __call__(self):
         '''This generates context for /etc/ceph/ceph.conf templates'''
-        if not relation_ids('ceph'):
+        snapshot = relation_snapshot('ceph')
+        if not snapshot:
             return {}
         log('Generating template context for ceph')
         mon_hosts = []
         auth = None
         key = None
-        for rid in relation_ids('ceph'):
-            for unit in related_units(rid):
-                mon_hosts.append(relation_get('private-address', rid=rid,
-                                              unit=unit))
-                auth = relation_get('auth', rid=rid, unit=unit)
-                key = relation_get('key', rid=rid, unit=unit)
+        for units in snapshot.itervalues():
+            for settings in units.itervalues():
+                mon_hosts.append(settings.get('private-address'))
+                auth = settings.get('auth')
+                key = settings.get('key')
 
         ctxt = {
             'mon_hosts': ' '.join(mon_hosts),
@@ -236,18 +231,18 @@ class HAProxyContext(OSContextGenerator):
         all peers to be included in the cluster.  Each charm needs to include
         its own context generator that describes the port mapping.
         '''
-        if not relation_ids('cluster'):
+        snapshot = relation_snapshot('cluster')
+        if not snapshot:
             return {}
 
         cluster_hosts = {}
         l_unit = local_unit().replace('/', '-')
         cluster_hosts[l_unit] = unit_get('private-address')
 
-        for rid in relation_ids('cluster'):
-            for unit in related_units(rid):
+        for units in snapshot.itervalues():
+            for unit, settings in units.iteritems():
                 _unit = unit.replace('/', '-')
-                addr = relation_get('private-address', rid=rid, unit=unit)
-                cluster_hosts[_unit] = addr
+                cluster_hosts[_unit] = settings.get('private-address')
 
         ctxt = {
             'units': cluster_hosts,
@@ -264,6 +259,7 @@ class HAProxyContext(OSContextGenerator):
 
 class ImageServiceContext(OSContextGenerator):
     interfaces = ['image-service']
+    keys = ['glance_api_servers']
 
     def __call__(self):
         '''
@@ -271,13 +267,12 @@ class ImageServiceContext(OSContextGenerator):
         in nova and cinder (currently).
         '''
         log('Generating template context for image-service.')
-        rids = relation_ids('image-service')
-        if not rids:
+        snapshot = relation_snapshot('image-service')
+        if not snapshot:
             return {}
-        for rid in rids:
-            for unit in related_units(rid):
-                api_server = relation_get('glance-api-server',
-                                          rid=rid, unit=unit)
+        for units in snapshot.itervalues():
+            for settings in units.itervalues():
+                api_server = settings.get('glance-api-server')
                 if api_server:
                     return {'glance_api_servers': api_server}
         log('ImageService context is incomplete. '
@@ -508,10 +503,9 @@ class SubordinateConfigContext(OSContextGenerator):
 
     def __call__(self):
         ctxt = {}
-        for rid in relation_ids(self.interface):
-            for unit in related_units(rid):
-                sub_config = relation_get('subordinate_configuration',
-                                          rid=rid, unit=unit)
+        for rid, units in relation_snapshot(self.interface).iteritems():
+            for settings in units.itervalues():
+                sub_config = settings.get('subordinate_configuration')
                 if sub_config and sub_config != '':
                     try:
                         sub_config = json.loads(sub_config)
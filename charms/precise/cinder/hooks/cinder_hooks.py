@@ -77,6 +77,7 @@ def install():
             juju_log('Ensuring block device is clean: %s' % bdev)
             clean_storage(bdev)
         prepare_lvm_storage(bdev, conf['volume-group'])
+    CONFIGS.precompile()
 
 
 @hooks.hook('config-changed')
@@ -268,6 +269,7 @@ def configure_https():
 
 @hooks.hook('upgrade-charm')
 def upgrade_charm():
+    CONFIGS.precompile()
     for rel_id in relation_ids('amqp'):
         amqp_joined(relation_id=rel_id)
 
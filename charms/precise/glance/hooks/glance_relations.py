@@ -74,6 +74,7 @@ def install_hook():
 
     for service in SERVICES:
         service_stop(service)
+    CONFIGS.precompile()
 
 
 @hooks.hook('shared-db-relation-joined')
@@ -231,6 +232,7 @@ def cluster_changed():
 
 @hooks.hook('upgrade-charm')
 def upgrade_charm():
+    CONFIGS.precompile()
     cluster_changed()
 
 
@@ -32,7 +32,12 @@ instance: see the chain_methods and merge_properties functions, and their
 usages.
 
 There is also a feature for determining if configuration values have changed
-between old and new configurations so we can selectively take action.
+between old and new configurations so we can selectively take action. Mixins
+declare the config keys affecting them in the install_keys, restart_keys and
+write_config_keys attributes: when the configuration changes, the backend
+update() method only runs the install, stop/start and write_config steps of the
+mixins whose keys have changed. Mixins added to or removed from the backend
+(e.g. when switching to the builtin server) are started or stopped.
 
 The mixins appear in the code in the order they are instantiated by the
 backend. Keeping them that way is useful.
@@ -50,6 +55,10 @@ from charmhelpers import (
 import utils
 
 
+# The config keys of the SSL certificates used by the servers.
+CERTIFICATE_KEYS = ('ssl-cert-path', 'ssl-cert-contents', 'ssl-key-contents')
+
+
 class SetUpMixin(object):
     """Handle the overall set up and clean up processes."""
 
@@ -80,6 +89,9 @@ class ImprovMixin(PythonInstallMixinBase):
     """Manage the improv backend when on staging."""
 
     debs = ('zookeeper',)
+    install_keys = ('juju-api-branch',)
+    restart_keys = (
+        ('juju-api-branch', 'staging-environment') + CERTIFICATE_KEYS)
 
     def start(self, backend):
         config = backend.config
@@ -97,6 +109,9 @@ class SandboxMixin(object):
 class PythonMixin(PythonInstallMixinBase):
     """Manage the real PyJuju backend."""
 
+    install_keys = ('juju-api-branch',)
+    restart_keys = ('juju-api-branch',) + CERTIFICATE_KEYS
+
     def start(self, backend):
         utils.start_agent(backend.config['ssl-cert-path'])
 
@@ -114,6 +129,13 @@ class GuiMixin(object):
 
     # The curl package is used to download release tarballs from Launchpad.
     debs = ('curl',)
+    install_keys = ('juju-gui-source',)
+    # A new release does not include the GUI configuration file.
+    write_config_keys = (
+        'charmworld-url', 'default-viewmode', 'ga-key',
+        'juju-gui-console-enabled', 'juju-gui-debug', 'juju-gui-source',
+        'login-help', 'password', 'read-only', 'sandbox', 'secure',
+        'serve-tests', 'show-get-juju-button', 'staging')
 
     def install(self, backend):
         """Install the GUI and dependencies."""
@@ -144,6 +166,13 @@ class GuiMixin(object):
 
     def start(self, backend):
         log('Starting Juju GUI.')
+        self.write_config(backend)
+        # Expose the service.
+        open_port(80)
+        open_port(443)
+
+    def write_config(self, backend):
+        """Write the GUI configuration file."""
         config = backend.config
         build_dir = utils.compute_build_dir(
             config['juju-gui-debug'], config['serve-tests'])
@@ -155,9 +184,6 @@ class GuiMixin(object):
             default_viewmode=config['default-viewmode'],
             show_get_juju_button=config['show-get-juju-button'],
             password=config.get('password'))
-        # Expose the service.
-        open_port(80)
-        open_port(443)
 
 
 class ServerInstallMixinBase(object):
@@ -166,6 +192,8 @@ class ServerInstallMixinBase(object):
     BuiltinServerMixin.
     """
 
+    install_keys = CERTIFICATE_KEYS
+
     def _setup_certificates(self, backend):
         # Set up the SSL certificates.
         if backend.different(
@@ -182,6 +210,8 @@ class HaproxyApacheMixin(ServerInstallMixinBase):
     debs = ('apache2', 'haproxy', 'openssl')
     # We need to add the juju-gui PPA containing our customized haproxy.
     ppa_required = True
+    restart_keys = (
+        CERTIFICATE_KEYS + ('juju-gui-debug', 'secure', 'serve-tests'))
 
     def install(self, backend):
         self._setup_certificates(backend)
@@ -204,6 +234,12 @@ class BuiltinServerMixin(ServerInstallMixinBase):
     # The package python-bzrlib is required by juju-deployer.
     # The package python-pip is is used to install the GUI server dependencies.
     debs = ('openssl', 'python-bzrlib', 'python-pip')
+    # The server caches the static files of the GUI release.
+    restart_keys = CERTIFICATE_KEYS + (
+        'builtin-server-deploy-workers', 'builtin-server-logging',
+        'builtin-server-multiplex', 'builtin-server-processes',
+        'charmworld-url', 'juju-gui-debug', 'juju-gui-source', 'sandbox',
+        'secure', 'serve-tests')
 
     def install(self, backend):
         utils.install_builtin_server()
@@ -216,7 +252,10 @@ class BuiltinServerMixin(ServerInstallMixinBase):
         utils.start_builtin_server(
             build_dir, config['ssl-cert-path'], config['serve-tests'],
             config['sandbox'], config['builtin-server-logging'],
-            not config['secure'], config['charmworld-url'])
+            not config['secure'], config['charmworld-url'],
+            processes=config['builtin-server-processes'],
+            multiplex=config['builtin-server-multiplex'],
+            deploy_workers=config['builtin-server-deploy-workers'])
 
     def stop(self, backend):
         utils.stop_builtin_server()
@@ -309,6 +348,52 @@ class Backend(object):
         """Execute the charm's "start" steps."""
         call_methods(self.mixins, 'start', self)
 
+    def plan(self, prev_backend):
+        """Return the steps required to apply the configuration changes.
+
+        The given prev_backend is the backend built from prev_config. The steps
+        are (name, mixin, backend) tuples, where name is the name of the mixin
+        method to be called passing the backend. Mixins are stopped using
+        prev_backend, in reverse order.
+        """
+        classes = [mixin.__class__ for mixin in self.mixins]
+        prev_mixins = dict(
+            (mixin.__class__, mixin) for mixin in prev_backend.mixins)
+        stops, installs, starts = [], [], []
+        for mixin in reversed(prev_backend.mixins):
+            if (mixin.__class__ not in classes or
+                    self.different(*getattr(mixin, 'restart_keys', ()))):
+                stops.append(('stop', mixin, prev_backend))
+        for mixin in self.mixins:
+            if mixin.__class__ not in prev_mixins:
+                installs.append(('install', mixin, self))
+                starts.append(('start', mixin, self))
+                continue
+            if self.different(*getattr(mixin, 'install_keys', ())):
+                installs.append(('install', mixin, self))
+            if self.different(*getattr(mixin, 'restart_keys', ())):
+                starts.append(('start', mixin, self))
+            elif self.different(*getattr(mixin, 'write_config_keys', ())):
+                starts.append(('write_config', mixin, self))
+        return [
+            (name, mixin, backend)
+            for name, mixin, backend in stops + installs + starts
+            if hasattr(mixin, name)]
+
+    def update(self):
+        """Apply the changes between prev_config and the current config."""
+        prev_backend = Backend(self.prev_config)
+        classes = set(mixin.__class__ for mixin in self.mixins)
+        prev_classes = set(mixin.__class__ for mixin in prev_backend.mixins)
+        if classes - prev_classes:
+            # New mixins might require additional packages.
+            debs, repository = self.get_dependencies()
+            log('Installing dependencies.')
+            utils.install_missing_packages(debs, repository=repository)
+        for name, mixin, backend in self.plan(prev_backend):
+            log('Running {} step: {}.'.format(mixin.__class__.__name__, name))
+            getattr(mixin, name)(backend)
+
     def stop(self):
         """Execute the charm's "stop" steps.
 
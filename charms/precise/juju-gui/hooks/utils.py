@@ -20,12 +20,14 @@ __all__ = [
     'APACHE_SITE',
     'APACHE_PORTS',
     'API_PORT',
+    'CACHE_DIR',
     'CURRENT_DIR',
     'JUJU_AGENT_DIR',
     'JUJU_GUI_DIR',
     'JUJU_PEM',
     'WEB_PORT',
     'cmd_log',
+    'compress_static_files',
     'compute_build_dir',
     'download_release',
     'fetch_api',
@@ -46,6 +48,7 @@ __all__ = [
     'remove_apache_setup',
     'remove_haproxy_setup',
     'render_to_file',
+    'resolve_launchpad_release',
     'save_or_create_certificates',
     'setup_apache_config',
     'setup_gui',
@@ -64,6 +67,9 @@ __all__ = [
 from contextlib import contextmanager
 from distutils.version import LooseVersion
 import errno
+import fcntl
+import gzip
+import hashlib
 import json
 import os
 import logging
@@ -71,6 +77,8 @@ import re
 import shutil
 from subprocess import CalledProcessError
 import tempfile
+import threading
+import time
 import urlparse
 
 import apt
@@ -110,11 +118,15 @@ API_PORT = 8080
 WEB_PORT = 8000
 
 BASE_DIR = '/var/lib/juju-gui'
+CACHE_DIR = os.path.join(BASE_DIR, 'cache')
 CURRENT_DIR = os.getcwd()
 CONFIG_DIR = os.path.join(CURRENT_DIR, 'config')
 JUJU_AGENT_DIR = os.path.join(BASE_DIR, 'juju')
 JUJU_GUI_DIR = os.path.join(BASE_DIR, 'juju-gui')
 RELEASES_DIR = os.path.join(CURRENT_DIR, 'releases')
+# Unpacked releases, each one in a directory named after the digest of its
+# tarball. JUJU_GUI_DIR links to the contents of one of them.
+UNPACKED_RELEASES_DIR = os.path.join(BASE_DIR, 'releases')
 SERVER_DIR = os.path.join(CURRENT_DIR, 'server')
 
 APACHE_CFG_DIR = os.path.join(os.path.sep, 'etc', 'apache2')
@@ -125,10 +137,30 @@ HAPROXY_CFG_PATH = os.path.join(os.path.sep, 'etc', 'haproxy', 'haproxy.cfg')
 SYS_INIT_DIR = os.path.join(os.path.sep, 'etc', 'init')
 AGENT_INIT_PATH = os.path.join(SYS_INIT_DIR, 'juju-api-agent.conf')
 GUISERVER_INIT_PATH = os.path.join(SYS_INIT_DIR, 'guiserver.conf')
+# The database shared by the GUI server processes when running more than one.
+# It includes user credentials: it is kept in memory, on the /run tmpfs.
+GUISERVER_STORE = os.path.join(
+    os.path.sep, 'run', 'juju-gui', 'guiserver', 'store.db')
 HAPROXY_INIT_PATH = os.path.join(SYS_INIT_DIR, 'haproxy.conf')
 IMPROV_INIT_PATH = os.path.join(SYS_INIT_DIR, 'juju-api-improv.conf')
 
 JUJU_PEM = 'juju.includes-private-key.pem'
+# Static files precompressed when the GUI is installed, so that the GUI server
+# can serve the gzipped variants without compressing them on each request.
+COMPRESSIBLE_EXTENSIONS = (
+    '.css', '.eot', '.html', '.js', '.json', '.map', '.svg', '.ttf', '.txt',
+    '.xml',
+)
+COMPRESS_MIN_SIZE = 1024
+# How long (in seconds) mutable resources are cached: the latest release of a
+# Launchpad series, and the files downloaded from arbitrary URLs.
+CACHE_TTL = 60 * 60
+# The number of unpacked releases to keep, including the active one.
+RELEASES_RETENTION = 3
+# The time after which temporary directories unpacking a release are
+# considered to be left over by a failed hook, rather than being still in use
+# by a concurrent one.
+UNPACK_EXPIRY = 60 * 60
 DEB_BUILD_DEPENDENCIES = (
     'bzr', 'g++', 'imagemagick', 'make',  'nodejs', 'npm',
 )
@@ -557,7 +589,8 @@ def install_builtin_server():
 
 def write_builtin_server_startup(
         gui_root, ssl_cert_path, serve_tests=False, sandbox=False,
-        builtin_server_logging='info', insecure=False, charmworld_url=''):
+        builtin_server_logging='info', insecure=False, charmworld_url='',
+        processes=1, multiplex=False, deploy_workers=1):
     """Generate the builtin server Upstart file."""
     log('Generating the builtin server Upstart file.')
     context = {
@@ -568,6 +601,10 @@ def write_builtin_server_startup(
         'serve_tests': serve_tests,
         'ssl_cert_path': ssl_cert_path,
         'charmworld_url': charmworld_url,
+        'processes': processes,
+        'deploy_workers': deploy_workers,
+        'store': GUISERVER_STORE if processes != 1 else '',
+        'multiplex': False,
     }
     if not sandbox:
         is_legacy_juju = legacy_juju()
@@ -575,9 +612,12 @@ def write_builtin_server_startup(
             api_url = 'wss://127.0.0.1:{}/ws'.format(API_PORT)
         else:
             api_url = 'wss://{}'.format(get_api_address())
+        if multiplex and is_legacy_juju:
+            log('API connections can only be shared with juju-core.')
         context.update({
             'api_url': api_url,
             'api_version': 'python' if is_legacy_juju else 'go',
+            'multiplex': multiplex and not is_legacy_juju,
         })
     if serve_tests:
         context['tests_root'] = os.path.join(JUJU_GUI_DIR, 'test', '')
@@ -587,12 +627,14 @@ def write_builtin_server_startup(
 
 def start_builtin_server(
         build_dir, ssl_cert_path, serve_tests, sandbox, builtin_server_logging,
-        insecure, charmworld_url):
+        insecure, charmworld_url, processes=1, multiplex=False,
+        deploy_workers=1):
     """Start the builtin server."""
     write_builtin_server_startup(
         build_dir, ssl_cert_path, serve_tests=serve_tests, sandbox=sandbox,
         builtin_server_logging=builtin_server_logging, insecure=insecure,
-        charmworld_url=charmworld_url)
+        charmworld_url=charmworld_url, processes=processes,
+        multiplex=multiplex, deploy_workers=deploy_workers)
     log('Starting the builtin server.')
     with su('root'):
         service_control(BUILTIN_SERVER, RESTART)
@@ -606,20 +648,98 @@ def stop_builtin_server():
     cmd_log(run('rm', '-f', GUISERVER_INIT_PATH))
 
 
-def get_npm_cache_archive_url(Launchpad=Launchpad):
-    """Figure out the URL of the most recent NPM cache archive on Launchpad."""
+@contextmanager
+def _cache_lock(name):
+    """Hold an exclusive lock with the given name on the local cache.
+
+    Locks are shared between hooks and processes running on the machine.
+    """
+    path = os.path.join(CACHE_DIR, 'locks', name)
+    _makedirs(os.path.dirname(path))
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _makedirs(path):
+    """Create the given directory and its parents if they do not exist."""
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def _get_cache_entry(key):
+    """Return the cache index entry with the given key, or None."""
+    with _cache_lock('index'):
+        index = Serializer(os.path.join(CACHE_DIR, 'index.json')).get()
+    return index.get(key)
+
+
+def _set_cache_entry(key, entry):
+    """Store the given entry in the cache index."""
+    with _cache_lock('index'):
+        serializer = Serializer(os.path.join(CACHE_DIR, 'index.json'))
+        index = serializer.get()
+        index[key] = entry
+        serializer.set(index)
+
+
+def _is_fresh(entry, ttl):
+    """Return True if the cache entry is not older than ttl seconds.
+
+    A ttl of None means the entry never expires.
+    """
+    return ttl is None or time.time() - entry['time'] < ttl
+
+
+def sha256sum(path):
+    """Return the SHA256 hex digest of the file at the given path."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def resolve_launchpad_release(series_name, release_version,
+                              Launchpad=Launchpad):
+    """Return the URL and the name of a juju-gui release file on Launchpad.
+
+    See get_launchpad_release. Results are stored in the local cache: the
+    file of a specific release version never changes, while the latest
+    release of a series is looked up again after CACHE_TTL seconds.
+    """
+    key = 'launchpad:{}:{}'.format(series_name, release_version or '')
+    ttl = CACHE_TTL if release_version is None else None
+    entry = _get_cache_entry(key)
+    if entry is not None and _is_fresh(entry, ttl):
+        return entry['url'], entry['filename']
     launchpad = Launchpad.login_anonymously('Juju GUI charm', 'production')
     project = launchpad.projects['juju-gui']
+    url, filename = get_launchpad_release(
+        project, series_name, release_version)
+    _set_cache_entry(
+        key, {'url': url, 'filename': filename, 'time': time.time()})
+    return url, filename
+
+
+def get_npm_cache_archive_url(Launchpad=Launchpad):
+    """Figure out the URL of the most recent NPM cache archive on Launchpad."""
     # Find the URL of the most recently created NPM cache archive.
-    npm_cache_url, _ = get_launchpad_release(project, 'npm-cache', None)
+    npm_cache_url, _ = resolve_launchpad_release(
+        'npm-cache', None, Launchpad=Launchpad)
     return npm_cache_url
 
 
 def prime_npm_cache(npm_cache_url):
     """Download NPM cache archive and prime the NPM cache with it."""
     # Download the cache archive and then uncompress it into the NPM cache.
-    npm_cache_archive = os.path.join(CURRENT_DIR, 'npm-cache.tgz')
-    cmd_log(run('curl', '-L', '-o', npm_cache_archive, npm_cache_url))
+    npm_cache_archive = download_release(npm_cache_url, 'npm-cache.tgz')
     npm_cache_dir = os.path.expanduser('~/.npm')
     # The NPM cache directory probably does not exist, so make it if not.
     try:
@@ -634,17 +754,31 @@ def prime_npm_cache(npm_cache_url):
 
 def fetch_gui_from_branch(branch_url, revision, logpath):
     """Retrieve the Juju GUI from a branch and build a release archive."""
-    # Inject NPM packages into the cache for faster building.
-    prime_npm_cache(get_npm_cache_archive_url())
+    # Inject NPM packages into the cache for faster building. The archive is
+    # retrieved while the branch is checked out.
+    errors = []
+
+    def npm_cache_worker():
+        try:
+            prime_npm_cache(get_npm_cache_archive_url())
+        except Exception as err:
+            errors.append(err)
+    npm_cache_thread = threading.Thread(target=npm_cache_worker)
+    npm_cache_thread.start()
     # Create a release starting from a branch.
     juju_gui_source_dir = os.path.join(CURRENT_DIR, 'juju-gui-source')
     checkout_args, revno = ([], 'latest revno') if revision is None else (
         ['--revision', revision], 'revno {}'.format(revision))
     log('Retrieving Juju GUI source checkout from {} ({}).'.format(
         branch_url, revno))
-    cmd_log(run('rm', '-rf', juju_gui_source_dir))
-    checkout_args.extend([branch_url, juju_gui_source_dir])
-    cmd_log(bzr_checkout(*checkout_args))
+    try:
+        cmd_log(run('rm', '-rf', juju_gui_source_dir))
+        checkout_args.extend([branch_url, juju_gui_source_dir])
+        cmd_log(bzr_checkout(*checkout_args))
+    finally:
+        npm_cache_thread.join()
+    if errors:
+        raise errors[0]
     log('Preparing a Juju GUI release.')
     logdir = os.path.dirname(logpath)
     fd, name = tempfile.mkstemp(prefix='make-distfile-', dir=logdir)
@@ -656,15 +790,47 @@ def fetch_gui_from_branch(branch_url, revision, logpath):
         os.path.join(juju_gui_source_dir, 'releases'))
 
 
-def download_release(url, filename):
-    """Download a Juju GUI release from the given URL.
+def download_release(url, filename, ttl=None):
+    """Download a Juju GUI release (or another build artifact) from url.
 
-    Save the resulting file as filename in the local releases repository.
+    Files are stored in the local cache, in a directory named after their
+    SHA256 digest. A file is not downloaded again if the URL was already
+    fetched less than *ttl* seconds ago (or ever, if *ttl* is None) and the
+    cached copy is intact. Concurrent downloads of the same URL wait for each
+    other, and interrupted downloads of immutable files (ttl is None) are
+    resumed.
     Return the full path of the saved file.
     """
-    destination = os.path.join(RELEASES_DIR, filename)
-    log('Downloading release file: {} --> {}.'.format(url, destination))
-    cmd_log(run('curl', '-L', '-o', destination, url))
+    key = 'download:' + url
+    name = hashlib.sha256(key).hexdigest()
+    with _cache_lock(name):
+        entry = _get_cache_entry(key)
+        if entry is not None and _is_fresh(entry, ttl):
+            path = os.path.join(
+                CACHE_DIR, 'files', entry['sha256'], entry['filename'])
+            if os.path.exists(path) and sha256sum(path) == entry['sha256']:
+                log('Using cached release file: {} --> {}.'.format(url, path))
+                return path
+            log('Discarding missing or corrupted file: {}.'.format(path))
+        partial = os.path.join(CACHE_DIR, 'partial', name)
+        _makedirs(os.path.dirname(partial))
+        log('Downloading release file: {} --> {}.'.format(url, partial))
+        if ttl is None and os.path.exists(partial):
+            try:
+                cmd_log(run('curl', '-L', '-f', '-C', '-', '-o', partial, url))
+            except CalledProcessError:
+                # The server does not support resuming the download.
+                log('Unable to resume the download: starting over.')
+                os.remove(partial)
+        if ttl is not None or not os.path.exists(partial):
+            cmd_log(run('curl', '-L', '-f', '-o', partial, url))
+        digest = sha256sum(partial)
+        destination = os.path.join(CACHE_DIR, 'files', digest, filename)
+        _makedirs(os.path.dirname(destination))
+        os.rename(partial, destination)
+        _set_cache_entry(key, {
+            'sha256': digest, 'filename': filename, 'time': time.time()})
+    log('Release file saved: {} (sha256 {}).'.format(destination, digest))
     return destination
 
 
@@ -709,7 +875,8 @@ def fetch_gui_release(origin, version):
         _, _, extension = version.rpartition('.')
         if extension not in ('tgz', 'xz'):
             extension = 'xz'
-        return download_release(version, 'url-release.' + extension)
+        return download_release(
+            version, 'url-release.' + extension, ttl=CACHE_TTL)
     if origin == 'local':
         path = get_release_file_path()
         log('Using a local release: {}'.format(path))
@@ -724,9 +891,7 @@ def fetch_gui_release(origin, version):
             log('Using a local release: {}'.format(path))
             return path
     # Retrieve a release from Launchpad.
-    launchpad = Launchpad.login_anonymously('Juju GUI charm', 'production')
-    project = launchpad.projects['juju-gui']
-    url, filename = get_launchpad_release(project, origin, version)
+    url, filename = resolve_launchpad_release(origin, version)
     return download_release(url, filename)
 
 
@@ -738,17 +903,141 @@ def fetch_api(juju_api_branch):
     cmd_log(bzr_checkout(juju_api_branch, JUJU_AGENT_DIR))
 
 
+def compress_static_files(directory):
+    """Store a gzipped copy of the static files found in *directory*.
+
+    The compressed file is saved next to the original one, adding the ".gz"
+    extension. Small files, files not included in COMPRESSIBLE_EXTENSIONS
+    and files whose compressed copy is up to date are skipped.
+    Return the number of files compressed.
+    """
+    compressed = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            if not filename.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(dirpath, filename)
+            stat = os.stat(path)
+            if stat.st_size < COMPRESS_MIN_SIZE:
+                continue
+            gz_path = path + '.gz'
+            if (os.path.exists(gz_path) and
+                    os.path.getmtime(gz_path) >= stat.st_mtime):
+                continue
+            # Write to a temporary file first, so that the GUI server never
+            # sees a partially written variant.
+            fd, tmp_path = tempfile.mkstemp(dir=dirpath, suffix='.gz')
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    gz_file = gzip.GzipFile(
+                        filename, 'wb', 9, tmp_file, stat.st_mtime)
+                    with open(path, 'rb') as source:
+                        shutil.copyfileobj(source, gz_file)
+                    gz_file.close()
+                os.chmod(tmp_path, stat.st_mode & 0777)
+                os.rename(tmp_path, gz_path)
+            except:
+                os.remove(tmp_path)
+                raise
+            compressed += 1
+    return compressed
+
+
+def _release_digest(release_tarball):
+    """Return the SHA256 digest of the given release tarball.
+
+    Files stored in the local cache are not read again: their digest is the
+    name of the directory including them.
+    """
+    files_dir = os.path.join(CACHE_DIR, 'files')
+    digest_dir = os.path.dirname(release_tarball)
+    if os.path.dirname(digest_dir) == files_dir:
+        return os.path.basename(digest_dir)
+    return sha256sum(release_tarball)
+
+
+def _unpack_release(release_tarball, digest):
+    """Unpack the release tarball, returning the resulting directory.
+
+    The release is unpacked in a temporary directory, which is renamed once
+    the static files are in place. Releases already unpacked are reused.
+    """
+    release_dir = os.path.join(UNPACKED_RELEASES_DIR, digest)
+    if os.path.isdir(release_dir):
+        log('Reusing unpacked release: {}.'.format(release_dir))
+        return release_dir
+    _makedirs(UNPACKED_RELEASES_DIR)
+    tmp_dir = tempfile.mkdtemp(prefix='.unpack-', dir=UNPACKED_RELEASES_DIR)
+    try:
+        uncompress = command('tar', '-x', '-a', '-C', tmp_dir, '-f')
+        cmd_log(uncompress(release_tarball))
+        # Precompress the static files served by the GUI server.
+        log('Compressed {} static files.'.format(
+            compress_static_files(tmp_dir)))
+        os.chmod(tmp_dir, 0755)
+        os.rename(tmp_dir, release_dir)
+    except:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return release_dir
+
+
+def _switch_release(release_dir):
+    """Atomically link the Juju GUI dir to the contents of release_dir."""
+    target = first_path_in_dir(release_dir)
+    if os.path.islink(JUJU_GUI_DIR) and os.readlink(JUJU_GUI_DIR) == target:
+        return
+    link = JUJU_GUI_DIR + '.new'
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(target, link)
+    os.rename(link, JUJU_GUI_DIR)
+    # Record when the release has been activated, for garbage collection.
+    os.utime(release_dir, None)
+    log('Juju GUI dir linked to {}.'.format(target))
+
+
+def _remove_old_releases(active_dir, retention=RELEASES_RETENTION):
+    """Remove unpacked releases, keeping the most recently used ones.
+
+    The active release is never removed, and is included in the retention
+    count. Temporary unpack directories are only removed once expired, as
+    another hook may still be unpacking a release in them.
+    """
+    paths = [
+        os.path.join(UNPACKED_RELEASES_DIR, name)
+        for name in os.listdir(UNPACKED_RELEASES_DIR)]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    keep = set([active_dir])
+    unpacking = set()
+    expiry = time.time() - UNPACK_EXPIRY
+    for path in paths:
+        if os.path.basename(path).startswith('.'):
+            if os.path.getmtime(path) > expiry:
+                unpacking.add(path)
+        elif len(keep) < retention:
+            keep.add(path)
+    keep.update(unpacking)
+    # Releases were unpacked in a single directory by older charm versions.
+    paths.append(os.path.join(BASE_DIR, 'release'))
+    for path in paths:
+        if path not in keep and os.path.exists(path):
+            log('Removing unpacked release: {}.'.format(path))
+            cmd_log(run('rm', '-rf', path))
+
+
 def setup_gui(release_tarball):
-    """Set up Juju GUI."""
-    # Uncompress the release tarball.
+    """Set up Juju GUI.
+
+    The release is unpacked in a directory named after the tarball digest,
+    and then the Juju GUI dir is atomically switched to the new release.
+    Nothing is done if the release is already the active one.
+    """
     log('Installing Juju GUI.')
-    release_dir = os.path.join(BASE_DIR, 'release')
-    cmd_log(run('rm', '-rf', release_dir))
-    os.mkdir(release_dir)
-    uncompress = command('tar', '-x', '-a', '-C', release_dir, '-f')
-    cmd_log(uncompress(release_tarball))
-    # Link the Juju GUI dir to the contents of the release tarball.
-    cmd_log(run('ln', '-sf', first_path_in_dir(release_dir), JUJU_GUI_DIR))
+    digest = _release_digest(release_tarball)
+    release_dir = _unpack_release(release_tarball, digest)
+    _switch_release(release_dir)
+    _remove_old_releases(release_dir)
 
 
 def save_or_create_certificates(
@@ -19,12 +19,17 @@
 import os
 import time
 
-from tornado import web
+from tornado import (
+    process,
+    web,
+)
 from tornado.options import options
 
 from guiserver import (
     auth,
     handlers,
+    metrics,
+    multiplex,
 )
 from guiserver.bundles.base import Deployer
 
@@ -38,13 +43,25 @@ def server():
     # Set up static paths.
     guiroot = options.guiroot
     static_path = os.path.join(guiroot, 'juju-ui')
+    # Set up the metrics collection. Each GUI server process only renders its
+    # own metrics: label them with the process number.
+    labels = {}
+    task_id = process.task_id()
+    if task_id is not None:
+        labels['process'] = task_id
+    server_metrics = metrics.Metrics(**labels)
     # Set up the bundle deployer.
     deployer = Deployer(options.apiurl, options.apiversion,
-                        options.charmworldurl)
+                        options.charmworldurl, workers=options.deployworkers,
+                        metrics=server_metrics, store=options.tokenstore)
     # Set up handlers.
     server_handlers = []
     if not options.sandbox:
-        tokens = auth.AuthenticationTokenHandler()
+        if options.tokenstore:
+            # Share the authentication tokens between GUI server processes.
+            tokens = auth.SharedAuthenticationTokenHandler(options.tokenstore)
+        else:
+            tokens = auth.AuthenticationTokenHandler()
         websocket_handler_options = {
             # The Juju API backend url.
             'apiurl': options.apiurl,
@@ -54,7 +71,13 @@ def server():
             'deployer': deployer,
             # The tokens collection for authentication token requests.
             'tokens': tokens,
+            # The metrics updated while proxying messages.
+            'metrics': server_metrics,
         }
+        if options.multiplex:
+            # Share the Juju API connections between browsers.
+            websocket_handler_options['pool'] = multiplex.ConnectionPool(
+                options.apiurl)
         server_handlers.append(
             # Handle WebSocket connections.
             (r'^/ws$', handlers.WebSocketHandler, websocket_handler_options),
@@ -74,10 +97,15 @@ def server():
     }
     server_handlers.extend([
         # Handle static files.
-        (r'^/juju-ui/(.*)', web.StaticFileHandler, {'path': static_path}),
-        (r'^/(favicon\.ico)$', web.StaticFileHandler, {'path': guiroot}),
+        (r'^/juju-ui/(.*)', handlers.CompressedStaticFileHandler,
+         {'path': static_path}),
+        (r'^/(favicon\.ico)$', handlers.CompressedStaticFileHandler,
+         {'path': guiroot}),
         # Handle GUI server info.
         (r'^/gui-server-info', handlers.InfoHandler, info_handler_options),
+        # Handle GUI server metrics.
+        (r'^/gui-server-metrics', handlers.MetricsHandler,
+         {'metrics': server_metrics}),
         # Any other path is served by index.html.
         (r'^/(.*)', handlers.IndexHandler, {'path': guiroot}),
     ])
@@ -42,14 +42,34 @@ This module includes the pieces required to process user authentication.
       and usage requests.  It is used both by the AuthMiddleware and by
       handlers.WebSocketHandler in the ``on_message`` and ``on_juju_message``
       methods.
+    - SharedAuthenticationTokenHandler: an AuthenticationTokenHandler storing
+      tokens in a SQLite database, so that tokens created by a GUI server
+      process can be used to log in through the other ones.
 """
 
+import collections
 import datetime
 import logging
+import sqlite3
+import time
 import uuid
 
+from tornado import gen
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
 
+from guiserver.utils import (
+    open_database,
+    retry_locked,
+    transaction,
+)
+
+
+# The maximum number of outstanding authentication tokens.
+MAX_TOKENS = 1000
+# How often, in seconds, expired authentication tokens are removed.
+TOKENS_SWEEP_INTERVAL = 5
+
 
 class User(object):
     """The current WebSocket user."""
@@ -96,36 +116,56 @@ class AuthMiddleware(object):
 
         Start the authentication process if data represents a login request
         performed by the GUI user.
+
+        Token authentication requests are answered with a Future when the
+        token is retrieved asynchronously: its result is the login request to
+        send, or None if a response was already sent.
         """
         backend = self._backend
         tokens = self._tokens
         request_id = backend.get_request_id(data)
         if request_id is not None:
-            credentials = None
-            is_token = False
             if backend.request_is_login(data):
                 credentials = backend.get_credentials(data)
+                if credentials is not None:
+                    self._stash_credentials(request_id, False, credentials)
             elif tokens.authentication_requested(data):
-                is_token = True
                 credentials = tokens.process_authentication_request(
                     data, self._write_message)
-                if credentials is None:
-                    # This means that the tokens object handled the request.
-                    return None
-                else:
-                    # We need a "real" authentication request.
-                    data = backend.make_request(request_id, *credentials)
-            if credentials is not None:
-                # Stashing credentials is a security risk.  We currently deem
-                # this risk to be acceptably small.  Even keeping an
-                # authenticated websocket in memory seems to be of a similar
-                # risk profile, and we cannot operate without that.
-                self._request_ids[request_id] = dict(
-                    is_token=is_token,
-                    username=credentials[0],
-                    password=credentials[1])
+                if isinstance(credentials, Future):
+                    return self._async_token_login_request(
+                        request_id, credentials)
+                return self._token_login_request(request_id, credentials)
         return data
 
+    def _token_login_request(self, request_id, credentials):
+        """Return the login request for the credentials of a token.
+
+        Return None if the tokens object handled the request.
+        """
+        if credentials is None:
+            return None
+        self._stash_credentials(request_id, True, credentials)
+        # We need a "real" authentication request.
+        return self._backend.make_request(request_id, *credentials)
+
+    @gen.coroutine
+    def _async_token_login_request(self, request_id, future):
+        credentials = yield future
+        raise gen.Return(self._token_login_request(request_id, credentials))
+
+    def _stash_credentials(self, request_id, is_token, credentials):
+        """Keep the credentials used by a login request until it completes.
+        """
+        # Stashing credentials is a security risk.  We currently deem this
+        # risk to be acceptably small.  Even keeping an authenticated
+        # websocket in memory seems to be of a similar risk profile, and we
+        # cannot operate without that.
+        self._request_ids[request_id] = dict(
+            is_token=is_token,
+            username=credentials[0],
+            password=credentials[1])
+
     def process_response(self, data):
         """Parse the WebSocket data arriving from the Juju API server.
 
@@ -310,6 +350,15 @@ class AuthenticationTokenHandler(object):
             'Response': {},
         }
 
+    If too many tokens are still waiting to be used, the request fails.
+
+        {
+            'RequestId': 42,
+            'Error': 'too many outstanding tokens.',
+            'ErrorCode': 'unauthorized access',
+            'Response': {},
+        }
+
     A token authentication request looks like the following:
 
         {
@@ -346,12 +395,18 @@ class AuthenticationTokenHandler(object):
         }
     """
 
-    def __init__(self, max_life=datetime.timedelta(minutes=2), io_loop=None):
+    def __init__(self, max_life=datetime.timedelta(minutes=2), io_loop=None,
+                 max_tokens=MAX_TOKENS):
         self._max_life = max_life
         if io_loop is None:
             io_loop = IOLoop.current()
         self._io_loop = io_loop
-        self._data = {}
+        self._max_tokens = max_tokens
+        # Since all the tokens have the same life, the creation order is also
+        # the expiration order: expired tokens are removed in batches from
+        # the beginning of the ordered dict, using a single timeout.
+        self._data = collections.OrderedDict()
+        self._sweeper = None
 
     def token_requested(self, data):
         """Does data represent a token creation request?  True or False."""
@@ -361,6 +416,7 @@ class AuthenticationTokenHandler(object):
             data.get('Request', None) == 'Create'
         )
 
+    @gen.coroutine
     def process_token_request(self, data, user, write_message):
         """Create a single-use, time-expired token and send it back."""
         if not user.is_authenticated:
@@ -371,21 +427,21 @@ class AuthenticationTokenHandler(object):
                 Response={}))
             return
         token = uuid.uuid4().hex
-
-        def expire_token():
-            self._data.pop(token, None)
-            logging.info('auth: expired token {}'.format(token))
-        handle = self._io_loop.add_timeout(self._max_life, expire_token)
-        now = datetime.datetime.utcnow()
         # Stashing these is a security risk.  We currently deem this risk to
         # be acceptably small.  Even keeping an authenticated websocket in
         # memory seems to be of a similar risk profile, and we cannot operate
         # without that.
-        self._data[token] = dict(
-            username=user.username,
-            password=user.password,
-            handle=handle
-            )
+        added = self._add_token(token, user.username, user.password)
+        if isinstance(added, Future):
+            added = yield added
+        if not added:
+            write_message(dict(
+                RequestId=data['RequestId'],
+                Error='too many outstanding tokens.',
+                ErrorCode='unauthorized access',
+                Response={}))
+            return
+        now = datetime.datetime.utcnow()
         write_message({
             'RequestId': data['RequestId'],
             'Response': {
@@ -407,13 +463,28 @@ class AuthenticationTokenHandler(object):
         )
 
     def process_authentication_request(self, data, write_message):
-        """Get the credentials for the token, or send an error."""
+        """Get the credentials for the token, or send an error.
+
+        If the token is retrieved asynchronously, return a Future whose result
+        is the credentials or None.
+        """
+        token = data['Params']['Token']
+        credentials = self._pop_token(token)
+        if isinstance(credentials, Future):
+            return self._async_use_token(data, write_message, credentials)
+        return self._use_token(data, write_message, credentials)
+
+    @gen.coroutine
+    def _async_use_token(self, data, write_message, future):
+        credentials = yield future
+        raise gen.Return(self._use_token(data, write_message, credentials))
+
+    def _use_token(self, data, write_message, credentials):
+        """Return the credentials of the token, or send an error."""
         token = data['Params']['Token']
-        credentials = self._data.pop(token, None)
         if credentials is not None:
             logging.info('auth: using token {}'.format(token))
-            self._io_loop.remove_timeout(credentials['handle'])
-            return credentials['username'], credentials['password']
+            return credentials
         else:
             write_message({
                 'RequestId': data['RequestId'],
@@ -424,6 +495,69 @@ class AuthenticationTokenHandler(object):
             # None is an explicit return marker to say "I handled this".
             # It is returned by default.
 
+    def _add_token(self, token, username, password):
+        """Store the credentials for the given token until it expires.
+
+        Return False, without storing them, if the maximum number of tokens
+        has been reached. Subclasses can instead return a Future whose result
+        is True or False.
+        """
+        if len(self._data) >= self._max_tokens:
+            self._remove_expired()
+            if len(self._data) >= self._max_tokens:
+                return False
+        expires = self._io_loop.time() + self._max_life.total_seconds()
+        self._data[token] = dict(
+            username=username,
+            password=password,
+            expires=expires,
+            )
+        if self._sweeper is None:
+            self._sweeper = self._io_loop.add_timeout(expires, self._sweep)
+        return True
+
+    def _remove_expired(self):
+        """Remove the expired tokens.
+
+        Return the expiration time of the oldest remaining token, or None if
+        no tokens are left.
+        """
+        now = self._io_loop.time()
+        expired = 0
+        for token, credentials in self._data.iteritems():
+            if credentials['expires'] > now:
+                break
+            expired += 1
+        for _ in range(expired):
+            self._data.popitem(last=False)
+        if expired:
+            logging.info('auth: expired {} token(s)'.format(expired))
+        if self._data:
+            return next(self._data.itervalues())['expires']
+
+    def _sweep(self):
+        """Remove the expired tokens and schedule the next sweep."""
+        self._sweeper = None
+        expires = self._remove_expired()
+        if expires is not None:
+            deadline = max(
+                expires, self._io_loop.time() + TOKENS_SWEEP_INTERVAL)
+            self._sweeper = self._io_loop.add_timeout(deadline, self._sweep)
+
+    def _pop_token(self, token):
+        """Remove the given token.
+
+        Return its (username, password) credentials, or None if the token is
+        unknown, already fulfilled or expired. Subclasses can instead return
+        a Future whose result is the credentials or None.
+        """
+        credentials = self._data.pop(token, None)
+        # Expired tokens are removed in batches: they could still be stored.
+        if (credentials is None or
+                credentials['expires'] <= self._io_loop.time()):
+            return None
+        return credentials['username'], credentials['password']
+
     def process_authentication_response(self, data, user):
         """Make a successful token authentication response.
 
@@ -434,3 +568,140 @@ class AuthenticationTokenHandler(object):
             'RequestId': data['RequestId'],
             'Response': {'AuthTag': user.username, 'Password': user.password}
         }
+
+
+class SharedAuthenticationTokenHandler(AuthenticationTokenHandler):
+    """Handle authentication tokens stored in a SQLite database.
+
+    The GUI server uses this handler when it runs multiple processes: since
+    all the processes share the same database, a token created by a process
+    can be used to log in through any other one. Since tokens include the user
+    credentials, expired tokens are removed from the database every time it
+    is accessed, and when they expire.
+
+    The database is accessed without blocking the IO loop while another
+    process holds its lock: tokens are stored and retrieved asynchronously.
+    """
+
+    def __init__(self, path, max_life=datetime.timedelta(minutes=2),
+                 io_loop=None, max_tokens=MAX_TOKENS):
+        super(SharedAuthenticationTokenHandler, self).__init__(
+            max_life=max_life, io_loop=io_loop, max_tokens=max_tokens)
+        self._path = path
+        self._connection = None
+
+    def _connect(self):
+        """Return the database connection, opening it if required.
+
+        The connection is opened lazily so that each process has its own.
+        """
+        if self._connection is None:
+            connection = open_database(self._path)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS tokens ('
+                'token TEXT PRIMARY KEY, username TEXT, password TEXT, '
+                'expires REAL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS tokens_expires '
+                'ON tokens (expires)')
+            self._connection = connection
+        return self._connection
+
+    @gen.coroutine
+    def _add_token(self, token, username, password):
+        """Store the credentials for the given token until it expires.
+
+        Return a Future whose result is False, if the token has not been
+        stored because the maximum number of tokens has been reached, or True.
+        """
+        try:
+            added = yield retry_locked(
+                self._io_loop, self._insert_token, token, username, password)
+        except sqlite3.Error as err:
+            logging.error('auth: unable to store token: {}'.format(err))
+            added = False
+        if added and self._sweeper is None:
+            self._sweeper = self._io_loop.add_timeout(
+                self._io_loop.time() + self._max_life.total_seconds(),
+                self._sweep)
+        raise gen.Return(added)
+
+    def _insert_token(self, token, username, password):
+        # Check the limit and store the token atomically, so that concurrent
+        # processes cannot exceed it.
+        with transaction(self._connect()) as connection:
+            self._delete_expired(connection)
+            count = connection.execute(
+                'SELECT COUNT(*) FROM tokens').fetchone()[0]
+            if count >= self._max_tokens:
+                return False
+            connection.execute(
+                'INSERT INTO tokens VALUES (?, ?, ?, ?)',
+                (token, username, password,
+                 time.time() + self._max_life.total_seconds()))
+        return True
+
+    def _delete_expired(self, connection):
+        """Delete the expired tokens using the given connection."""
+        expired = connection.execute(
+            'DELETE FROM tokens WHERE expires <= ?', (time.time(),)).rowcount
+        if expired:
+            logging.info('auth: expired {} token(s)'.format(expired))
+
+    def _remove_expired(self):
+        """Remove the expired tokens.
+
+        Return the expiration time of the oldest remaining token, or None if
+        no tokens are left.
+        """
+        connection = self._connect()
+        self._delete_expired(connection)
+        return connection.execute(
+            'SELECT MIN(expires) FROM tokens').fetchone()[0]
+
+    @gen.coroutine
+    def _sweep(self):
+        """Remove the expired tokens and schedule the next sweep.
+
+        The sweep is also scheduled by the other processes sharing the
+        database, so that tokens are removed even if this one stops.
+        """
+        self._sweeper = None
+        try:
+            expires = yield retry_locked(self._io_loop, self._remove_expired)
+        except sqlite3.Error as err:
+            logging.error('auth: unable to remove tokens: {}'.format(err))
+            expires = time.time()
+        if expires is not None and self._sweeper is None:
+            delay = max(expires - time.time(), TOKENS_SWEEP_INTERVAL)
+            self._sweeper = self._io_loop.add_timeout(
+                self._io_loop.time() + delay, self._sweep)
+
+    @gen.coroutine
+    def _pop_token(self, token):
+        """Remove the given token.
+
+        Return a Future whose result is the token (username, password)
+        credentials, or None if the token is unknown, already fulfilled or
+        expired.
+        """
+        try:
+            credentials = yield retry_locked(
+                self._io_loop, self._delete_token, token)
+        except sqlite3.Error as err:
+            logging.error('auth: unable to retrieve token: {}'.format(err))
+            credentials = None
+        raise gen.Return(credentials)
+
+    def _delete_token(self, token):
+        # Avoid the same token being used concurrently by two processes.
+        with transaction(self._connect()) as connection:
+            self._delete_expired(connection)
+            row = connection.execute(
+                'SELECT username, password FROM tokens WHERE token = ?',
+                (token,)).fetchone()
+            connection.execute('DELETE FROM tokens WHERE token = ?', (token,))
+        if row is None:
+            return None
+        username, password = row
+        return username, password
@@ -50,7 +50,10 @@ base module:
 
       Note that the Deployer is not intended to store request related data: one
       instance is created once when the application is bootstrapped and used as
-      a singleton by all WebSocket requests;
+      a singleton by all WebSocket requests. When the GUI server runs
+      multiple processes, each process has its own Deployer: deployments are
+      tracked by the process serving the WebSocket connection which started
+      them;
 
     - base.DeployMiddleware: process deployment requests arriving from the
       client, validate the requests' data and send the appropriate responses.
@@ -195,9 +198,10 @@ becomes available, e.g.:
     }
 
 The Queue values in the response indicates the position of the requested
-bundle deployment in the queue. The Deployer implementation processes one
-bundle at the time. A Queue value of zero means the deployment will be started
-as soon as possible.
+bundle deployment in the queue. The Deployer implementation processes bundles
+in parallel, up to the configured number of workers, as long as they do not
+include the same services. A Queue value of zero means the deployment is
+started or will be started as soon as possible.
 
 The Status can be one of the following: 'scheduled', 'started', 'completed' and
 'cancelled. See the next section for an explanation of how to cancel a pending
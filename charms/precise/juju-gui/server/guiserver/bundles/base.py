@@ -23,15 +23,16 @@ bundle views and the Deployer itself. See the bundles package docstring for
 a detailed explanation of how these objects are used.
 """
 
-import time
-
 from concurrent.futures import (
-    process,
+    Future,
     ProcessPoolExecutor,
 )
+import time
+
 from deployer import guiserver as blocking
 import deployer.cli
 from tornado import gen
+from tornado.concurrent import chain_future
 from tornado.ioloop import IOLoop
 from tornado.util import ObjectDict
 
@@ -39,19 +40,22 @@ from guiserver.bundles import (
     utils,
     views,
 )
+from guiserver.metrics import (
+    DEPLOYMENT_BUCKETS,
+    Metrics,
+)
 from guiserver.utils import add_future
 from guiserver.watchers import WatcherError
 
 
-# Controls how many more calls than processes will be queued in the call queue.
-# Set to zero to make Future.cancel() succeed more frequently (Futures in the
-# call queue cannot be cancelled).
-process.EXTRA_QUEUED_CALLS = 0
 # Juju API versions supported by the GUI server Deployer.
 # Tests use the first API version in this list.
 SUPPORTED_API_VERSIONS = ['go']
 # Options used by the juju-deployer.  The defaults work for us.
 IMPORTER_OPTIONS = deployer.cli.setup_parser().parse_args([])
+# How often, in seconds, deployments waiting for other GUI server processes
+# check whether they can be started.
+SLOTS_POLL_INTERVAL = 1
 
 
 class Deployer(object):
@@ -62,18 +66,29 @@ class Deployer(object):
     process.
 
     The validation and deployments steps are executed in separate processes.
-    It is possible to process only one bundle at the time.
+    Up to "workers" bundles are deployed at the same time, provided that they
+    do not include the same services: deployments sharing services are
+    executed in the order they are scheduled. If a store is provided, the
+    limits apply to the deployments of all the GUI server processes sharing
+    it: in that case deployments waiting for other processes are started in
+    no particular order.
 
     Note that the Deployer is not intended to store request related state: it
     is instantiated once when the application is bootstrapped and used as a
     singleton by all WebSocket requests.
     """
 
-    def __init__(self, apiurl, apiversion, charmworldurl=None, io_loop=None):
+    def __init__(self, apiurl, apiversion, charmworldurl=None, io_loop=None,
+                 workers=1, metrics=None, store=None):
         """Initialize the deployer.
 
         The apiurl argument is the URL of the juju-core WebSocket server.
         The apiversion argument is the Juju API version (e.g. "go").
+        The workers argument is the maximum number of concurrent deployments.
+        The optional metrics argument is the guiserver.metrics.Metrics
+        instance used to record the deployment jobs timings.
+        The optional store argument is the path of the SQLite database used
+        to coordinate deployments with other GUI server processes.
         """
         self._apiurl = apiurl
         self._apiversion = apiversion
@@ -84,9 +99,20 @@ class Deployer(object):
             io_loop = IOLoop.current()
         self._io_loop = io_loop
 
-        # Deployment validation and importing executors.
+        self._workers = workers
+        # The deployment slots shared with other processes, if any.
+        self._slots = None
+        if store is not None:
+            self._slots = utils.DeploymentSlots(
+                store, workers, io_loop=io_loop)
+        # The timeout handle used to check again the shared slots.
+        self._poll = None
+
+        # Deployment validation and importing executors. Import jobs are only
+        # submitted to the executor when they can be started, so that pending
+        # deployments can always be cancelled.
         self._validate_executor = ProcessPoolExecutor(1)
-        self._run_executor = ProcessPoolExecutor(1)
+        self._run_executor = ProcessPoolExecutor(workers)
 
         # An observer instance is used to watch the deployments progress.
         self._observer = utils.Observer()
@@ -95,13 +121,44 @@ class Deployer(object):
         self._queue = []
         # The futures attribute maps deployment identifiers to Futures.
         self._futures = {}
+        # The jobs attribute maps identifiers of deployments not yet started
+        # to (services, function, args) tuples.
+        self._jobs = {}
+        # The running attribute maps identifiers of started deployments to
+        # the names of the services they include.
+        self._running = {}
+        # The positions attribute maps deployment identifiers to the last
+        # queue position notified to the observer.
+        self._positions = {}
+        # The times attribute maps deployment identifiers to the time they
+        # were scheduled or, once started, to the time they were started.
+        self._times = {}
+
+        if metrics is None:
+            metrics = Metrics()
+        self._metrics = metrics
+        self._wait_times = metrics.histogram(
+            'guiserver_deployment_wait_seconds',
+            'Time spent by bundle deployments waiting to be started.',
+            DEPLOYMENT_BUCKETS)
+        self._run_times = metrics.histogram(
+            'guiserver_deployment_run_seconds',
+            'Time required to deploy bundles.', DEPLOYMENT_BUCKETS)
+        metrics.gauge(
+            'guiserver_deployments_queued',
+            'Bundle deployments waiting to be started.',
+            lambda: len(self._jobs))
+        metrics.gauge(
+            'guiserver_deployments_running', 'Bundle deployments in progress.',
+            lambda: len(self._running))
 
     @gen.coroutine
     def validate(self, user, name, bundle):
         """Validate the deployment bundle.
 
-        The validation is executed in a separate process using the
-        juju-deployer library.
+        The validation is executed in a separate long-lived process using the
+        juju-deployer library. The process reuses its Juju API connections and
+        briefly caches the environment status (see utils.validate_bundle).
 
         Three arguments are provided:
           - user: the current authenticated user;
@@ -116,7 +173,7 @@ class Deployer(object):
             raise gen.Return('unsupported API version: {}'.format(apiversion))
         try:
             yield self._validate_executor.submit(
-                blocking.validate, self._apiurl, user.password, bundle)
+                utils.validate_bundle, self._apiurl, user.password, bundle)
         except Exception as err:
             raise gen.Return(str(err))
 
@@ -139,29 +196,96 @@ class Deployer(object):
 
         Return the deployment identifier assigned to this deployment process.
         """
-        # Start observing this deployment, retrieve the next available
-        # deployment id and notify its position at the end of the queue.
+        # Start observing this deployment and retrieve the next available
+        # deployment id.
         deployment_id = self._observer.add_deployment()
-        self._observer.notify_position(deployment_id, len(self._queue))
         # Add this deployment to the queue.
         self._queue.append(deployment_id)
-        # Add the import bundle job to the run executor, and set up a callback
-        # to be called when the import process completes.
-        future = self._run_executor.submit(
-            blocking.import_bundle,
-            self._apiurl, user.password, name, bundle, IMPORTER_OPTIONS)
+        self._times[deployment_id] = time.time()
+        # Store the import bundle job: it is submitted to the run executor
+        # when started. Set up a callback to be called when the import process
+        # completes or the deployment is cancelled.
+        future = Future()
+        self._jobs[deployment_id] = (
+            utils.get_services(bundle), blocking.import_bundle,
+            (self._apiurl, user.password, name, bundle, IMPORTER_OPTIONS))
         add_future(self._io_loop, future, self._import_callback,
                    deployment_id, bundle_id)
         self._futures[deployment_id] = future
         # If a customized callback is provided, schedule it as well.
         if test_callback is not None:
             add_future(self._io_loop, future, test_callback)
-        # Submit a sleeping job in order to avoid the next deployment job to be
-        # immediately put in the executor's call queue. This allows for
-        # cancelling scheduled jobs, even if the job is the next to be started.
-        self._run_executor.submit(time.sleep, 1)
+        # Start the deployment if possible, and notify its queue position.
+        self._schedule()
         return deployment_id
 
+    def _schedule(self):
+        """Start the pending deployments that can be run.
+
+        A deployment is started if a worker is available and its services do
+        not overlap with the ones included in started deployments or in
+        deployments scheduled before it.
+        When the slots are shared with other processes, a worker must also be
+        available in the store: if not, check again later.
+        Also notify the queue position of each deployment: started deployments
+        are in position 0, pending ones are numbered from 1 in queue order.
+        """
+        busy = list(self._running.values())
+        position = 0
+        waiting = False
+        for deployment_id in self._queue:
+            if deployment_id in self._running:
+                self._notify_position(deployment_id, 0)
+                continue
+            if self._futures[deployment_id].cancelled():
+                # The deployment is about to be removed from the queue.
+                continue
+            services = self._jobs[deployment_id][0]
+            overlaps = any(
+                utils.services_overlap(services, i) for i in busy)
+            startable = len(self._running) < self._workers and not overlaps
+            if startable and self._slots is not None:
+                startable = self._slots.acquire(deployment_id, services)
+                waiting = waiting or not startable
+            if startable:
+                self._start(deployment_id)
+                self._notify_position(deployment_id, 0)
+            else:
+                position += 1
+                self._notify_position(deployment_id, position)
+            busy.append(services)
+        if waiting and self._poll is None:
+            self._poll = self._io_loop.add_timeout(
+                self._io_loop.time() + SLOTS_POLL_INTERVAL, self._poll_slots)
+
+    def _poll_slots(self):
+        """Start the deployments which were waiting for other processes."""
+        self._poll = None
+        self._schedule()
+
+    def _start(self, deployment_id):
+        """Submit the import job of the given deployment to the run executor.
+        """
+        services, function, args = self._jobs.pop(deployment_id)
+        future = self._futures[deployment_id]
+        # From now on the deployment can no longer be cancelled.
+        future.set_running_or_notify_cancel()
+        self._running[deployment_id] = services
+        now = time.time()
+        self._wait_times.observe(now - self._times[deployment_id])
+        self._times[deployment_id] = now
+        run_future = self._run_executor.submit(function, *args)
+        # Copy the outcome from the IO loop thread, so that the callbacks of
+        # the deployment future are all executed by the IO loop.
+        self._io_loop.add_future(
+            run_future, lambda _: chain_future(run_future, future))
+
+    def _notify_position(self, deployment_id, position):
+        """Notify the queue position of a deployment if it changed."""
+        if self._positions.get(deployment_id) != position:
+            self._positions[deployment_id] = position
+            self._observer.notify_position(deployment_id, position)
+
     def _import_callback(self, deployment_id, bundle_id, future):
         """Callback called when a deployment process is completed.
 
@@ -169,25 +293,39 @@ class Deployer(object):
         deployment_id identifying one specific deployment job, and the fired
         future returned by the executor.
         """
+        started = self._times.pop(deployment_id, None)
         if future.cancelled():
             # Notify a deployment has been cancelled.
             self._observer.notify_cancelled(deployment_id)
             success = False
+            outcome = 'cancelled'
         else:
             error = None
             success = True
+            outcome = 'success'
             exception = future.exception()
             if exception is not None:
                 error = utils.message_from_error(exception)
                 success = False
+                outcome = 'error'
             # Notify a deployment completed.
             self._observer.notify_completed(deployment_id, error=error)
+            if started is not None:
+                self._run_times.observe(time.time() - started)
+        self._metrics.counter(
+            'guiserver_deployments_total', 'Completed bundle deployments.',
+            outcome=outcome).inc()
+        if self._slots is not None and deployment_id in self._running:
+            self._slots.release(deployment_id)
         # Remove the completed deployment job from the queue.
         self._queue.remove(deployment_id)
         del self._futures[deployment_id]
-        # Notify the new position of all remaining deployments in the queue.
-        for position, deploy_id in enumerate(self._queue):
-            self._observer.notify_position(deploy_id, position)
+        self._jobs.pop(deployment_id, None)
+        self._running.pop(deployment_id, None)
+        self._positions.pop(deployment_id, None)
+        # Start the deployments waiting for this one, and notify the new
+        # position of all remaining deployments in the queue.
+        self._schedule()
         # Increment the Charmworld deployment count upon successful
         # deployment.
         if success and bundle_id is not None:
@@ -237,7 +375,11 @@ class Deployer(object):
 
     def status(self):
         """Return a list containing the last known change for each deployment.
+
+        Deployments completed or cancelled more than an hour ago are not
+        included (see guiserver.bundles.utils.DEPLOYMENT_TTL).
         """
+        self._observer.expire()
         watchers = self._observer.deployments.values()
         return [i.getlast() for i in watchers]
 
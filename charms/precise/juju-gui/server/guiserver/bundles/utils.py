@@ -17,9 +17,14 @@
 """Bundle deployment utility functions and objects."""
 
 import collections
+import errno
 from functools import wraps
 import itertools
+import json
 import logging
+import operator
+import os
+import sqlite3
 import time
 import urllib
 
@@ -27,8 +32,17 @@ from tornado import (
     gen,
     escape,
 )
+from deployer import guiserver as blocking
+from deployer.env.gui import GUIEnvironment
 from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
 
+from guiserver.utils import (
+    is_locked,
+    open_database,
+    retry_locked,
+    transaction,
+)
 from guiserver.watchers import AsyncWatcher
 from jujuclient import EnvError
 
@@ -40,6 +54,20 @@ COMPLETED = 'completed'
 # Define a sequence of allowed constraints to be used in the process of
 # preparing the bundle object. See the _prepare_constraints function below.
 ALLOWED_CONSTRAINTS = ('arch', 'cpu-cores', 'cpu-power', 'mem')
+# The number of seconds closed deployments are kept around, so that clients
+# can still retrieve their final status.
+DEPLOYMENT_TTL = 60 * 60
+# The number of seconds the Juju environment status is reused by validation
+# worker processes. Bundles are validated again, against a fresh status, right
+# before being imported.
+VALIDATION_STATUS_TTL = 10
+# The maximum number of Juju API connections (one for each set of credentials)
+# kept open by a validation worker process.
+VALIDATION_CONNECTIONS = 10
+# Map (apiurl, password) tuples to connected CachedEnvironment instances, least
+# recently used first. Validation worker processes are long-lived, so that the
+# connections are reused by subsequent validations.
+_environments = collections.OrderedDict()
 
 
 def create_change(deployment_id, status, queue=None, error=None):
@@ -86,26 +114,54 @@ def message_from_error(exception):
 
 
 class Observer(object):
-    """Handle multiple deployment watchers."""
+    """Handle multiple deployment watchers.
+
+    Each deployment watcher only retains the latest deployment change.
+    Deployments which are cancelled or completed are forgotten, together with
+    their watcher identifiers, after ttl seconds.
+    """
 
-    def __init__(self):
+    def __init__(self, ttl=DEPLOYMENT_TTL):
+        self.ttl = ttl
         # Map deployment identifiers to watchers.
         self.deployments = {}
         # Map watcher identifiers to deployment identifiers.
         self.watchers = {}
+        # Map closed deployment identifiers to their closing time.
+        self._closed = collections.OrderedDict()
         # This counter is used to generate deployment identifiers.
         self._deployment_counter = itertools.count()
         # This counter is used to generate watcher identifiers.
         self._watcher_counter = itertools.count()
 
+    def expire(self):
+        """Forget the deployments closed more than ttl seconds ago."""
+        deadline = time.time() - self.ttl
+        expired = set()
+        while self._closed:
+            deployment_id, closed_at = next(self._closed.iteritems())
+            if closed_at > deadline:
+                break
+            del self._closed[deployment_id]
+            del self.deployments[deployment_id]
+            expired.add(deployment_id)
+        if expired:
+            for watcher_id, deployment_id in self.watchers.items():
+                if deployment_id in expired:
+                    del self.watchers[watcher_id]
+            logging.debug('deployments expired: {}'.format(
+                ', '.join(map(str, sorted(expired)))))
+
     def add_deployment(self):
         """Start observing a deployment.
 
         Generate a deployment id and add it to self.deployments.
         Return the generated deployment id.
         """
+        self.expire()
         deployment_id = self._deployment_counter.next()
-        self.deployments[deployment_id] = AsyncWatcher()
+        self.deployments[deployment_id] = AsyncWatcher(
+            key=operator.itemgetter('DeploymentId'))
         logging.info('deployment {} scheduled'.format(deployment_id))
         return deployment_id
 
@@ -138,6 +194,7 @@ class Observer(object):
         watcher = self.deployments[deployment_id]
         change = create_change(deployment_id, CANCELLED)
         watcher.close(change)
+        self._closed[deployment_id] = time.time()
         logging.info('deployment {} cancelled'.format(deployment_id))
 
     def notify_completed(self, deployment_id, error=None):
@@ -145,9 +202,215 @@ class Observer(object):
         watcher = self.deployments[deployment_id]
         change = create_change(deployment_id, COMPLETED, error=error)
         watcher.close(change)
+        self._closed[deployment_id] = time.time()
         logging.info('deployment {} completed'.format(deployment_id))
 
 
+def get_services(bundle):
+    """Return the set of service names included in the given bundle.
+
+    Return None if the services cannot be determined, e.g. if the bundle is
+    not well formed or if it inherits from other bundles.
+    """
+    if not isinstance(bundle, collections.Mapping) or 'inherits' in bundle:
+        return None
+    services = bundle.get('services')
+    if not isinstance(services, collections.Mapping):
+        return None
+    return frozenset(services)
+
+
+def services_overlap(services1, services2):
+    """Return True if the given sets of service names overlap.
+
+    Unknown services (None) are assumed to overlap with any other services.
+    """
+    if services1 is None or services2 is None:
+        return True
+    return not services1.isdisjoint(services2)
+
+
+def _process_exists(pid):
+    """Return True if a process with the given pid is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+class DeploymentSlots(object):
+    """Share the bundle deployment workers between GUI server processes.
+
+    The deployments in progress are stored in a SQLite database shared by all
+    the processes. A deployment can be started if less than "workers"
+    deployments are in progress and none of them includes the same services.
+    Deployments left behind by processes no longer running are ignored.
+
+    The database is never waited for: a deployment is not started while the
+    database is locked by another process, and it is checked again later.
+    """
+
+    def __init__(self, path, workers, io_loop=None):
+        self._path = path
+        self._workers = workers
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._connection = None
+
+    def _connect(self):
+        """Return the database connection, opening it if required."""
+        if self._connection is None:
+            connection = open_database(self._path)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS deployments ('
+                'pid INTEGER, deployment INTEGER, services TEXT, '
+                'PRIMARY KEY (pid, deployment))')
+            self._connection = connection
+        return self._connection
+
+    def acquire(self, deployment_id, services):
+        """Reserve a worker for the given deployment of this process.
+
+        The services argument is the set of service names included in the
+        bundle, or None if they are not known.
+        Return True if the deployment can be started, False otherwise.
+        """
+        try:
+            return self._acquire(deployment_id, services)
+        except sqlite3.OperationalError as err:
+            if not is_locked(err):
+                raise
+            logging.debug('deployer: deployment slots locked')
+            return False
+
+    def _acquire(self, deployment_id, services):
+        # Avoid two processes starting deployments in the same slot.
+        with transaction(self._connect()) as connection:
+            busy = []
+            rows = connection.execute(
+                'SELECT pid, deployment, services FROM deployments')
+            for pid, deployment, names in rows.fetchall():
+                if not _process_exists(pid):
+                    connection.execute(
+                        'DELETE FROM deployments '
+                        'WHERE pid = ? AND deployment = ?', (pid, deployment))
+                    continue
+                names = json.loads(names)
+                busy.append(None if names is None else frozenset(names))
+            available = len(busy) < self._workers and not any(
+                services_overlap(services, i) for i in busy)
+            if available:
+                if services is not None:
+                    services = sorted(services)
+                connection.execute(
+                    'INSERT INTO deployments VALUES (?, ?, ?)',
+                    (os.getpid(), deployment_id, json.dumps(services)))
+        return available
+
+    @gen.coroutine
+    def release(self, deployment_id):
+        """Free the worker reserved for the given deployment.
+
+        Return a Future which is done once the worker has been freed.
+        """
+        try:
+            yield retry_locked(self._io_loop, self._release, deployment_id)
+        except sqlite3.Error as err:
+            logging.error('deployer: unable to release the worker of '
+                          'deployment {}: {}'.format(deployment_id, err))
+
+    def _release(self, deployment_id):
+        self._connect().execute(
+            'DELETE FROM deployments WHERE pid = ? AND deployment = ?',
+            (os.getpid(), deployment_id))
+
+
+class CachedEnvironment(object):
+    """A Juju environment caching its status for ttl seconds.
+
+    Only the methods required by the juju-deployer validation logic are
+    provided.
+    """
+
+    def __init__(self, apiurl, password, ttl=VALIDATION_STATUS_TTL):
+        self.ttl = ttl
+        self._env = GUIEnvironment(apiurl, password)
+        self._status = None
+        self._expires = 0
+
+    def connect(self):
+        """Connect and log in to the Juju API server."""
+        self._env.connect()
+
+    def close(self):
+        """Close the API connection, ignoring errors."""
+        try:
+            self._env.close()
+        except Exception as err:
+            logging.debug('error closing the environment: {}'.format(err))
+
+    def status(self):
+        """Return the environment status, possibly from the cache."""
+        now = time.time()
+        if self._status is None or now >= self._expires:
+            self._status = self._env.status()
+            self._expires = now + self.ttl
+        return self._status
+
+
+def _validate_with(key, env, bundle):
+    """Validate the bundle using the given connected environment.
+
+    Store the environment for subsequent validations, unless an unexpected
+    error occurs, in which case the connection is closed.
+    """
+    try:
+        blocking._validate(env, bundle)
+    except ValueError:
+        # The bundle is not valid, but the connection is still usable.
+        _store_environment(key, env)
+        raise
+    except Exception:
+        env.close()
+        raise
+    _store_environment(key, env)
+
+
+def _store_environment(key, env):
+    """Store the environment, closing the least recently used ones."""
+    _environments[key] = env
+    while len(_environments) > VALIDATION_CONNECTIONS:
+        _, expired = _environments.popitem(last=False)
+        expired.close()
+
+
+def validate_bundle(apiurl, password, bundle):
+    """Validate a bundle against the current Juju environment.
+
+    This function is executed in a validation worker process. The Juju API
+    connection and the environment status are cached across calls, so that
+    repeated validations do not need to log in and retrieve the status again.
+    A stale cached connection is replaced by a new one.
+
+    Raise a ValueError if the bundle is not valid.
+    """
+    key = (apiurl, password)
+    env = _environments.pop(key, None)
+    if env is not None:
+        try:
+            _validate_with(key, env, bundle)
+            return
+        except ValueError:
+            raise
+        except Exception as err:
+            logging.debug('cached environment failed: {}'.format(err))
+    env = CachedEnvironment(apiurl, password)
+    env.connect()
+    _validate_with(key, env, bundle)
+
+
 def _prepare_constraints(constraints):
     """Validate and prepare the given service constraints.
 
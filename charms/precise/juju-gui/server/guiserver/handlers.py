@@ -19,6 +19,7 @@
 from collections import deque
 import logging
 import os
+import re
 import time
 
 from tornado import (
@@ -27,6 +28,7 @@ from tornado import (
     web,
     websocket,
 )
+from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
 
 from guiserver import get_version
@@ -36,7 +38,15 @@ from guiserver.auth import (
 )
 from guiserver.bundles.base import DeployMiddleware
 from guiserver.clients import websocket_connect
+from guiserver.metrics import (
+    CONNECT_BUCKETS,
+    LATENCY_BUCKETS,
+    Metrics,
+)
+from guiserver.multiplex import make_error
 from guiserver.utils import (
+    accepts_gzip,
+    add_future,
     get_headers,
     json_decode_dict,
     request_summary,
@@ -44,6 +54,28 @@ from guiserver.utils import (
 )
 
 
+# Once the user is authenticated, the only browser messages the proxy needs to
+# inspect are deployment and token requests. A message not including any of
+# these markers is forwarded to Juju without being decoded.
+INTERCEPTED_MARKERS = ('"Deployer"', '"GUIToken"')
+# Static assets including a content hash in their name, e.g. "app-0f3c9a1b.js".
+VERSIONED_ASSET = re.compile(r'[.-][0-9a-f]{8,}\.\w+$')
+
+
+def debug_enabled():
+    """Return True if debug messages are logged, False otherwise."""
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
+def is_intercepted(message):
+    """Return True if the given browser message must be decoded and inspected.
+
+    This is a cheap substring check: a message including one of the markers
+    as a value is just decoded to find out it can be forwarded as is.
+    """
+    return any(marker in message for marker in INTERCEPTED_MARKERS)
+
+
 class WebSocketHandler(websocket.WebSocketHandler):
     """WebSocket handler supporting secure WebSockets.
 
@@ -55,12 +87,22 @@ class WebSocketHandler(websocket.WebSocketHandler):
 
       - connected: True if the current browser is connected, False otherwise;
       - juju_connected: True if the Juju API is connected, False otherwise;
-      - juju_connection: the WebSocket client connection to the Juju API.
+      - juju_connection: the WebSocket client connection to the Juju API;
+      - shared_connection: the multiplex.SharedConnection in use, if the
+        handler is initialized with a connection pool;
+      - messages_received and messages_sent: the number of messages received
+        from and sent to the browser.
+
+    If a multiplex.ConnectionPool is provided, the handler does not connect to
+    the Juju API: when the user logs in, it acquires the connection shared by
+    all the browsers using the same credentials.
 
     Callbacks:
 
       - on_message(message): called when a message arrives from the browser;
       - on_juju_message(message): called when a message arrives from Juju;
+      - on_shared_message(data): called when a response arrives through the
+        shared connection;
       - on_close(): called when the browser closes the connection;
       - on_juju_close(): called when juju closes the connection.
 
@@ -70,10 +112,12 @@ class WebSocketHandler(websocket.WebSocketHandler):
     """
 
     @gen.coroutine
-    def initialize(self, apiurl, auth_backend, deployer, tokens, io_loop=None):
+    def initialize(self, apiurl, auth_backend, deployer, tokens, io_loop=None,
+                   pool=None, metrics=None):
         """Initialize the WebSocket server.
 
-        Create a new WebSocket client and connect it to the Juju API.
+        Create a new WebSocket client and connect it to the Juju API, unless
+        a connection pool is provided.
         Set up the authentication system.
         Handle the queued messages.
         """
@@ -82,9 +126,31 @@ class WebSocketHandler(websocket.WebSocketHandler):
         self._io_loop = io_loop
         self._summary = request_summary(self.request) + ' '
         logging.info(self._summary + 'client connected')
+        # Set up the metrics updated while proxying messages.
+        if metrics is None:
+            metrics = Metrics()
+        self._metrics = metrics
+        self.metrics_id = metrics.add_connection(self)
+        self.messages_received = 0
+        self.messages_sent = 0
+        self._received_counter = metrics.counter(
+            'guiserver_messages_received_total',
+            'Messages received from browsers.')
+        self._sent_counter = metrics.counter(
+            'guiserver_messages_sent_total', 'Messages sent to browsers.')
+        help = 'Time spent by the proxy handling a message.'
+        self._client_latency = metrics.histogram(
+            'guiserver_proxy_latency_seconds', help, LATENCY_BUCKETS,
+            source='client')
+        self._juju_latency = metrics.histogram(
+            'guiserver_proxy_latency_seconds', help, LATENCY_BUCKETS,
+            source='juju')
         self.connected = True
         self.juju_connected = False
+        self.shared_connection = None
         self._juju_message_queue = queue = deque()
+        self._pool = pool
+        self._auth_backend = auth_backend
         # Set up the authentication infrastructure.
         self.tokens = tokens
         write_message = wrap_write_message(self)
@@ -97,7 +163,12 @@ class WebSocketHandler(websocket.WebSocketHandler):
         # client handshake request. Propagate the client origin if present;
         # use the Juju API server as origin otherwise.
         headers = get_headers(self.request, apiurl)
+        if pool is not None:
+            # The shared connection is acquired when the user logs in.
+            self._headers = headers
+            raise gen.Return()
         # Connect the WebSocket client to the Juju API server.
+        start_time = time.time()
         self._juju_connected_future = websocket_connect(
             io_loop, apiurl, self.on_juju_message, headers=headers)
         try:
@@ -107,6 +178,10 @@ class WebSocketHandler(websocket.WebSocketHandler):
             logging.exception(err)
             self.connected = False
             raise gen.Return()
+        metrics.histogram(
+            'guiserver_juju_connect_seconds',
+            'Time required to connect to the Juju API server.',
+            CONNECT_BUCKETS).observe(time.time() - start_time)
         # At this point the Juju API is successfully connected.
         self.juju_connected = True
         logging.info(self._summary + 'Juju API connected')
@@ -114,8 +189,7 @@ class WebSocketHandler(websocket.WebSocketHandler):
         # to the Juju API server was established.
         while self.connected and self.juju_connected and len(queue):
             message = queue.popleft()
-            encoded = message.encode('utf-8')
-            logging.debug(self._summary + 'queue -> juju: {}'.format(encoded))
+            self._log_message('queue -> juju', message)
             self.juju_connection.write_message(message)
 
     def select_subprotocol(self, subprotocols):
@@ -130,16 +204,50 @@ class WebSocketHandler(websocket.WebSocketHandler):
         """
         return subprotocols[0]
 
+    def _log_message(self, direction, message):
+        """Log the given proxied message, if debug logging is enabled."""
+        if debug_enabled():
+            logging.debug(self._summary + '{}: {}'.format(
+                direction, message.encode('utf-8')))
+
+    def queue_length(self):
+        """Return the number of messages waiting for the Juju API connection.
+        """
+        return len(self._juju_message_queue)
+
+    def write_message(self, message, binary=False):
+        """Send the given message to the browser."""
+        self.messages_sent += 1
+        self._sent_counter.inc()
+        return super(WebSocketHandler, self).write_message(
+            message, binary=binary)
+
     def on_message(self, message):
         """Hook called when a new message is received from the browser.
 
+        The time spent handling the message is recorded in the metrics.
+        """
+        start_time = time.time()
+        self.messages_received += 1
+        self._received_counter.inc()
+        result = self._handle_message(message)
+        self._client_latency.observe(time.time() - start_time)
+        return result
+
+    def _handle_message(self, message):
+        """Handle a message received from the browser.
+
         If the message is a deployment request, start the deployment process.
         Otherwise the message is propagated to the Juju API server.
         Messages sent before the client connection to the Juju API server is
         established are queued for later delivery.
+
+        Once the user is authenticated, messages which cannot be deployment or
+        token requests are propagated without being decoded.
         """
+        if self.user.is_authenticated and not is_intercepted(message):
+            return self._send_to_juju(message)
         data = json_decode_dict(message)
-        encoded = None
         if data is not None:
             # Handle deployment requests.
             if self.deployment.requested(data):
@@ -150,44 +258,111 @@ class WebSocketHandler(websocket.WebSocketHandler):
                 if new_data is None:
                     # The None marker indicates that a response was sent.
                     return
+                elif isinstance(new_data, Future):
+                    # The login request is sent once the token is retrieved.
+                    return add_future(
+                        self._io_loop, new_data, self._send_token_login)
                 elif new_data != data:
-                    encoded = escape.json_encode(new_data)
-                    message = encoded.decode('utf8')
+                    message = escape.json_encode(new_data).decode('utf8')
             # Handle authentication token requests.
             if self.tokens.token_requested(data):
                 return self.tokens.process_token_request(
                     data, self.user, wrap_write_message(self))
-        # Propagate messages to the Juju API server.
-        if encoded is None:
-            encoded = message.encode('utf-8')
+        return self._send_to_juju(message)
+
+    def _send_token_login(self, future):
+        """Send the login request for a token retrieved asynchronously."""
+        data = future.result()
+        if data is not None and self.connected:
+            self._send_to_juju(escape.json_encode(data).decode('utf8'))
+
+    def _send_to_juju(self, message):
+        """Propagate the given message to the Juju API server.
+
+        If the Juju API is not yet connected, the message is queued.
+        """
+        if self._pool is not None:
+            return self._send_shared(message)
         if self.juju_connected:
-            logging.debug(self._summary + 'client -> juju: {}'.format(encoded))
+            self._log_message('client -> juju', message)
             return self.juju_connection.write_message(message)
-        logging.debug(self._summary + 'client -> queue: {}'.format(encoded))
+        self._log_message('client -> queue', message)
         self._juju_message_queue.append(message)
 
+    def _send_shared(self, message):
+        """Send the given message through the shared Juju API connection.
+
+        Before the user logs in, only login requests are accepted.
+        """
+        data = json_decode_dict(message)
+        if data is None:
+            return
+        self._log_message('client -> shared', message)
+        if self.shared_connection is not None:
+            return self.shared_connection.send(self, data)
+        backend = self._auth_backend
+        if backend.request_is_login(data):
+            return self._login_shared(data)
+        self.on_shared_message(
+            make_error(backend.get_request_id(data), 'not logged in'))
+
+    @gen.coroutine
+    def _login_shared(self, data):
+        """Acquire the shared connection for the credentials in data.
+
+        The login response is sent back to the browser.
+        """
+        backend = self._auth_backend
+        credentials = backend.get_credentials(data)
+        connection, response = yield self._pool.acquire(
+            self, credentials, headers=self._headers)
+        if connection is not None:
+            if not self.connected:
+                # The browser disconnected while logging in.
+                self._pool.release(connection, self)
+                raise gen.Return()
+            self.shared_connection = connection
+            self.juju_connected = True
+            logging.info(self._summary + 'shared Juju API connection acquired')
+        self.on_shared_message(
+            dict(response, RequestId=backend.get_request_id(data)))
+
+    def on_shared_message(self, data):
+        """Hook called when a response arrives through the shared connection.
+
+        The response is propagated to the browser.
+        """
+        self.on_juju_message(escape.json_encode(data).decode('utf8'))
+
     def on_juju_message(self, message):
         """Hook called when a new message is received from the Juju API server.
 
-        The message is propagated to the browser.
+        The message is propagated to the browser. Messages are only decoded
+        while an authentication is in progress.
         """
         if message is None:
             # The Juju API closed the connection.
             return self.on_juju_close()
-        data = json_decode_dict(message)
-        if (data is not None) and self.auth.in_progress():
-            encoded = escape.json_encode(
-                self.auth.process_response(data))
-            message = encoded.decode('utf8')
-        else:
-            encoded = message.encode('utf-8')
-        logging.debug(self._summary + 'juju -> client: {}'.format(encoded))
+        start_time = time.time()
+        if self.auth.in_progress():
+            data = json_decode_dict(message)
+            if data is not None:
+                message = escape.json_encode(
+                    self.auth.process_response(data)).decode('utf8')
+        self._log_message('juju -> client', message)
         self.write_message(message)
+        self._juju_latency.observe(time.time() - start_time)
 
     def on_close(self):
         """Hook called when the WebSocket connection is terminated."""
         logging.info(self._summary + 'client connection closed')
         self.connected = False
+        self._metrics.remove_connection(self)
+        if self._pool is not None:
+            if self.shared_connection is not None:
+                self._pool.release(self.shared_connection, self)
+                self.shared_connection = None
+            return
         # At this point the WebSocket client connection to the Juju API server
         # might not yet be established. For this reason the connection is
         # terminated adding a callback to the corresponding future.
@@ -199,6 +374,7 @@ class WebSocketHandler(websocket.WebSocketHandler):
         logging.info(self._summary + 'Juju API connection closed')
         self.juju_connected = False
         self.juju_connection = None
+        self.shared_connection = None
         # Usually the Juju API connection is terminated as a consequence of a
         # browser disconnection. A server disconnection is unexpected and
         # unlikely to happen. In the future Juju will support HA and we will
@@ -209,15 +385,115 @@ class WebSocketHandler(websocket.WebSocketHandler):
             self.close()
 
 
-class IndexHandler(web.StaticFileHandler):
+class CompressedStaticFileHandler(web.StaticFileHandler):
+    """Serve static files, preferring their precompressed variants.
+
+    If the client accepts gzip encoded responses, and a "<name>.gz" file not
+    older than the requested one exists, the compressed file is sent in place
+    of the original one. The charm creates those files when setting up the
+    GUI release.
+
+    Versioned assets, i.e. those requested with a "v" argument or including a
+    content hash in their name, are cached by browsers for a long time.
+    """
+
+    # Map absolute paths to ((modification time, size), content hash) tuples.
+    _etags = {}
+
+    def initialize(self, path, default_filename=None):
+        """Initialize the handler."""
+        super(CompressedStaticFileHandler, self).initialize(
+            path, default_filename=default_filename)
+        self.gzipped = False
+
+    def validate_absolute_path(self, root, absolute_path):
+        """See tornado.web.StaticFileHandler.validate_absolute_path."""
+        absolute_path = super(
+            CompressedStaticFileHandler, self).validate_absolute_path(
+                root, absolute_path)
+        if absolute_path is None or not accepts_gzip(self.request):
+            return absolute_path
+        compressed_path = absolute_path + '.gz'
+        try:
+            compressed_mtime = os.stat(compressed_path).st_mtime
+        except OSError:
+            return absolute_path
+        if compressed_mtime < os.stat(absolute_path).st_mtime:
+            # The compressed file is stale.
+            return absolute_path
+        self.gzipped = True
+        return compressed_path
+
+    def compute_etag(self):
+        """Return a strong ETag, a hash of the content being sent.
+
+        Hashes are computed once for each version of a file, and only the
+        hash of the latest version is kept.
+        """
+        abspath = self.absolute_path
+        stat_result = os.stat(abspath)
+        key = (stat_result.st_mtime, stat_result.st_size)
+        cached = self._etags.get(abspath)
+        if cached is None or cached[0] != key:
+            cached = self._etags[abspath] = (
+                key, self.get_content_version(abspath))
+        return '"{}"'.format(cached[1])
+
+    def get_cache_time(self, path, modified, mime_type):
+        """See tornado.web.StaticFileHandler.get_cache_time."""
+        if 'v' in self.request.arguments or VERSIONED_ASSET.search(path):
+            return self.CACHE_MAX_AGE
+        return 0
+
+    def set_extra_headers(self, path):
+        """See tornado.web.StaticFileHandler.set_extra_headers."""
+        self.set_header('Vary', 'Accept-Encoding')
+        if self.gzipped:
+            self.set_header('Content-Encoding', 'gzip')
+        cache_time = self.get_cache_time(path, self.modified, None)
+        if cache_time:
+            # Versioned assets never change.
+            self.set_header(
+                'Cache-Control',
+                'public, max-age={}, immutable'.format(cache_time))
+
+
+class IndexHandler(CompressedStaticFileHandler):
     """Serve all requests using the index.html file placed in the static root.
+
+    The index contents are kept in memory, and reloaded when the file changes.
+    Browsers are asked to revalidate the index on every visit, so that they
+    always load the assets of the current GUI release.
     """
 
+    # Map absolute paths to ((modification time, size), contents) tuples.
+    _contents = {}
+
     @classmethod
     def get_absolute_path(cls, root, path):
         """See tornado.web.StaticFileHandler.get_absolute_path."""
         return os.path.join(root, 'index.html')
 
+    @classmethod
+    def get_content(cls, abspath, start=None, end=None):
+        """See tornado.web.StaticFileHandler.get_content."""
+        stat_result = os.stat(abspath)
+        key = (stat_result.st_mtime, stat_result.st_size)
+        cached = cls._contents.get(abspath)
+        if cached is None or cached[0] != key:
+            with open(abspath, 'rb') as index_file:
+                cached = cls._contents[abspath] = (key, index_file.read())
+        return cached[1][start:end]
+
+    def get_cache_time(self, path, modified, mime_type):
+        """See tornado.web.StaticFileHandler.get_cache_time."""
+        return 0
+
+    def set_extra_headers(self, path):
+        """See tornado.web.StaticFileHandler.set_extra_headers."""
+        super(IndexHandler, self).set_extra_headers(path)
+        self.set_header('Cache-Control', 'no-cache')
+
 
 class InfoHandler(web.RequestHandler):
     """Return information about the GUI server."""
@@ -250,6 +526,25 @@ class InfoHandler(web.RequestHandler):
         self.write(info)
 
 
+class MetricsHandler(web.RequestHandler):
+    """Return the GUI server metrics using the Prometheus text format.
+
+    When multiple GUI server processes are running, the request is served by
+    one of them, returning only its own metrics labelled with its process
+    number.
+    """
+
+    def initialize(self, metrics):
+        """Initialize the handler."""
+        self.metrics = metrics
+
+    def get(self):
+        """Handle GET requests."""
+        self.set_header(
+            'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.metrics.render())
+
+
 class HttpsRedirectHandler(web.RequestHandler):
     """Permanently redirect all the requests to the equivalent HTTPS URL."""
 
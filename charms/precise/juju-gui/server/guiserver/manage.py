@@ -16,10 +16,19 @@
 
 """Juju GUI server management."""
 
+import atexit
 import logging
 import os
+import shutil
+import signal
 import sys
+import tempfile
 
+from tornado import (
+    netutil,
+    process,
+)
+from tornado.httpserver import HTTPServer
 from tornado.ioloop import IOLoop
 from tornado.options import (
     define,
@@ -36,6 +45,11 @@ from guiserver.apps import (
 
 DEFAULT_API_VERSION = 'go'
 DEFAULT_SSL_PATH = '/etc/ssl/juju-gui'
+DEFAULT_DEPLOY_WORKERS = 1
+DEFAULT_PROCESSES = 1
+# Directories backed by memory where the temporary tokens database is created,
+# so that the user credentials it includes are never written to disk.
+MEMORY_DIRS = ('/run/shm', '/dev/shm')
 
 
 def _add_debug(logger):
@@ -119,17 +133,124 @@ def setup():
     define(
         'charmworldurl', type=str,
         help='The URL to use for Charmworld.')
+    define(
+        'multiplex', type=bool, default=False,
+        help='Set to True to share a single Juju API connection, and its '
+             'AllWatcher, between all the browsers logged in with the same '
+             'credentials. Only supported by the "go" API version.')
+    define(
+        'deployworkers', type=int, default=DEFAULT_DEPLOY_WORKERS,
+        help='The maximum number of bundle deployments executed at the same '
+             'time by all the GUI server processes. Bundles including the '
+             'same services are never deployed concurrently.')
+    define(
+        'processes', type=int, default=DEFAULT_PROCESSES,
+        help='The number of GUI server processes to start, all listening on '
+             'the same ports. Use 0 to start a process for each CPU.')
+    define(
+        'tokenstore', type=str,
+        help='The path of the SQLite database used to share authentication '
+             'tokens and bundle deployment workers between the GUI server '
+             'processes. The database includes user credentials: it should '
+             'be stored in memory, e.g. on a tmpfs file system. It is removed '
+             'when the server exits. If not provided, a temporary database is '
+             'used when running multiple processes.')
 
     # In Tornado, parsing the options also sets up the default logger.
     parse_command_line()
     _validate_required('guiroot')
     _validate_choices('apiversion', ('go', 'python'))
+    if options.multiplex and options.apiversion != 'go':
+        sys.exit('error: the multiplex argument requires the go API version')
+    if options.deployworkers < 1:
+        sys.exit('error: the deployworkers argument must be a positive number')
+    if options.processes < 0:
+        sys.exit('error: the processes argument must not be a negative number')
     _add_debug(logging.getLogger())
 
 
+def _at_main_exit(function, *args):
+    """Call the function with the given args when the main process exits."""
+    pid = os.getpid()
+
+    def cleanup():
+        # Forked processes inherit the exit handlers.
+        if os.getpid() == pid:
+            function(*args)
+    atexit.register(cleanup)
+
+
+def _exit(signum, frame):
+    """Exit when a signal is received, running the exit handlers."""
+    sys.exit(0)
+
+
+def _get_memory_dir():
+    """Return a directory backed by memory, or None if none is available."""
+    for path in MEMORY_DIRS:
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+def _make_tokenstore():
+    """Create a temporary directory for the shared tokens database.
+
+    The directory is created in memory if possible. Return the database path.
+    The directory is removed when the main process exits.
+    """
+    directory = tempfile.mkdtemp(prefix='guiserver-', dir=_get_memory_dir())
+    _at_main_exit(shutil.rmtree, directory, True)
+    return os.path.join(directory, 'tokens.db')
+
+
+def _remove_tokenstore(path):
+    """Remove the given tokens database, including its journal."""
+    for filename in (path, path + '-journal'):
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+
+
+def _run_processes():
+    """Fork the GUI server processes, all sharing the same listening sockets.
+
+    The sockets are bound before forking, and each process then creates its
+    own IO loop and applications.
+    """
+    if options.insecure:
+        listeners = [(server, netutil.bind_sockets(80), None)]
+    else:
+        listeners = [
+            (server, netutil.bind_sockets(443), _get_ssl_options()),
+            (redirector, netutil.bind_sockets(80), None),
+        ]
+    if not options.tokenstore:
+        options.tokenstore = _make_tokenstore()
+    else:
+        if not os.path.isdir(os.path.dirname(options.tokenstore)):
+            # The database stores user credentials.
+            os.makedirs(os.path.dirname(options.tokenstore), 0700)
+        # Tokens left behind by a server no longer running are not removed
+        # anymore by their sweeps.
+        _remove_tokenstore(options.tokenstore)
+        _at_main_exit(_remove_tokenstore, options.tokenstore)
+    # The database is removed by the exit handlers also when the server is
+    # stopped.
+    signal.signal(signal.SIGTERM, _exit)
+    # In the parent process, this only returns when all the children exit.
+    task_id = process.fork_processes(options.processes)
+    logging.info('process {} started'.format(task_id))
+    for application, sockets, ssl_options in listeners:
+        HTTPServer(application(), ssl_options=ssl_options).add_sockets(sockets)
+
+
 def run():
     """Run the server"""
-    if options.insecure:
+    if options.processes != 1:
+        _run_processes()
+    elif options.insecure:
         # Run the server over an insecure HTTP connection.
         server().listen(80)
     else:
@@ -0,0 +1,239 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2014 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server metrics.
+
+The GUI server collects metrics about the proxied WebSocket traffic and the
+bundle deployments. They are exposed by handlers.MetricsHandler using the
+Prometheus text format.
+
+    - Counter: a value which can only increase, e.g. the number of messages
+      received from browsers;
+    - Histogram: a distribution of observed values, e.g. the time spent by
+      the proxy handling messages. Values are counted in cumulative buckets;
+    - Metrics: the collection of metrics of the GUI server. Counters and
+      histograms are created once, usually when a connection is opened,
+      so that updating them while proxying messages is just an increment.
+      Gauges are instead registered as functions called when the metrics
+      are rendered.
+
+When the GUI server runs multiple processes, each process collects and
+renders its own metrics: Metrics can be given labels, e.g. the process number,
+added to all the samples so that the series of each process are distinct.
+
+Metrics also keeps track of the open WebSocket connections, which are objects
+implementing the following interface:
+    - metrics_id: a number identifying the connection;
+    - messages_received: the number of messages received from the browser;
+    - messages_sent: the number of messages sent to the browser;
+    - queue_length(): return the number of messages waiting to be sent to
+      the Juju API server.
+"""
+
+import bisect
+from collections import OrderedDict
+import itertools
+
+
+# Histogram buckets (upper bounds, in seconds) for the time spent by the proxy
+# handling a message.
+LATENCY_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+# Histogram buckets for the time required to connect to the Juju API server.
+CONNECT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Histogram buckets for the bundle deployments wait and run times.
+DEPLOYMENT_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+
+def _format_labels(labels):
+    """Format the given sequence of (name, value) label pairs."""
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = unicode(value).replace('\\', r'\\').replace(
+            '\n', r'\n').replace('"', r'\"')
+        pairs.append(u'{}="{}"'.format(name, value))
+    return u'{' + u','.join(pairs) + u'}'
+
+
+def _format_value(value):
+    """Format a sample value."""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    """A monotonically increasing value."""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        """Increment the counter by the given amount."""
+        self.value += amount
+
+    def samples(self, name, labels):
+        """Return a list of (name, labels, value) samples."""
+        return [(name, labels, self.value)]
+
+
+class Histogram(object):
+    """Count observed values in buckets defined by their upper bounds."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        # The last item counts values greater than the highest bound.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """Record the given value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """Return a list of (name, labels, value) samples."""
+        samples = []
+        cumulative = 0
+        bounds = self.buckets + (float('inf'),)
+        for bound, count in zip(bounds, self.counts):
+            cumulative += count
+            bucket_labels = labels + (('le', _format_value(bound)),)
+            samples.append((name + '_bucket', bucket_labels, cumulative))
+        samples.append((name + '_sum', labels, self.sum))
+        samples.append((name + '_count', labels, self.count))
+        return samples
+
+
+class Metrics(object):
+    """The GUI server metrics.
+
+    The given labels are added to all the rendered samples.
+    """
+
+    def __init__(self, **labels):
+        self._labels = tuple(sorted(labels.items()))
+        # The families attribute maps metric names to (kind, help, metrics)
+        # tuples, where metrics is an ordered dict mapping labels to either
+        # counters/histograms or, for gauges, to functions returning the
+        # current value.
+        self._families = OrderedDict()
+        self._connection_ids = itertools.count(1)
+        self.connections = set()
+        self._connections_total = self.counter(
+            'guiserver_connections_total', 'WebSocket connections opened.')
+        self.gauge(
+            'guiserver_connections', 'Open WebSocket connections.',
+            lambda: len(self.connections))
+
+    def _get(self, factory, kind, name, help, labels):
+        """Return the metric with the given name and labels.
+
+        Create the metric if it does not exist.
+        """
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (kind, help, OrderedDict())
+        elif family[0] != kind:
+            raise ValueError('{} is a {}'.format(name, family[0]))
+        metrics = family[2]
+        labels = tuple(sorted(labels.items()))
+        metric = metrics.get(labels)
+        if metric is None:
+            metric = metrics[labels] = factory()
+        return metric
+
+    def counter(self, name, help, **labels):
+        """Return the counter with the given name and labels."""
+        return self._get(Counter, 'counter', name, help, labels)
+
+    def histogram(self, name, help, buckets, **labels):
+        """Return the histogram with the given name and labels.
+
+        The buckets are only used when the histogram is created.
+        """
+        return self._get(
+            lambda: Histogram(buckets), 'histogram', name, help, labels)
+
+    def gauge(self, name, help, function, **labels):
+        """Register a gauge whose value is returned by the given function."""
+        family = self._families.setdefault(
+            name, ('gauge', help, OrderedDict()))
+        family[2][tuple(sorted(labels.items()))] = function
+
+    def add_connection(self, connection):
+        """Start tracking the given WebSocket connection.
+
+        Return the identifier assigned to the connection.
+        """
+        self._connections_total.inc()
+        self.connections.add(connection)
+        return next(self._connection_ids)
+
+    def remove_connection(self, connection):
+        """Stop tracking the given WebSocket connection."""
+        self.connections.discard(connection)
+
+    def _connection_samples(self):
+        """Yield the families of per-connection samples."""
+        connections = sorted(
+            self.connections, key=lambda connection: connection.metrics_id)
+        families = (
+            ('guiserver_connection_messages_received_total', 'counter',
+             'Messages received from the browser by open connections.',
+             lambda connection: connection.messages_received),
+            ('guiserver_connection_messages_sent_total', 'counter',
+             'Messages sent to the browser by open connections.',
+             lambda connection: connection.messages_sent),
+            ('guiserver_connection_queue_length', 'gauge',
+             'Messages waiting for the Juju API connection to be '
+             'established.',
+             lambda connection: connection.queue_length()),
+        )
+        for name, kind, help, get_value in families:
+            samples = [
+                (name, (('connection', connection.metrics_id),),
+                 get_value(connection))
+                for connection in connections]
+            yield name, kind, help, samples
+
+    def render(self):
+        """Return the metrics using the Prometheus text format."""
+        families = []
+        for name, (kind, help, metrics) in self._families.items():
+            if kind == 'gauge':
+                samples = [
+                    (name, labels, function())
+                    for labels, function in metrics.items()]
+            else:
+                samples = []
+                for labels, metric in metrics.items():
+                    samples.extend(metric.samples(name, labels))
+            families.append((name, kind, help, samples))
+        families.extend(self._connection_samples())
+        lines = []
+        for name, kind, help, samples in families:
+            lines.append(u'# HELP {} {}'.format(name, help))
+            lines.append(u'# TYPE {} {}'.format(name, kind))
+            for sample_name, labels, value in samples:
+                lines.append(u'{}{} {}'.format(
+                    sample_name, _format_labels(self._labels + labels),
+                    _format_value(value)))
+        return u'\n'.join(lines) + u'\n'
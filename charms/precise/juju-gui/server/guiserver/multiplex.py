@@ -0,0 +1,358 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2014 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Juju GUI server shared Juju API connections.
+
+When the GUI server is started with the --multiplex option, browser
+connections do not open their own connection to the Juju API server.
+Instead, the ones logged in using the same credentials share a single
+authenticated connection:
+
+    - SharedConnection: an authenticated Juju API connection. Requests from
+      every browser connection (a client) are sent through it, rewriting their
+      RequestId so that responses can be routed back to the right client.
+      The first client requesting an AllWatcher starts a single upstream
+      watcher: its deltas feed an EnvironmentWatcher, a copy of the
+      environment state. Clients starting to watch receive a snapshot of the
+      state, and then the deltas fanned out to every client asking for the
+      next changes.
+    - ConnectionPool: the collection of shared connections, keyed by user
+      credentials. A shared connection is created and logged in when the first
+      client logs in, and it is closed when the last client goes away.
+
+Clients are objects implementing the following interface:
+    - on_shared_message(data): called passing the response to a request
+      previously sent by the client;
+    - on_juju_close(): called when the shared connection is terminated.
+
+Only the Go API implementation is supported.
+"""
+
+import itertools
+import logging
+
+from tornado import (
+    escape,
+    gen,
+)
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from guiserver.auth import GoBackend
+from guiserver.clients import websocket_connect
+from guiserver.utils import (
+    add_future,
+    json_decode_dict,
+)
+from guiserver.watchers import EnvironmentWatcher
+
+
+# The AllWatcher identifier returned to clients. Since all the clients share
+# the same AllWatcher, there is no need to use the upstream one.
+SHARED_WATCHER_ID = 'shared'
+
+
+def make_error(request_id, error, code='unauthorized access'):
+    """Create and return a Go API error response."""
+    return {
+        'RequestId': request_id,
+        'Error': error,
+        'ErrorCode': code,
+        'Response': {},
+    }
+
+
+class SharedConnection(object):
+    """A Juju API connection shared by all the clients using the same
+    credentials.
+
+    Use the connect() method to open and log in the connection.
+    """
+
+    def __init__(self, apiurl, credentials, headers=None, io_loop=None):
+        self.apiurl = apiurl
+        self.credentials = credentials
+        self.clients = set()
+        self.closed = False
+        self.login_response = None
+        self.environment = EnvironmentWatcher()
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._headers = headers
+        self._connection = None
+        self._connect_future = None
+        self._request_ids = itertools.count(1)
+        # The _pending attribute maps upstream request identifiers to the
+        # callbacks to be called with the corresponding responses.
+        self._pending = {}
+        # The _next_requests attribute maps clients to the request identifier
+        # of their pending AllWatcher.Next request.
+        self._next_requests = {}
+        # The _watching attribute is True while the upstream AllWatcher is
+        # running, _watcher_id is its identifier once started.
+        self._watching = False
+        self._watcher_id = None
+
+    def connect(self):
+        """Connect and log in to the Juju API server.
+
+        Return a Future whose result is the login response. Subsequent calls
+        return the same Future.
+        """
+        if self._connect_future is None:
+            self._connect_future = self._connect()
+        return self._connect_future
+
+    @gen.coroutine
+    def _connect(self):
+        self._connection = yield websocket_connect(
+            self._io_loop, self.apiurl, self.on_message,
+            headers=self._headers)
+        if self.closed:
+            # The connection has been closed while connecting.
+            self._connection.close()
+            raise gen.Return(make_error(None, 'connection closed', ''))
+        logging.info('multiplex: Juju API connected')
+        request = GoBackend().make_request(None, *self.credentials)
+        response = yield self._request(request)
+        if 'Error' not in response:
+            self.login_response = response
+        raise gen.Return(response)
+
+    def _request(self, data):
+        """Send the given request to the Juju API server.
+
+        Return a Future whose result is the response.
+        """
+        future = Future()
+        self._send(data, future.set_result)
+        return future
+
+    def _send(self, data, callback):
+        """Send a request, calling callback with the response."""
+        request_id = next(self._request_ids)
+        self._pending[request_id] = callback
+        data = dict(data, RequestId=request_id)
+        self._connection.write_message(escape.json_encode(data))
+
+    def on_message(self, message):
+        """Hook called when a new message is received from the Juju API server.
+
+        Route the response to the callback registered by the request.
+        """
+        if message is None:
+            return self._on_close()
+        data = json_decode_dict(message)
+        if data is None:
+            return
+        callback = self._pending.pop(data.get('RequestId'), None)
+        if callback is None:
+            logging.warning(
+                'multiplex: unexpected response: {!r}'.format(message))
+            return
+        callback(data)
+
+    def _on_close(self):
+        """Handle the upstream connection termination."""
+        logging.info('multiplex: Juju API connection closed')
+        self.closed = True
+        pending, self._pending = self._pending, {}
+        for request_id, callback in pending.items():
+            callback(make_error(
+                request_id, 'Juju API connection closed', ''))
+        for client in list(self.clients):
+            client.on_juju_close()
+        self.clients.clear()
+
+    def add_client(self, client):
+        """Add a client to the shared connection."""
+        self.clients.add(client)
+
+    def remove_client(self, client):
+        """Remove a client from the shared connection.
+
+        Responses to requests previously sent by the client are discarded.
+        """
+        self.clients.discard(client)
+        self._next_requests.pop(client, None)
+        self.environment.discard(client)
+
+    def send(self, client, data):
+        """Send a request on behalf of the given client.
+
+        Login and AllWatcher requests are handled locally. The response is
+        sent to the client as a dict by calling its on_shared_message method.
+        """
+        request_id = data.get('RequestId')
+        kind = (data.get('Type'), data.get('Request'))
+        if kind == ('Admin', 'Login'):
+            # The shared connection is already logged in.
+            response = dict(self.login_response, RequestId=request_id)
+            return client.on_shared_message(response)
+        if kind == ('Client', 'WatchAll'):
+            return self._watch_all(client, request_id)
+        if kind == ('AllWatcher', 'Next'):
+            return self._next(client, request_id)
+        if kind == ('AllWatcher', 'Stop'):
+            return self._stop(client, request_id)
+
+        def callback(response):
+            if client in self.clients:
+                client.on_shared_message(dict(response, RequestId=request_id))
+        self._send(data, callback)
+
+    def _watch_all(self, client, request_id):
+        """Subscribe the client to the shared AllWatcher."""
+        # Start from the current environment state, as a new AllWatcher would.
+        self.environment.subscribe(client)
+        if not self._watching:
+            self._watching = True
+            self._watch()
+        client.on_shared_message({
+            'RequestId': request_id,
+            'Response': {'AllWatcherId': SHARED_WATCHER_ID},
+        })
+
+    @gen.coroutine
+    def _watch(self):
+        """Feed the shared AllWatcher with the upstream deltas."""
+        response = yield self._request(
+            {'Type': 'Client', 'Request': 'WatchAll', 'Params': {}})
+        if 'Error' in response:
+            logging.error('multiplex: unable to start the AllWatcher: '
+                          '{}'.format(response['Error']))
+            self._stop_watching(response['Error'])
+            raise gen.Return()
+        self._watcher_id = response['Response']['AllWatcherId']
+        while not self.closed:
+            response = yield self._request({
+                'Type': 'AllWatcher',
+                'Request': 'Next',
+                'Id': self._watcher_id,
+                'Params': {},
+            })
+            if 'Error' in response:
+                if not self.closed:
+                    logging.error('multiplex: AllWatcher error: '
+                                  '{}'.format(response['Error']))
+                    self._stop_watching(response['Error'])
+                break
+            self.environment.put(response['Response']['Deltas'])
+
+    def _stop_watching(self, error):
+        """Handle the upstream AllWatcher failure.
+
+        Pending Next requests fail with the given error, as they would with a
+        client's own AllWatcher. The next WatchAll request starts a new
+        upstream watcher.
+        """
+        self._watching = False
+        self._watcher_id = None
+        next_requests, self._next_requests = self._next_requests, {}
+        for client, request_id in next_requests.items():
+            self.environment.discard(client)
+            client.on_shared_message(make_error(request_id, error, ''))
+
+    def _next(self, client, request_id):
+        """Send the client the AllWatcher deltas it has not seen yet."""
+        if not self._watching:
+            # The upstream AllWatcher failed since the client started
+            # watching.
+            self.environment.discard(client)
+            return client.on_shared_message(
+                make_error(request_id, 'watcher was stopped', ''))
+        self._next_requests[client] = request_id
+        add_future(
+            self._io_loop, self.environment.next(client),
+            self._send_deltas, client, request_id)
+
+    def _send_deltas(self, client, request_id, future):
+        if self._next_requests.get(client) != request_id:
+            # The watcher has been stopped or the client went away.
+            return
+        del self._next_requests[client]
+        deltas = [delta for changes in future.result() for delta in changes]
+        client.on_shared_message({
+            'RequestId': request_id,
+            'Response': {'Deltas': deltas},
+        })
+
+    def _stop(self, client, request_id):
+        """Unsubscribe the client from the shared AllWatcher."""
+        self.environment.discard(client)
+        next_request_id = self._next_requests.pop(client, None)
+        if next_request_id is not None:
+            client.on_shared_message(
+                make_error(next_request_id, 'watcher was stopped', ''))
+        client.on_shared_message({'RequestId': request_id, 'Response': {}})
+
+    def close(self):
+        """Close the upstream connection."""
+        if self.closed:
+            return
+        self.closed = True
+        if self._connection is not None:
+            self._connection.close()
+
+
+class ConnectionPool(object):
+    """The shared Juju API connections, one for each set of credentials."""
+
+    def __init__(self, apiurl, io_loop=None):
+        self.apiurl = apiurl
+        if io_loop is None:
+            io_loop = IOLoop.current()
+        self._io_loop = io_loop
+        self._connections = {}
+
+    @gen.coroutine
+    def acquire(self, client, credentials, headers=None):
+        """Log in the given client using the given credentials.
+
+        Return a Future whose result is a tuple (connection, login response).
+        If the login fails, the connection is None.
+        """
+        credentials = tuple(credentials)
+        connection = self._connections.get(credentials)
+        if connection is None or connection.closed:
+            connection = SharedConnection(
+                self.apiurl, credentials, headers=headers,
+                io_loop=self._io_loop)
+            self._connections[credentials] = connection
+        connection.add_client(client)
+        try:
+            response = yield connection.connect()
+        except Exception as err:
+            logging.error('multiplex: unable to connect to the Juju API')
+            logging.exception(err)
+            response = make_error(
+                None, 'unable to connect to the Juju API', '')
+        if connection.login_response is None or connection.closed:
+            self.release(connection, client)
+            raise gen.Return((None, response))
+        raise gen.Return((connection, response))
+
+    def release(self, connection, client):
+        """Release the shared connection used by the given client.
+
+        The connection is closed if it is no longer used by any client.
+        """
+        connection.remove_client(client)
+        if not connection.clients:
+            if self._connections.get(connection.credentials) is connection:
+                del self._connections[connection.credentials]
+            connection.close()
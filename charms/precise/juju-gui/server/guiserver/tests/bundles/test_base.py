@@ -16,6 +16,10 @@
 
 """Tests for the bundle deployment base objects."""
 
+import os
+import shutil
+import tempfile
+
 from deployer import cli as deployer_cli
 import jujuclient
 import mock
@@ -217,6 +221,114 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         # Wait for the deployment to be completed.
         self.wait()
 
+    @gen_test
+    def test_parallel_deployments(self):
+        # Deployments not sharing services are started at the same time.
+        deployer = self.make_deployer(workers=2)
+        with self.patch_import_bundle():
+            deployment1 = deployer.import_bundle(
+                self.user, 'bundle', {'services': {'mysql': {}}},
+                bundle_id=None)
+            deployment2 = deployer.import_bundle(
+                self.user, 'bundle', {'services': {'wordpress': {}}},
+                bundle_id=None)
+        watcher1 = deployer.watch(deployment1)
+        watcher2 = deployer.watch(deployment2)
+        changes = yield deployer.next(watcher1)
+        self.assert_change(changes, deployment1, utils.STARTED, queue=0)
+        changes = yield deployer.next(watcher2)
+        self.assert_change(changes, deployment2, utils.STARTED, queue=0)
+        # Wait for the deployments to be completed.
+        changes = yield deployer.next(watcher1)
+        self.assert_change(changes, deployment1, utils.COMPLETED)
+        changes = yield deployer.next(watcher2)
+        self.assert_change(changes, deployment2, utils.COMPLETED)
+
+    @gen_test
+    def test_deployment_metrics(self):
+        # The deployment wait and run times are recorded, and completed
+        # deployments are counted.
+        deployer = self.make_deployer()
+        metrics = deployer._metrics
+        with self.patch_import_bundle():
+            deployment_id = deployer.import_bundle(
+                self.user, 'bundle', self.bundle, bundle_id=None)
+        watcher_id = deployer.watch(deployment_id)
+        yield deployer.next(watcher_id)
+        self.assertIn('guiserver_deployments_running 1', metrics.render())
+        changes = yield deployer.next(watcher_id)
+        self.assert_change(changes, deployment_id, utils.COMPLETED)
+        wait_times = metrics.histogram('guiserver_deployment_wait_seconds',
+                                       '', ())
+        run_times = metrics.histogram('guiserver_deployment_run_seconds',
+                                      '', ())
+        self.assertEqual(1, wait_times.count)
+        self.assertEqual(1, run_times.count)
+        counter = metrics.counter(
+            'guiserver_deployments_total', '', outcome='success')
+        self.assertEqual(1, counter.value)
+        self.assertIn('guiserver_deployments_running 0', metrics.render())
+        self.assertEqual({}, deployer._times)
+
+    @gen_test
+    def test_overlapping_deployments(self):
+        # Deployments sharing services are executed one after the other.
+        deployer = self.make_deployer(workers=2)
+        bundle = {'services': {'mysql': {}, 'wordpress': {}}}
+        with self.patch_import_bundle():
+            deployment1 = deployer.import_bundle(
+                self.user, 'bundle', bundle, bundle_id=None)
+            deployment2 = deployer.import_bundle(
+                self.user, 'bundle', {'services': {'mysql': {}}},
+                bundle_id=None)
+            deployment3 = deployer.import_bundle(
+                self.user, 'bundle', {'services': {'haproxy': {}}},
+                bundle_id=None)
+        watcher1 = deployer.watch(deployment1)
+        watcher2 = deployer.watch(deployment2)
+        watcher3 = deployer.watch(deployment3)
+        changes = yield deployer.next(watcher2)
+        self.assert_change(changes, deployment2, utils.SCHEDULED, queue=1)
+        # The third deployment does not wait for the previous ones.
+        changes = yield deployer.next(watcher3)
+        self.assert_change(changes, deployment3, utils.STARTED, queue=0)
+        yield deployer.next(watcher1)
+        changes = yield deployer.next(watcher1)
+        self.assert_change(changes, deployment1, utils.COMPLETED)
+        # The second deployment is started when the first one completes.
+        changes = yield deployer.next(watcher2)
+        self.assertEqual(utils.STARTED, changes[-1]['Status'])
+        # Wait for the deployments to be completed.
+        changes = yield deployer.next(watcher2)
+        self.assert_change(changes, deployment2, utils.COMPLETED)
+        yield deployer.next(watcher3)
+
+    @gen_test
+    def test_shared_slots(self):
+        # Deployments wait for the ones started by other processes sharing
+        # the store, and are started once those complete.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'store.db')
+        deployer = base.Deployer(self.apiurl, 'go', workers=2, store=path)
+        helpers.add_deployment_slot(path, os.getppid(), 1, ['mysql'])
+        with self.patch_import_bundle():
+            with mock.patch('guiserver.bundles.base.SLOTS_POLL_INTERVAL', 0):
+                deployment_id = deployer.import_bundle(
+                    self.user, 'bundle', {'services': {'mysql': {}}},
+                    bundle_id=None)
+                watcher_id = deployer.watch(deployment_id)
+                changes = yield deployer.next(watcher_id)
+                self.assert_change(
+                    changes, deployment_id, utils.SCHEDULED, queue=1)
+                helpers.remove_deployment_slots(path, os.getppid())
+                changes = yield deployer.next(watcher_id)
+        self.assertEqual(utils.STARTED, changes[-1]['Status'])
+        changes = yield deployer.next(watcher_id)
+        self.assert_change(changes, deployment_id, utils.COMPLETED)
+        # The slot is released once the deployment completes.
+        self.assertTrue(utils.DeploymentSlots(path, 1).acquire(0, None))
+
     @gen_test
     def test_deployment_failure(self):
         # An error change is notified if the deployment process fails.
@@ -408,6 +520,20 @@ class TestDeployer(helpers.BundlesTestMixin, LogTrapTestCase, AsyncTestCase):
         mock_notify.assert_called_with(deployer_id, error=None)
         mock_incrementer.assert_called_with(bundle_id, deployer._charmworldurl)
 
+    def test_import_callback_cancelled_metrics(self):
+        # Cancelled deployments are counted.
+        deployer = self.make_deployer()
+        deployer_id = 123
+        deployer._queue.append(deployer_id)
+        deployer._futures[deployer_id] = None
+        deployer._times[deployer_id] = 0
+        with mock.patch.object(deployer._observer, 'notify_cancelled'):
+            deployer._import_callback(deployer_id, None, FakeFuture(True))
+        counter = deployer._metrics.counter(
+            'guiserver_deployments_total', '', outcome='cancelled')
+        self.assertEqual(1, counter.value)
+        self.assertEqual({}, deployer._times)
+
 
 class TestDeployMiddleware(helpers.BundlesTestMixin, AsyncTestCase):
 
@@ -16,6 +16,9 @@
 
 """Tests for the deployment utility functions and objects."""
 
+import os
+import shutil
+import tempfile
 import unittest
 
 from concurrent.futures import Future
@@ -32,6 +35,7 @@ import urllib
 from guiserver import watchers
 from guiserver.bundles import utils
 from guiserver.tests import helpers
+from guiserver.utils import open_database
 from jujuclient import EnvError
 
 mock_time = mock.patch('time.time', mock.Mock(return_value=12345))
@@ -269,6 +273,262 @@ class TestObserver(LogTrapTestCase, unittest.TestCase):
         self.assertTrue(watcher.closed)
 
 
+    @mock_time
+    def test_latest_change_retained(self):
+        # Deployment watchers only retain the latest deployment change.
+        deployment_id = self.observer.add_deployment()
+        watcher = self.observer.deployments[deployment_id]
+        self.observer.notify_position(deployment_id, 2)
+        self.observer.notify_position(deployment_id, 1)
+        self.observer.notify_position(deployment_id, 0)
+        changes = watcher.next(self.observer.add_watcher(deployment_id))
+        expected = {
+            'DeploymentId': deployment_id,
+            'Status': utils.STARTED,
+            'Time': 12345,
+            'Queue': 0,
+        }
+        self.assertEqual([expected], changes.result())
+
+    def test_expire(self):
+        # Closed deployments and their watchers are forgotten after the TTL.
+        observer = utils.Observer(ttl=60)
+        with mock.patch('time.time', mock.Mock(return_value=1000)):
+            deployment1 = observer.add_deployment()
+            deployment2 = observer.add_deployment()
+            observer.add_watcher(deployment1)
+            watcher2 = observer.add_watcher(deployment2)
+            observer.notify_completed(deployment1)
+        with mock.patch('time.time', mock.Mock(return_value=1059)):
+            observer.expire()
+        self.assertEqual(2, len(observer.deployments))
+        with mock.patch('time.time', mock.Mock(return_value=1060)):
+            observer.expire()
+        self.assertEqual([deployment2], observer.deployments.keys())
+        self.assertEqual({watcher2: deployment2}, observer.watchers)
+
+    def test_expire_open_deployments(self):
+        # Deployments in progress are never expired.
+        self.observer.ttl = 0
+        deployment_id = self.observer.add_deployment()
+        self.observer.notify_position(deployment_id, 0)
+        self.observer.expire()
+        self.assert_deployment(deployment_id)
+
+    def test_expire_on_add_deployment(self):
+        # Expired deployments are removed when new deployments are added.
+        observer = utils.Observer(ttl=0)
+        deployment1 = observer.add_deployment()
+        observer.notify_cancelled(deployment1)
+        deployment2 = observer.add_deployment()
+        self.assertEqual([deployment2], observer.deployments.keys())
+
+
+class TestGetServices(unittest.TestCase):
+
+    def test_services(self):
+        # The service names included in the bundle are returned.
+        bundle = {'services': {'mysql': {}, 'wordpress': {}}}
+        services = utils.get_services(bundle)
+        self.assertEqual(frozenset(['mysql', 'wordpress']), services)
+
+    def test_no_services(self):
+        # None is returned if the bundle does not include services.
+        self.assertIsNone(utils.get_services({'foo': 'bar'}))
+        self.assertIsNone(utils.get_services('invalid'))
+
+    def test_inheritance(self):
+        # None is returned if the bundle inherits from other bundles.
+        bundle = {'inherits': 'base', 'services': {'mysql': {}}}
+        self.assertIsNone(utils.get_services(bundle))
+
+
+class TestServicesOverlap(unittest.TestCase):
+
+    def test_overlap(self):
+        # Sets sharing at least a service overlap.
+        self.assertTrue(utils.services_overlap(
+            frozenset(['mysql', 'wordpress']), frozenset(['mysql'])))
+
+    def test_no_overlap(self):
+        # Disjoint sets do not overlap.
+        self.assertFalse(utils.services_overlap(
+            frozenset(['mysql']), frozenset(['wordpress'])))
+
+    def test_unknown(self):
+        # Unknown services overlap with everything.
+        self.assertTrue(utils.services_overlap(None, frozenset()))
+        self.assertTrue(utils.services_overlap(frozenset(['mysql']), None))
+
+
+class TestDeploymentSlots(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestDeploymentSlots, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'store.db')
+        self.slots = utils.DeploymentSlots(self.path, 2, io_loop=self.io_loop)
+
+    def acquire_other(self, deployment_id, services, pid=None):
+        """Simulate a slot used by another GUI server process."""
+        if pid is None:
+            pid = os.getppid()
+        helpers.add_deployment_slot(self.path, pid, deployment_id, services)
+
+    def test_workers(self):
+        # Up to the given number of deployments are started by all the
+        # processes.
+        self.assertTrue(self.slots.acquire(1, frozenset(['mysql'])))
+        self.acquire_other(1, frozenset(['haproxy']))
+        self.assertFalse(self.slots.acquire(2, frozenset(['wordpress'])))
+        self.slots.release(1)
+        self.assertTrue(self.slots.acquire(2, frozenset(['wordpress'])))
+
+    def test_overlapping(self):
+        # Deployments including the same services are not started at the
+        # same time by different processes.
+        self.acquire_other(1, frozenset(['mysql']))
+        self.assertFalse(self.slots.acquire(
+            1, frozenset(['mysql', 'wordpress'])))
+        self.assertTrue(self.slots.acquire(2, frozenset(['wordpress'])))
+
+    def test_unknown_services(self):
+        # Deployments with unknown services wait for any other deployment.
+        self.acquire_other(1, None)
+        self.assertFalse(self.slots.acquire(1, frozenset(['mysql'])))
+
+    def test_dead_process(self):
+        # Deployments of processes no longer running are ignored.
+        self.acquire_other(1, None, pid=424242)
+        with mock.patch('os.kill', mock.Mock(side_effect=OSError(3, ''))):
+            self.assertTrue(self.slots.acquire(1, frozenset(['mysql'])))
+        rows = self.slots._connect().execute(
+            'SELECT pid FROM deployments').fetchall()
+        self.assertEqual([(os.getpid(),)], rows)
+
+    def lock_database(self):
+        """Lock the database as if another process were writing to it.
+
+        Return the connection holding the lock.
+        """
+        self.slots._connect()
+        connection = open_database(self.path)
+        self.addCleanup(connection.close)
+        connection.execute('BEGIN IMMEDIATE')
+        return connection
+
+    def test_locked(self):
+        # Deployments are not started, without waiting, while the database is
+        # locked by another process.
+        connection = self.lock_database()
+        self.assertFalse(self.slots.acquire(1, frozenset(['mysql'])))
+        connection.execute('COMMIT')
+        self.assertTrue(self.slots.acquire(1, frozenset(['mysql'])))
+
+    @gen_test
+    def test_release_locked(self):
+        # Workers are released once the database is no longer locked.
+        self.assertTrue(self.slots.acquire(1, frozenset(['mysql'])))
+        connection = self.lock_database()
+        future = self.slots.release(1)
+        self.assertFalse(future.done())
+        self.io_loop.add_timeout(
+            self.io_loop.time() + 0.05, lambda: connection.execute('COMMIT'))
+        yield future
+        rows = self.slots._connect().execute(
+            'SELECT pid FROM deployments').fetchall()
+        self.assertEqual([], rows)
+
+
+class TestValidateBundle(unittest.TestCase):
+
+    apiurl = 'wss://api.example.com:17070'
+    bundle = {'services': {'wordpress': {}}}
+
+    def setUp(self):
+        # Mock the juju-deployer environment and clear the connections cache.
+        patcher = mock.patch('guiserver.bundles.utils.GUIEnvironment')
+        self.mock_environment = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.env = self.mock_environment.return_value
+        self.env.status.return_value = {'services': {'mysql': {}}}
+        self.addCleanup(utils._environments.clear)
+
+    def test_valid(self):
+        # No errors are raised if the bundle is valid.
+        utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        self.mock_environment.assert_called_once_with(self.apiurl, 'passwd')
+        self.env.connect.assert_called_once_with()
+        self.assertFalse(self.env.close.called)
+
+    def test_invalid(self):
+        # A ValueError is raised if the bundle is not valid.
+        bundle = {'services': {'mysql': {}}}
+        with self.assertRaises(ValueError) as context_manager:
+            utils.validate_bundle(self.apiurl, 'passwd', bundle)
+        self.assertEqual(
+            'service(s) already in the environment: mysql',
+            str(context_manager.exception))
+        # The connection is still reused.
+        utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        self.assertEqual(1, self.mock_environment.call_count)
+
+    def test_connection_reused(self):
+        # The API connection is reused by subsequent validations.
+        utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        self.assertEqual(1, self.mock_environment.call_count)
+        self.assertEqual(1, self.env.connect.call_count)
+
+    def test_connection_per_credentials(self):
+        # Different credentials use different connections.
+        utils.validate_bundle(self.apiurl, 'passwd1', self.bundle)
+        utils.validate_bundle(self.apiurl, 'passwd2', self.bundle)
+        self.assertEqual(2, self.mock_environment.call_count)
+
+    def test_status_cached(self):
+        # The environment status is cached for a short time.
+        with mock.patch('time.time', mock.Mock(return_value=1000)):
+            utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        with mock.patch('time.time', mock.Mock(return_value=1009)):
+            utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        self.assertEqual(1, self.env.status.call_count)
+        with mock.patch('time.time', mock.Mock(return_value=1010)):
+            utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        self.assertEqual(2, self.env.status.call_count)
+
+    def test_stale_connection(self):
+        # A failing cached connection is replaced by a new one.
+        with mock.patch('time.time', mock.Mock(return_value=1000)):
+            utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        self.env.status.side_effect = [
+            EnvError({'Error': 'connection lost'}),
+            {'services': {}},
+        ]
+        with mock.patch('time.time', mock.Mock(return_value=2000)):
+            utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        self.assertEqual(2, self.mock_environment.call_count)
+        self.env.close.assert_called_once_with()
+
+    def test_connection_error(self):
+        # Errors connecting to a new environment are propagated.
+        self.env.connect.side_effect = EnvError({'Error': 'bad wolf'})
+        with self.assertRaises(EnvError):
+            utils.validate_bundle(self.apiurl, 'passwd', self.bundle)
+        self.assertEqual({}, utils._environments)
+
+    def test_max_connections(self):
+        # The least recently used connections are closed.
+        with mock.patch('guiserver.bundles.utils.VALIDATION_CONNECTIONS', 2):
+            for password in ('passwd1', 'passwd2', 'passwd1', 'passwd3'):
+                utils.validate_bundle(self.apiurl, password, self.bundle)
+        self.assertEqual(
+            [(self.apiurl, 'passwd1'), (self.apiurl, 'passwd3')],
+            utils._environments.keys())
+        self.env.close.assert_called_once_with()
+
+
 class TestPrepareConstraints(unittest.TestCase):
 
     def test_valid_constraints(self):
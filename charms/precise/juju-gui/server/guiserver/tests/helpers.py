@@ -28,6 +28,7 @@ from tornado import websocket
 
 from guiserver import auth
 from guiserver.bundles import base
+from guiserver.bundles.utils import DeploymentSlots
 
 
 class EchoWebSocketHandler(websocket.WebSocketHandler):
@@ -100,8 +101,7 @@ class GoAPITestMixin(object):
                                  token='DEFACED', username=None,
                                  password=None):
         if username is not None and password is not None:
-            tokens._data[token] = dict(
-                username=username, password=password, handle="handle")
+            tokens._add_token(token, username, password)
         return dict(
             RequestId=request_id, Type='GUIToken', Request='Login',
             Params={'Token': token})
@@ -150,9 +150,10 @@ class BundlesTestMixin(object):
 
     apiurl = 'wss://api.example.com:17070'
 
-    def make_deployer(self, apiversion=base.SUPPORTED_API_VERSIONS[0]):
+    def make_deployer(
+            self, apiversion=base.SUPPORTED_API_VERSIONS[0], workers=1):
         """Create and return a Deployer instance."""
-        return base.Deployer(self.apiurl, apiversion)
+        return base.Deployer(self.apiurl, apiversion, workers=workers)
 
     def make_view_request(self, params=None, is_authenticated=True):
         """Create and return a mock request to be passed to bundle views.
@@ -206,7 +207,7 @@ class BundlesTestMixin(object):
     def patch_validate(self, side_effect=None):
         """Mock the blocking validate function."""
         mock_validate = MultiProcessMock(side_effect=side_effect)
-        validate_path = 'guiserver.bundles.base.blocking.validate'
+        validate_path = 'guiserver.bundles.utils.validate_bundle'
         return mock.patch(validate_path, mock_validate)
 
     def patch_import_bundle(self, side_effect=None):
@@ -216,6 +217,22 @@ class BundlesTestMixin(object):
         return mock.patch(import_bundle_path, mock_import_bundle)
 
 
+def add_deployment_slot(path, pid, deployment_id, services):
+    """Store a deployment started by the given GUI server process."""
+    connection = DeploymentSlots(path, 1)._connect()
+    if services is not None:
+        services = sorted(services)
+    connection.execute(
+        'INSERT INTO deployments VALUES (?, ?, ?)',
+        (pid, deployment_id, json.dumps(services)))
+
+
+def remove_deployment_slots(path, pid):
+    """Remove the deployments started by the given GUI server process."""
+    connection = DeploymentSlots(path, 1)._connect()
+    connection.execute('DELETE FROM deployments WHERE pid = ?', (pid,))
+
+
 class WSSTestMixin(object):
     """Add some helper methods for testing secure WebSocket handlers."""
 
@@ -25,6 +25,8 @@ from guiserver import (
     auth,
     handlers,
     manage,
+    metrics,
+    multiplex,
 )
 from guiserver.bundles import base
 
@@ -79,7 +81,10 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         options_dict = {
             'apiversion': 'go',
             'guiroot': '/my/guiroot/',
+            'multiplex': False,
+            'deployworkers': 1,
             'sandbox': False,
+            'tokenstore': None,
         }
         options_dict.update(kwargs)
         options = mock.Mock(**options_dict)
@@ -102,12 +107,66 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         deployer = self.assert_in_spec(spec, 'deployer')
         self.assertIsInstance(deployer, base.Deployer)
 
+    def test_deployer_workers(self):
+        # The deployer is set up with the given number of workers.
+        app = self.get_app(deployworkers=3)
+        spec = self.get_url_spec(app, r'^/ws$')
+        deployer = self.assert_in_spec(spec, 'deployer')
+        self.assertEqual(3, deployer._workers)
+
     def test_tokens(self):
         # The tokens instance is correctly passed to the WebSocket handler.
         app = self.get_app()
         spec = self.get_url_spec(app, r'^/ws$')
         tokens = self.assert_in_spec(spec, 'tokens')
         self.assertIsInstance(tokens, auth.AuthenticationTokenHandler)
+        self.assertNotIsInstance(tokens, auth.SharedAuthenticationTokenHandler)
+
+    def test_shared_tokens(self):
+        # A shared tokens instance is used if a token store is provided.
+        app = self.get_app(tokenstore='/tmp/tokens.db')
+        spec = self.get_url_spec(app, r'^/ws$')
+        tokens = self.assert_in_spec(spec, 'tokens')
+        self.assertIsInstance(tokens, auth.SharedAuthenticationTokenHandler)
+        self.assertEqual('/tmp/tokens.db', tokens._path)
+
+    def test_metrics(self):
+        # The same metrics instance is passed to the WebSocket handler, the
+        # deployer and the metrics handler.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws$')
+        server_metrics = self.assert_in_spec(spec, 'metrics')
+        self.assertIsInstance(server_metrics, metrics.Metrics)
+        deployer = self.assert_in_spec(spec, 'deployer')
+        self.assertIs(server_metrics, deployer._metrics)
+        spec = self.get_url_spec(app, r'^/gui-server-metrics$')
+        self.assertIs(server_metrics, self.assert_in_spec(spec, 'metrics'))
+        self.assertNotIn('process=', server_metrics.render())
+
+    def test_metrics_process(self):
+        # When running multiple processes, the metrics are labelled with the
+        # process number.
+        with mock.patch('tornado.process.task_id', mock.Mock(return_value=3)):
+            app = self.get_app()
+        spec = self.get_url_spec(app, r'^/gui-server-metrics$')
+        server_metrics = self.assert_in_spec(spec, 'metrics')
+        self.assertIn(
+            'guiserver_connections{process="3"} 0', server_metrics.render())
+
+    def test_multiplex(self):
+        # A connection pool is passed to the WebSocket handler if the Juju API
+        # connections are multiplexed.
+        app = self.get_app(apiurl='wss://example.com', multiplex=True)
+        spec = self.get_url_spec(app, r'^/ws$')
+        pool = self.assert_in_spec(spec, 'pool')
+        self.assertIsInstance(pool, multiplex.ConnectionPool)
+        self.assertEqual('wss://example.com', pool.apiurl)
+
+    def test_no_multiplex(self):
+        # By default each WebSocket handler connects to the Juju API.
+        app = self.get_app()
+        spec = self.get_url_spec(app, r'^/ws$')
+        self.assertNotIn('pool', spec.kwargs)
 
     def test_sandbox(self):
         # The WebSocket handler is excluded if sandbox mode is enabled.
@@ -119,6 +178,8 @@ class TestServer(AppsTestMixin, unittest.TestCase):
         # The Juju GUI static files are correctly served.
         app = self.get_app()
         spec = self.get_url_spec(app, r'^/juju-ui/(.*)$')
+        self.assertEqual(
+            handlers.CompressedStaticFileHandler, spec.handler_class)
         self.assert_in_spec(spec, 'path', value='/my/guiroot/juju-ui')
 
     def test_serving_gui_tests(self):
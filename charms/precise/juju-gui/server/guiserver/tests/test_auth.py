@@ -17,12 +17,25 @@
 """Tests for the Juju GUI server authentication management."""
 
 import datetime
+import os
+import shutil
+import stat
+import tempfile
+import time
 import unittest
 
 import mock
-from tornado.testing import LogTrapTestCase
-
-from guiserver import auth
+from tornado import gen
+from tornado.testing import (
+    AsyncTestCase,
+    LogTrapTestCase,
+    gen_test,
+)
+
+from guiserver import (
+    auth,
+    utils,
+)
 from guiserver.tests import helpers
 
 
@@ -62,7 +75,7 @@ class AuthMiddlewareTestMixin(object):
 
     def setUp(self):
         self.user = auth.User()
-        self.io_loop = mock.Mock()
+        self.io_loop = mock.Mock(**{'time.return_value': 1000})
         self.write_message = mock.Mock()
         self.tokens = auth.AuthenticationTokenHandler(io_loop=self.io_loop)
         self.auth = auth.AuthMiddleware(
@@ -321,15 +334,16 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
 
     def setUp(self):
         super(TestAuthenticationTokenHandler, self).setUp()
-        self.io_loop = mock.Mock()
+        self.io_loop = mock.Mock(**{'time.return_value': 1000})
         self.max_life = datetime.timedelta(minutes=1)
         self.tokens = auth.AuthenticationTokenHandler(
-            self.max_life, self.io_loop)
+            self.max_life, self.io_loop, max_tokens=3)
 
     def test_explicit_initialization(self):
         # The class accepted the explicit initialization.
         self.assertEqual(self.max_life, self.tokens._max_life)
         self.assertEqual(self.io_loop, self.tokens._io_loop)
+        self.assertEqual(3, self.tokens._max_tokens)
         self.assertEqual({}, self.tokens._data)
 
     @mock.patch('tornado.ioloop.IOLoop.current',
@@ -340,6 +354,7 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             datetime.timedelta(minutes=2), tokens._max_life)
         self.assertEqual('mockloop', tokens._io_loop)
+        self.assertEqual(auth.MAX_TOKENS, tokens._max_tokens)
 
     def test_token_requested(self):
         # It recognizes a token request.
@@ -382,17 +397,13 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         ))
         self.assertTrue('DEFACED' in self.tokens._data)
         self.assertEqual(
-            {'username', 'password', 'handle'},
-            set(self.tokens._data['DEFACED'].keys()))
-        self.assertEqual(
-            user.username, self.tokens._data['DEFACED']['username'])
-        self.assertEqual(
-            user.password, self.tokens._data['DEFACED']['password'])
-        self.assertEqual(
-            self.max_life, self.io_loop.add_timeout.call_args[0][0])
-        self.assertTrue('DEFACED' in self.tokens._data)
-        expire_token = self.io_loop.add_timeout.call_args[0][1]
-        expire_token()
+            {'username': user.username, 'password': user.password,
+             'expires': 1060},
+            self.tokens._data['DEFACED'])
+        self.io_loop.add_timeout.assert_called_once_with(
+            1060, self.tokens._sweep)
+        self.io_loop.time.return_value = 1060
+        self.tokens._sweep()
         self.assertFalse('DEFACED' in self.tokens._data)
 
     def test_unauthenticated_process_token_request(self):
@@ -436,7 +447,7 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         username = 'user-admin'
         password = 'ADMINSECRET'
         self.tokens._data['DEFACED'] = dict(
-            handle='handle marker', username=username, password=password)
+            expires=1060, username=username, password=password)
         request = dict(
             RequestId=42, Type='GUIToken', Request='Login',
             Params={'Token': 'DEFACED'})
@@ -444,7 +455,6 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             (username, password),
             self.tokens.process_authentication_request(request, write_message))
-        self.io_loop.remove_timeout.assert_called_once_with('handle marker')
         self.assertFalse(write_message.called)
         self.assertFalse('DEFACED' in self.tokens._data)
 
@@ -457,7 +467,6 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
         self.assertEqual(
             None,
             self.tokens.process_authentication_request(request, write_message))
-        self.assertFalse(self.io_loop.remove_timeout.called)
         write_message.assert_called_once_with(dict(
             RequestId=42,
             Error='unknown, fulfilled, or expired token',
@@ -483,6 +492,90 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
             (user.username, user.password),
             self.tokens.process_authentication_request(request, write_message))
 
+    def create_token(self, token):
+        """Create a token, returning the message sent to the client."""
+        user = auth.User('user-admin', 'ADMINSECRET', True)
+        write_message = mock.Mock()
+        request = dict(RequestId=42, Type='GUIToken', Request='Create')
+        with mock.patch('uuid.uuid4', mock.Mock(
+                return_value=mock.Mock(hex=token))):
+            self.tokens.process_token_request(request, user, write_message)
+        return write_message.call_args[0][0]
+
+    def test_single_timeout(self):
+        # A single timeout is scheduled for multiple tokens.
+        self.create_token('TOKEN1')
+        self.io_loop.time.return_value = 1010
+        self.create_token('TOKEN2')
+        self.io_loop.add_timeout.assert_called_once_with(
+            1060, self.tokens._sweep)
+
+    def test_sweep(self):
+        # Expired tokens are removed in batches, and the next sweep is
+        # scheduled for the first remaining token.
+        self.create_token('TOKEN1')
+        self.create_token('TOKEN2')
+        self.io_loop.time.return_value = 1030
+        self.create_token('TOKEN3')
+        self.io_loop.time.return_value = 1060
+        self.tokens._sweep()
+        self.assertEqual(['TOKEN3'], list(self.tokens._data))
+        self.io_loop.add_timeout.assert_called_with(1090, self.tokens._sweep)
+
+    def test_sweep_interval(self):
+        # Sweeps are not scheduled more often than the sweep interval.
+        self.create_token('TOKEN1')
+        self.io_loop.time.return_value = 1001
+        self.create_token('TOKEN2')
+        self.io_loop.time.return_value = 1060
+        self.tokens._sweep()
+        self.io_loop.add_timeout.assert_called_with(
+            1060 + auth.TOKENS_SWEEP_INTERVAL, self.tokens._sweep)
+
+    def test_sweep_empty(self):
+        # No sweeps are scheduled if there are no tokens left.
+        self.create_token('TOKEN1')
+        self.io_loop.time.return_value = 1060
+        self.tokens._sweep()
+        self.assertEqual({}, self.tokens._data)
+        self.assertEqual(1, self.io_loop.add_timeout.call_count)
+        # A new sweep is scheduled when a token is created.
+        self.create_token('TOKEN2')
+        self.io_loop.add_timeout.assert_called_with(1120, self.tokens._sweep)
+
+    def test_expired_not_swept(self):
+        # Expired tokens are rejected even if they have not been removed yet.
+        self.create_token('DEFACED')
+        self.io_loop.time.return_value = 1060
+        request = dict(
+            RequestId=43, Type='GUIToken', Request='Login',
+            Params={'Token': 'DEFACED'})
+        self.assertIsNone(
+            self.tokens.process_authentication_request(request, mock.Mock()))
+
+    def test_too_many_tokens(self):
+        # Tokens are not created if too many of them are outstanding.
+        for token in ('TOKEN1', 'TOKEN2', 'TOKEN3'):
+            self.create_token(token)
+        message = self.create_token('TOKEN4')
+        self.assertEqual(dict(
+            RequestId=42,
+            Error='too many outstanding tokens.',
+            ErrorCode='unauthorized access',
+            Response={}
+        ), message)
+        self.assertEqual(
+            ['TOKEN1', 'TOKEN2', 'TOKEN3'], list(self.tokens._data))
+
+    def test_too_many_tokens_expired(self):
+        # Expired tokens do not count against the maximum number of tokens.
+        for token in ('TOKEN1', 'TOKEN2', 'TOKEN3'):
+            self.create_token(token)
+        self.io_loop.time.return_value = 1060
+        message = self.create_token('TOKEN4')
+        self.assertEqual('TOKEN4', message['Response']['Token'])
+        self.assertEqual(['TOKEN4'], list(self.tokens._data))
+
     def test_process_authentication_response(self):
         # It translates a normal authentication success.
         user = auth.User('user-admin', 'ADMINSECRET', True)
@@ -491,3 +584,235 @@ class TestAuthenticationTokenHandler(LogTrapTestCase, unittest.TestCase):
             dict(RequestId=42,
                  Response=dict(AuthTag=user.username, Password=user.password)),
             self.tokens.process_authentication_response(response, user))
+
+
+class TestSharedAuthenticationTokenHandler(LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestSharedAuthenticationTokenHandler, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'tokens.db')
+        self.max_life = datetime.timedelta(minutes=1)
+        self.tokens = self.make_tokens()
+        self.user = auth.User('user-admin', 'ADMINSECRET', True)
+
+    def make_tokens(self):
+        """Create and return a shared tokens handler."""
+        return auth.SharedAuthenticationTokenHandler(
+            self.path, self.max_life, self.io_loop, max_tokens=2)
+
+    @gen.coroutine
+    def create_token(self, tokens):
+        """Create a token using the given handler. Return the token."""
+        write_message = mock.Mock()
+        request = dict(RequestId=42, Type='GUIToken', Request='Create')
+        yield tokens.process_token_request(request, self.user, write_message)
+        raise gen.Return(write_message.call_args[0][0]['Response']['Token'])
+
+    def login(self, tokens, token):
+        """Use the given token to log in.
+
+        Return a Future whose result is the credentials or None.
+        """
+        request = dict(
+            RequestId=43, Type='GUIToken', Request='Login',
+            Params={'Token': token})
+        return tokens.process_authentication_request(request, mock.Mock())
+
+    def lock_database(self):
+        """Lock the database as if another process were writing to it.
+
+        Return the connection holding the lock.
+        """
+        connection = utils.open_database(self.path)
+        self.addCleanup(connection.close)
+        connection.execute('BEGIN IMMEDIATE')
+        return connection
+
+    def unlock_later(self, connection):
+        """Release the lock held by the given connection on the IO loop."""
+        self.io_loop.add_timeout(
+            self.io_loop.time() + 0.05, lambda: connection.execute('COMMIT'))
+
+    @gen_test
+    def test_authentication(self):
+        # A token can be used to retrieve the user credentials.
+        token = yield self.create_token(self.tokens)
+        credentials = yield self.login(self.tokens, token)
+        self.assertEqual((self.user.username, self.user.password), credentials)
+
+    @gen_test
+    def test_shared(self):
+        # A token created by a handler can be used by another one sharing the
+        # same database, e.g. one living in another GUI server process.
+        token = yield self.create_token(self.tokens)
+        credentials = yield self.login(self.make_tokens(), token)
+        self.assertEqual((self.user.username, self.user.password), credentials)
+
+    @gen_test
+    def test_single_use(self):
+        # A token can only be used once.
+        token = yield self.create_token(self.tokens)
+        yield self.login(self.make_tokens(), token)
+        credentials = yield self.login(self.tokens, token)
+        self.assertIsNone(credentials)
+
+    @gen_test
+    def test_unknown(self):
+        # Unknown tokens are rejected.
+        credentials = yield self.login(self.tokens, 'DEFACED')
+        self.assertIsNone(credentials)
+
+    def patch_time(self, delta):
+        """Move the time seen by the tokens handler forward by delta."""
+        now = time.time() + delta.total_seconds()
+        return mock.patch(
+            'guiserver.auth.time', mock.Mock(**{'time.return_value': now}))
+
+    @gen_test
+    def test_expired(self):
+        # Expired tokens are rejected.
+        token = yield self.create_token(self.tokens)
+        with self.patch_time(datetime.timedelta(minutes=2)):
+            credentials = yield self.login(self.tokens, token)
+        self.assertIsNone(credentials)
+
+    def count_tokens(self):
+        """Return the number of tokens stored in the database."""
+        return self.tokens._connect().execute(
+            'SELECT COUNT(*) FROM tokens').fetchone()[0]
+
+    @gen_test
+    def test_expired_removed(self):
+        # Expired tokens, including the user credentials, are removed from the
+        # database when a token is stored.
+        yield self.create_token(self.tokens)
+        with self.patch_time(datetime.timedelta(minutes=2)):
+            yield self.create_token(self.tokens)
+            self.assertEqual(1, self.count_tokens())
+
+    @gen_test
+    def test_expired_removed_login(self):
+        # Expired tokens are removed from the database when a token is used.
+        yield self.create_token(self.tokens)
+        with self.patch_time(datetime.timedelta(minutes=2)):
+            yield self.login(self.tokens, 'DEFACED')
+        self.assertEqual(0, self.count_tokens())
+
+    @gen_test
+    def test_sweep_scheduled(self):
+        # Expired tokens are removed when they expire.
+        self.io_loop.add_timeout = mock.Mock()
+        yield self.create_token(self.tokens)
+        deadline, callback = self.io_loop.add_timeout.call_args[0]
+        self.assertAlmostEqual(self.io_loop.time() + 60, deadline, places=0)
+        self.assertEqual(self.tokens._sweep, callback)
+
+    @gen_test
+    def test_sweep(self):
+        # The sweep removes the expired tokens, and it is scheduled again
+        # while tokens are left.
+        yield self.create_token(self.tokens)
+        with self.patch_time(datetime.timedelta(seconds=30)):
+            yield self.create_token(self.make_tokens())
+        self.io_loop.add_timeout = mock.Mock()
+        with self.patch_time(datetime.timedelta(seconds=70)):
+            yield self.tokens._sweep()
+        self.assertEqual(1, self.count_tokens())
+        deadline = self.io_loop.add_timeout.call_args[0][0]
+        self.assertAlmostEqual(self.io_loop.time() + 20, deadline, places=0)
+
+    @gen_test
+    def test_sweep_empty(self):
+        # The sweep is not scheduled again if no tokens are left.
+        yield self.create_token(self.tokens)
+        self.io_loop.add_timeout = mock.Mock()
+        with self.patch_time(datetime.timedelta(minutes=2)):
+            yield self.tokens._sweep()
+        self.assertEqual(0, self.count_tokens())
+        self.assertFalse(self.io_loop.add_timeout.called)
+
+    def test_expires_index(self):
+        # Expired tokens are looked up using an index.
+        plan = self.tokens._connect().execute(
+            'EXPLAIN QUERY PLAN DELETE FROM tokens WHERE expires <= 0')
+        self.assertIn('tokens_expires', str(plan.fetchall()))
+
+    @gen_test
+    def test_limit_atomic(self):
+        # The tokens are counted and stored in the same transaction, so that
+        # concurrent processes cannot exceed the limit.
+        connection = mock.Mock(wraps=self.tokens._connect())
+        self.tokens._connection = connection
+        yield self.create_token(self.tokens)
+        statements = [i[0][0] for i in connection.execute.call_args_list]
+        self.assertEqual('BEGIN IMMEDIATE', statements[0])
+        self.assertTrue(statements[1].startswith('DELETE FROM tokens'))
+        self.assertEqual('SELECT COUNT(*) FROM tokens', statements[2])
+        self.assertTrue(statements[3].startswith('INSERT INTO tokens'))
+        self.assertEqual('COMMIT', statements[4])
+
+    @gen_test
+    def test_too_many_tokens(self):
+        # Tokens are not created if too many of them are outstanding, also
+        # taking into account the ones created by other handlers.
+        yield self.create_token(self.tokens)
+        yield self.create_token(self.make_tokens())
+        write_message = mock.Mock()
+        request = dict(RequestId=42, Type='GUIToken', Request='Create')
+        yield self.tokens.process_token_request(
+            request, self.user, write_message)
+        self.assertEqual(
+            'too many outstanding tokens.',
+            write_message.call_args[0][0]['Error'])
+
+    @gen_test
+    def test_locked_create(self):
+        # Tokens are stored without blocking while another process holds the
+        # database lock.
+        self.tokens._connect()
+        connection = self.lock_database()
+        write_message = mock.Mock()
+        request = dict(RequestId=42, Type='GUIToken', Request='Create')
+        future = self.tokens.process_token_request(
+            request, self.user, write_message)
+        self.assertFalse(future.done())
+        self.assertFalse(write_message.called)
+        self.unlock_later(connection)
+        yield future
+        self.assertIn('Token', write_message.call_args[0][0]['Response'])
+        self.assertEqual(1, self.count_tokens())
+
+    @gen_test
+    def test_locked_login(self):
+        # Tokens are retrieved without blocking while another process holds
+        # the database lock.
+        token = yield self.create_token(self.tokens)
+        connection = self.lock_database()
+        future = self.login(self.tokens, token)
+        self.assertFalse(future.done())
+        self.unlock_later(connection)
+        credentials = yield future
+        self.assertEqual((self.user.username, self.user.password), credentials)
+
+    @gen_test
+    def test_locked_timeout(self):
+        # Token requests fail if the database stays locked for too long.
+        self.tokens._connect()
+        self.lock_database()
+        write_message = mock.Mock()
+        request = dict(RequestId=42, Type='GUIToken', Request='Create')
+        with mock.patch('guiserver.utils.DATABASE_RETRY_TIMEOUT', 0.05):
+            yield self.tokens.process_token_request(
+                request, self.user, write_message)
+        self.assertEqual(
+            'too many outstanding tokens.',
+            write_message.call_args[0][0]['Error'])
+
+    @gen_test
+    def test_permissions(self):
+        # The database is only accessible by the current user.
+        yield self.create_token(self.tokens)
+        mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        self.assertEqual(0600, mode)
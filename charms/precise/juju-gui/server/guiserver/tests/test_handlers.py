@@ -17,10 +17,14 @@
 """Tests for the Juju GUI server handlers."""
 
 import datetime
+import gzip
 import json
 import os
+import logging
+import mimetypes
 import shutil
 import tempfile
+import unittest
 
 import mock
 from tornado import (
@@ -43,6 +47,9 @@ from guiserver import (
     get_version,
     handlers,
     manage,
+    metrics,
+    multiplex,
+    utils,
 )
 from guiserver.bundles import base
 from guiserver.tests import helpers
@@ -53,6 +60,8 @@ class WebSocketHandlerTestMixin(object):
 
     auth_backend = auth.get_backend(manage.DEFAULT_API_VERSION)
     hello_message = json.dumps({'hello': 'world'})
+    # Set to True to share the Juju API connections between handlers.
+    multiplex = False
 
     def get_app(self):
         # In test cases including this mixin a WebSocket server is created.
@@ -68,6 +77,7 @@ class WebSocketHandlerTestMixin(object):
         self.deployer = base.Deployer(
             self.apiurl, manage.DEFAULT_API_VERSION, io_loop=self.io_loop)
         self.tokens = auth.AuthenticationTokenHandler(io_loop=self.io_loop)
+        self.metrics = metrics.Metrics()
         echo_options = {
             'close_future': self.api_close_future,
             'io_loop': self.io_loop,
@@ -77,8 +87,13 @@ class WebSocketHandlerTestMixin(object):
             'auth_backend': self.auth_backend,
             'deployer': self.deployer,
             'io_loop': self.io_loop,
+            'metrics': self.metrics,
             'tokens': self.tokens,
         }
+        if self.multiplex:
+            self.pool = multiplex.ConnectionPool(
+                self.apiurl, io_loop=self.io_loop)
+            ws_options['pool'] = self.pool
         return web.Application([
             (r'/echo', helpers.EchoWebSocketHandler, echo_options),
             (r'/ws', handlers.WebSocketHandler, ws_options),
@@ -110,9 +125,10 @@ class WebSocketHandlerTestMixin(object):
             apiurl = self.apiurl
         handler = self.make_handler(
             headers=headers, mock_protocol=mock_protocol)
+        pool = self.pool if self.multiplex else None
         yield handler.initialize(
             apiurl, self.auth_backend, self.deployer, self.tokens,
-            self.io_loop)
+            self.io_loop, pool=pool, metrics=self.metrics)
         raise gen.Return(handler)
 
 
@@ -224,6 +240,43 @@ class TestWebSocketHandlerProxy(
             handler.on_juju_message(self.hello_message)
             handler.write_message.assert_called_once_with(self.hello_message)
 
+    @gen_test
+    def test_authenticated_from_browser_to_juju(self):
+        # Once the user is authenticated, messages which are not deployment or
+        # token requests are forwarded without being decoded.
+        handler = yield self.make_initialized_handler()
+        handler.user.is_authenticated = True
+        handler.juju_connection = mock.Mock()
+        with mock.patch('guiserver.handlers.json_decode_dict') as mock_decode:
+            handler.on_message(self.hello_message)
+        self.assertFalse(mock_decode.called)
+        handler.juju_connection.write_message.assert_called_once_with(
+            self.hello_message)
+
+    @gen_test
+    def test_from_juju_to_browser_not_decoded(self):
+        # Messages from the remote server are not decoded if an authentication
+        # is not in progress.
+        handler = yield self.make_initialized_handler()
+        with mock.patch('guiserver.handlers.WebSocketHandler.write_message'):
+            with mock.patch(
+                    'guiserver.handlers.json_decode_dict') as mock_decode:
+                handler.on_juju_message(self.hello_message)
+            handler.write_message.assert_called_once_with(self.hello_message)
+        self.assertFalse(mock_decode.called)
+
+    @gen_test
+    def test_messages_not_encoded_without_debug(self):
+        # Proxied messages are only encoded for logging if debug is enabled.
+        handler = yield self.make_initialized_handler()
+        message = mock.MagicMock()
+        with mock.patch('guiserver.handlers.debug_enabled',
+                        mock.Mock(return_value=False)):
+            with mock.patch(
+                    'guiserver.handlers.WebSocketHandler.write_message'):
+                handler.on_juju_message(message)
+        self.assertFalse(message.encode.called)
+
     @gen_test
     def test_queued_messages(self):
         # Messages sent before the client connection is established are
@@ -380,10 +433,8 @@ class TestWebSocketHandlerAuthentication(
         # It supports authenticating with a token.
         request = self.make_token_login_request(
             self.tokens, username='user', password='passwd')
-        with mock.patch.object(self.io_loop,
-                               'remove_timeout') as mock_remove_timeout:
-            self.handler.on_message(json.dumps(request))
-            mock_remove_timeout.assert_called_once_with('handle')
+        self.handler.on_message(json.dumps(request))
+        self.assertNotIn('DEFACED', self.tokens._data)
         self.assertEqual(
             self.make_login_request(
                 request_id=42, username='user', password='passwd'),
@@ -400,10 +451,8 @@ class TestWebSocketHandlerAuthentication(
         # It correctly handles a token that will not authenticate.
         request = self.make_token_login_request(
             self.tokens, username='user', password='passwd')
-        with mock.patch.object(self.io_loop,
-                               'remove_timeout') as mock_remove_timeout:
-            self.handler.on_message(json.dumps(request))
-            mock_remove_timeout.assert_called_once_with('handle')
+        self.handler.on_message(json.dumps(request))
+        self.assertNotIn('DEFACED', self.tokens._data)
         self.send_login_response(False)
         message = self.handler.ws_connection.write_message.call_args[0][0]
         self.assertEqual(
@@ -421,6 +470,173 @@ class TestWebSocketHandlerAuthentication(
         self.assertFalse(self.handler.juju_connected)
         self.assertEqual(0, len(self.handler._juju_message_queue))
 
+    @gen_test
+    def test_shared_token_authentication(self):
+        # Tokens stored in a database locked by another process are used
+        # without blocking, once the lock is released.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'tokens.db')
+        tokens = auth.SharedAuthenticationTokenHandler(
+            path, io_loop=self.io_loop)
+        handler = self.make_handler(mock_protocol=True)
+        handler.initialize(
+            self.apiurl, self.auth_backend, self.deployer, tokens,
+            io_loop=self.io_loop)
+        request = self.make_token_login_request(
+            tokens, username='user', password='passwd')
+        connection = utils.open_database(path)
+        self.addCleanup(connection.close)
+        connection.execute('BEGIN IMMEDIATE')
+        handler.on_message(json.dumps(request))
+        self.assertEqual(0, len(handler._juju_message_queue))
+        self.assertFalse(handler.auth.in_progress())
+        connection.execute('COMMIT')
+        while not handler._juju_message_queue:
+            yield gen.Task(
+                self.io_loop.add_timeout, self.io_loop.time() + 0.01)
+        self.assertEqual(
+            self.make_login_request(
+                request_id=42, username='user', password='passwd'),
+            json.loads(handler._juju_message_queue[0]))
+        self.assertTrue(handler.auth.in_progress())
+
+
+class TestWebSocketHandlerMultiplex(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin,
+        helpers.GoAPITestMixin, LogTrapTestCase, AsyncHTTPSTestCase):
+
+    multiplex = True
+
+    @gen.coroutine
+    def make_logged_in_client(self):
+        """Return a WebSocket client logged in through the shared connection.
+        """
+        client = yield self.make_client()
+        client.write_message(self.make_login_request(encoded=True))
+        response = yield client.read_message()
+        # The echo server returns the login request sent by the shared
+        # connection, which is a successful response.
+        self.assertEqual(self.make_login_request(), json.loads(response))
+        raise gen.Return(client)
+
+    @gen_test
+    def test_login(self):
+        # The login response is returned with the original request id.
+        client = yield self.make_client()
+        client.write_message(self.make_login_request(encoded=True))
+        response = yield client.read_message()
+        data = json.loads(response)
+        self.assertEqual(42, data['RequestId'])
+        self.assertNotIn('Error', data)
+
+    @gen_test
+    def test_not_logged_in(self):
+        # Requests sent before logging in are rejected.
+        client = yield self.make_client()
+        client.write_message(json.dumps({'RequestId': 1, 'Type': 'Client'}))
+        response = yield client.read_message()
+        self.assertEqual(
+            multiplex.make_error(1, 'not logged in'), json.loads(response))
+
+    @gen_test
+    def test_proxy(self):
+        # Requests are sent through the shared connection, and responses are
+        # returned to the browser using the original request id.
+        client = yield self.make_logged_in_client()
+        client.write_message(json.dumps({'RequestId': 1, 'Type': 'Client'}))
+        response = yield client.read_message()
+        data = json.loads(response)
+        self.assertEqual(1, data['RequestId'])
+        self.assertEqual('Client', data['Type'])
+
+    @gen_test
+    def test_shared_connection(self):
+        # Browsers logged in with the same credentials share the connection.
+        yield self.make_logged_in_client()
+        yield self.make_logged_in_client()
+        self.assertEqual(1, len(self.pool._connections))
+        connection = self.pool._connections.values()[0]
+        self.assertEqual(2, len(connection.clients))
+
+    @gen_test
+    def test_connection_released(self):
+        # The shared connection is released when the browser disconnects.
+        handler = yield self.make_initialized_handler(mock_protocol=True)
+        connection = mock.Mock()
+        future = concurrent.Future()
+        future.set_result((connection, self.make_login_response()))
+        with mock.patch.object(self.pool, 'acquire', return_value=future):
+            yield handler._login_shared(self.make_login_request())
+        self.assertIs(connection, handler.shared_connection)
+        with mock.patch.object(self.pool, 'release') as mock_release:
+            handler.on_close()
+        mock_release.assert_called_once_with(connection, handler)
+        self.assertIsNone(handler.shared_connection)
+
+
+class TestWebSocketHandlerMetrics(
+        WebSocketHandlerTestMixin, helpers.WSSTestMixin, LogTrapTestCase,
+        AsyncHTTPSTestCase):
+
+    def get_histogram(self, name, **labels):
+        """Return the histogram with the given name and labels."""
+        return self.metrics.histogram(name, '', (), **labels)
+
+    @gen_test
+    def test_connections(self):
+        # Open connections are tracked by the metrics.
+        handler = yield self.make_initialized_handler()
+        self.assertEqual({handler}, self.metrics.connections)
+        self.assertEqual(1, handler.metrics_id)
+        handler.on_close()
+        self.assertEqual(set(), self.metrics.connections)
+
+    @gen_test
+    def test_connect_time(self):
+        # The time required to connect to the Juju API is recorded.
+        yield self.make_initialized_handler()
+        histogram = self.get_histogram('guiserver_juju_connect_seconds')
+        self.assertEqual(1, histogram.count)
+
+    @gen_test
+    def test_messages_received(self):
+        # Messages received from the browser are counted, and the time spent
+        # handling them is recorded.
+        handler = yield self.make_initialized_handler()
+        handler.juju_connection = mock.Mock()
+        handler.on_message(self.hello_message)
+        handler.on_message(self.hello_message)
+        self.assertEqual(2, handler.messages_received)
+        counter = self.metrics.counter('guiserver_messages_received_total', '')
+        self.assertEqual(2, counter.value)
+        histogram = self.get_histogram(
+            'guiserver_proxy_latency_seconds', source='client')
+        self.assertEqual(2, histogram.count)
+
+    @gen_test
+    def test_messages_sent(self):
+        # Messages sent to the browser are counted, and the time spent
+        # handling the ones coming from Juju is recorded.
+        handler = yield self.make_initialized_handler(mock_protocol=True)
+        handler.on_juju_message(self.hello_message)
+        handler.write_message(self.hello_message)
+        self.assertEqual(2, handler.messages_sent)
+        counter = self.metrics.counter('guiserver_messages_sent_total', '')
+        self.assertEqual(2, counter.value)
+        histogram = self.get_histogram(
+            'guiserver_proxy_latency_seconds', source='juju')
+        self.assertEqual(1, histogram.count)
+
+    @gen_test
+    def test_queue_length(self):
+        # The number of messages waiting for the Juju API connection is
+        # reported.
+        handler = yield self.make_initialized_handler()
+        handler.juju_connected = False
+        handler.on_message(self.hello_message)
+        self.assertEqual(1, handler.queue_length())
+
 
 class TestWebSocketHandlerBundles(
         WebSocketHandlerTestMixin, helpers.WSSTestMixin,
@@ -464,6 +680,159 @@ class TestWebSocketHandlerBundles(
         self.assertEqual(expected, json.loads(response))
 
 
+class TestIsIntercepted(unittest.TestCase):
+
+    def test_deployer(self):
+        # Deployment requests are intercepted.
+        message = json.dumps(
+            {'RequestId': 1, 'Type': 'Deployer', 'Request': 'Status'})
+        self.assertTrue(handlers.is_intercepted(message))
+
+    def test_token(self):
+        # Token requests are intercepted.
+        message = json.dumps(
+            {'RequestId': 1, 'Type': 'GUIToken', 'Request': 'Create'})
+        self.assertTrue(handlers.is_intercepted(message))
+
+    def test_other(self):
+        # Other messages are not intercepted.
+        message = json.dumps(
+            {'RequestId': 1, 'Type': 'Client', 'Request': 'WatchAll'})
+        self.assertFalse(handlers.is_intercepted(message))
+
+
+class TestDebugEnabled(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger()
+        self.addCleanup(logger.setLevel, logger.level)
+
+    def test_enabled(self):
+        logging.getLogger().setLevel(logging.DEBUG)
+        self.assertTrue(handlers.debug_enabled())
+
+    def test_disabled(self):
+        logging.getLogger().setLevel(logging.INFO)
+        self.assertFalse(handlers.debug_enabled())
+
+
+class TestCompressedStaticFileHandler(LogTrapTestCase, AsyncHTTPTestCase):
+
+    def setUp(self):
+        # Set up a static path with an asset and its compressed variant.
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.contents = 'console.log("We are the Borg!");'
+        self.compressed = self.make_file('app.js', self.contents)
+        super(TestCompressedStaticFileHandler, self).setUp()
+
+    def make_file(self, name, contents, compress=True):
+        """Create a file and, if requested, its gzip compressed variant.
+
+        Return the compressed contents.
+        """
+        path = os.path.join(self.path, name)
+        with open(path, 'w') as static_file:
+            static_file.write(contents)
+        if compress:
+            with gzip.open(path + '.gz', 'wb') as compressed_file:
+                compressed_file.write(contents)
+            with open(path + '.gz', 'rb') as compressed_file:
+                return compressed_file.read()
+
+    def get_app(self):
+        return web.Application([
+            (r'/(.*)', handlers.CompressedStaticFileHandler,
+             {'path': self.path}),
+        ])
+
+    def fetch_asset(self, path, gzip=False, **kwargs):
+        """Fetch the given asset, without decompressing the response."""
+        headers = kwargs.pop('headers', {})
+        if gzip:
+            headers['Accept-Encoding'] = 'gzip'
+        return self.fetch(path, headers=headers, use_gzip=False, **kwargs)
+
+    def test_compressed(self):
+        # The compressed variant is sent if the client accepts gzip.
+        response = self.fetch_asset('/app.js', gzip=True)
+        self.assertEqual(200, response.code)
+        self.assertEqual(self.compressed, response.body)
+        self.assertEqual('gzip', response.headers['Content-Encoding'])
+        # The content type is the one of the original file.
+        expected_type = mimetypes.guess_type('app.js')[0]
+        self.assertEqual(expected_type, response.headers['Content-Type'])
+        self.assertEqual('Accept-Encoding', response.headers['Vary'])
+
+    def test_not_compressed(self):
+        # The original file is sent if the client does not accept gzip.
+        response = self.fetch_asset('/app.js')
+        self.assertEqual(200, response.code)
+        self.assertEqual(self.contents, response.body)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual('Accept-Encoding', response.headers['Vary'])
+
+    def test_no_compressed_variant(self):
+        # The original file is sent if there is no compressed variant.
+        self.make_file('style.css', 'body {}', compress=False)
+        response = self.fetch_asset('/style.css', gzip=True)
+        self.assertEqual('body {}', response.body)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_stale_compressed_variant(self):
+        # Compressed variants older than the original file are ignored.
+        path = os.path.join(self.path, 'app.js')
+        stat_result = os.stat(path)
+        mtime = stat_result.st_mtime - 1
+        os.utime(path + '.gz', (stat_result.st_atime, mtime))
+        response = self.fetch_asset('/app.js', gzip=True)
+        self.assertEqual(self.contents, response.body)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_etag(self):
+        # Strong ETags are sent for both the original and compressed files.
+        etag = self.fetch_asset('/app.js').headers['Etag']
+        gzip_etag = self.fetch_asset('/app.js', gzip=True).headers['Etag']
+        self.assertTrue(etag.startswith('"'))
+        self.assertNotEqual(etag, gzip_etag)
+        response = self.fetch_asset(
+            '/app.js', headers={'If-None-Match': etag})
+        self.assertEqual(304, response.code)
+
+    def test_etag_changes(self):
+        # The ETag changes when the file changes.
+        etag = self.fetch_asset('/app.js').headers['Etag']
+        self.make_file('app.js', 'resistance is futile', compress=False)
+        self.assertNotEqual(etag, self.fetch_asset('/app.js').headers['Etag'])
+
+    def test_etag_replaced(self):
+        # Only the hash of the latest version of a file is kept.
+        self.fetch_asset('/app.js')
+        self.make_file('app.js', 'resistance is futile', compress=False)
+        self.fetch_asset('/app.js')
+        etags = handlers.CompressedStaticFileHandler._etags
+        path = os.path.join(self.path, 'app.js')
+        self.assertEqual(
+            [path], [key for key in etags if key.startswith(self.path)])
+        stat_result = os.stat(path)
+        self.assertEqual(
+            (stat_result.st_mtime, stat_result.st_size), etags[path][0])
+
+    def test_unversioned_cache(self):
+        # Unversioned assets are not cached for a long time.
+        response = self.fetch_asset('/app.js')
+        self.assertNotIn('Cache-Control', response.headers)
+
+    def test_versioned_cache(self):
+        # Versioned assets are cached for a long time.
+        self.make_file('app-0f3c9a1b.js', self.contents)
+        for path in ('/app-0f3c9a1b.js', '/app.js?v=42'):
+            response = self.fetch_asset(path)
+            self.assertEqual(
+                'public, max-age=315360000, immutable',
+                response.headers['Cache-Control'])
+
+
 class TestIndexHandler(LogTrapTestCase, AsyncHTTPTestCase):
 
     def setUp(self):
@@ -499,6 +868,29 @@ class TestIndexHandler(LogTrapTestCase, AsyncHTTPTestCase):
         # Requests including flags and queries are served by the index file.
         self.ensure_index('/:flag:/activated/?my=query')
 
+    def test_cache_headers(self):
+        # Browsers are asked to always revalidate the index.
+        response = self.fetch('/')
+        self.assertEqual('no-cache', response.headers['Cache-Control'])
+        response = self.fetch(
+            '/', headers={'If-None-Match': response.headers['Etag']})
+        self.assertEqual(304, response.code)
+
+    def test_in_memory(self):
+        # The index contents are kept in memory.
+        self.ensure_index('/')
+        with mock.patch('__builtin__.open') as mock_open:
+            self.ensure_index('/')
+        self.assertFalse(mock_open.called)
+
+    def test_changes(self):
+        # Changes to the index file are picked up.
+        self.ensure_index('/')
+        self.index_contents = 'Resistance is futile!'
+        with open(os.path.join(self.path, 'index.html'), 'w') as index_file:
+            index_file.write(self.index_contents)
+        self.ensure_index('/')
+
 
 class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
 
@@ -535,6 +927,26 @@ class TestInfoHandler(LogTrapTestCase, AsyncHTTPTestCase):
         self.assertEqual(expected, info)
 
 
+class TestMetricsHandler(LogTrapTestCase, AsyncHTTPTestCase):
+
+    def get_app(self):
+        self.metrics = metrics.Metrics()
+        options = {'metrics': self.metrics}
+        return web.Application([
+            (r'^/metrics', handlers.MetricsHandler, options)])
+
+    def test_metrics(self):
+        # The handler returns the metrics using the Prometheus text format.
+        self.metrics.counter('requests_total', 'Requests.').inc()
+        response = self.fetch('/metrics')
+        self.assertEqual(200, response.code)
+        self.assertEqual(
+            'text/plain; version=0.0.4; charset=utf-8',
+            response.headers['Content-Type'])
+        self.assertEqual(self.metrics.render(), response.body)
+        self.assertIn('requests_total 1\n', response.body)
+
+
 class TestHttpsRedirectHandler(LogTrapTestCase, AsyncHTTPTestCase):
 
     def get_app(self):
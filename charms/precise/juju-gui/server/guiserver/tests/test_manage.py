@@ -18,6 +18,11 @@
 
 from contextlib import contextmanager
 import logging
+import os
+import shutil
+import signal
+import stat
+import tempfile
 import unittest
 
 import mock
@@ -149,6 +154,7 @@ class TestRun(LogTrapTestCase, unittest.TestCase):
         options = {
             'apiversion': 'go',
             'guiroot': '/my/guiroot',
+            'processes': 1,
             'sslpath': '/my/sslpath',
         }
         options.update(kwargs)
@@ -181,3 +187,125 @@ class TestRun(LogTrapTestCase, unittest.TestCase):
         # The IO loop instance is started when the application is run.
         ioloop_start, _, _ = self.mock_and_run()
         ioloop_start.assert_called_once_with()
+
+
+class TestRunProcesses(LogTrapTestCase, unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.tokenstore = os.path.join(self.directory, 'tokens.db')
+
+    def mock_and_run(self, **kwargs):
+        """Run multiple processes after mocking the IO loop, forking, and the
+        options/apps.
+
+        Additional options can be specified using kwargs.
+        Return the mock options and the HTTPServer mock.
+        """
+        options = {
+            'apiversion': 'go',
+            'guiroot': '/my/guiroot',
+            'insecure': False,
+            'processes': 4,
+            'sslpath': '/my/sslpath',
+            'tokenstore': self.tokenstore,
+        }
+        options.update(kwargs)
+        mock_options = mock.Mock(**options)
+        self.sockets = {80: ['socket80'], 443: ['socket443']}
+        with \
+                mock.patch('guiserver.manage.IOLoop'), \
+                mock.patch('guiserver.manage.options', mock_options), \
+                mock.patch('guiserver.manage.redirector', self.redirector), \
+                mock.patch('guiserver.manage.server', self.server), \
+                mock.patch('guiserver.manage.netutil.bind_sockets',
+                           self.sockets.get), \
+                mock.patch('guiserver.manage.process.fork_processes',
+                           return_value=0) as self.fork_processes, \
+                mock.patch('guiserver.manage.atexit.register') as \
+                self.atexit_register, \
+                mock.patch('guiserver.manage.signal.signal') as self.signal, \
+                mock.patch('guiserver.manage.HTTPServer') as http_server:
+            manage.run()
+        return mock_options, http_server
+
+    def redirector(self):
+        return 'redirector'
+
+    def server(self):
+        return 'server'
+
+    def test_secure_mode(self):
+        # The server and redirector listen on the sockets bound before
+        # forking the processes.
+        _, http_server = self.mock_and_run()
+        self.fork_processes.assert_called_once_with(4)
+        expected_ssl_options = {
+            'certfile': '/my/sslpath/juju.crt',
+            'keyfile': '/my/sslpath/juju.key',
+        }
+        self.assertEqual([
+            mock.call('server', ssl_options=expected_ssl_options),
+            mock.call().add_sockets(['socket443']),
+            mock.call('redirector', ssl_options=None),
+            mock.call().add_sockets(['socket80']),
+        ], http_server.mock_calls)
+
+    def test_insecure_mode(self):
+        # Only the server is started in insecure mode.
+        _, http_server = self.mock_and_run(insecure=True)
+        self.assertEqual([
+            mock.call('server', ssl_options=None),
+            mock.call().add_sockets(['socket80']),
+        ], http_server.mock_calls)
+
+    def test_tokenstore(self):
+        # The provided tokens database is used.
+        options, _ = self.mock_and_run()
+        self.assertEqual(self.tokenstore, options.tokenstore)
+
+    def test_tokenstore_directory(self):
+        # The directory of the provided tokens database is created if missing.
+        tokenstore = os.path.join(self.directory, 'guiserver', 'tokens.db')
+        self.mock_and_run(tokenstore=tokenstore)
+        mode = os.stat(os.path.dirname(tokenstore)).st_mode
+        self.assertEqual(0700, stat.S_IMODE(mode))
+
+    def test_tokenstore_removed(self):
+        # The provided tokens database, which includes user credentials, is
+        # removed when the server starts and when it exits.
+        for path in (self.tokenstore, self.tokenstore + '-journal'):
+            open(path, 'w').close()
+        self.mock_and_run()
+        self.assertFalse(os.path.exists(self.tokenstore))
+        open(self.tokenstore, 'w').close()
+        cleanup = self.atexit_register.call_args[0][0]
+        cleanup()
+        self.assertFalse(os.path.exists(self.tokenstore))
+
+    def test_temporary_tokenstore(self):
+        # A temporary tokens database is created if not provided.
+        options, _ = self.mock_and_run(tokenstore=None)
+        directory, filename = os.path.split(options.tokenstore)
+        self.assertEqual('tokens.db', filename)
+        self.assertTrue(os.path.isdir(directory))
+        # The directory is removed when the server exits.
+        cleanup = self.atexit_register.call_args[0][0]
+        cleanup()
+        self.assertFalse(os.path.exists(directory))
+
+    def test_temporary_tokenstore_memory(self):
+        # The temporary tokens database is created in memory if possible.
+        with mock.patch('guiserver.manage.MEMORY_DIRS',
+                        ('/no/such/dir', self.directory)):
+            options, _ = self.mock_and_run(tokenstore=None)
+        directory = os.path.dirname(options.tokenstore)
+        self.assertEqual(self.directory, os.path.dirname(directory))
+
+    def test_sigterm(self):
+        # The exit handlers are run when the server is stopped.
+        self.mock_and_run()
+        self.signal.assert_called_once_with(signal.SIGTERM, manage._exit)
+        with self.assertRaises(SystemExit):
+            manage._exit(signal.SIGTERM, None)
@@ -0,0 +1,194 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2014 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server metrics."""
+
+import unittest
+
+import mock
+
+from guiserver import metrics
+
+
+class TestCounter(unittest.TestCase):
+
+    def test_inc(self):
+        # The counter is incremented by the given amount.
+        counter = metrics.Counter()
+        counter.inc()
+        counter.inc(41)
+        self.assertEqual(42, counter.value)
+
+    def test_samples(self):
+        # The counter produces a single sample.
+        counter = metrics.Counter()
+        counter.inc()
+        labels = (('direction', 'in'),)
+        self.assertEqual(
+            [('requests', labels, 1)], counter.samples('requests', labels))
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        # Values are counted in the bucket they belong to.
+        histogram = metrics.Histogram((1, 5, 10))
+        for value in (0.5, 1, 3, 7, 20):
+            histogram.observe(value)
+        self.assertEqual([2, 1, 1, 1], histogram.counts)
+        self.assertEqual(31.5, histogram.sum)
+        self.assertEqual(5, histogram.count)
+
+    def test_samples(self):
+        # Bucket samples are cumulative.
+        histogram = metrics.Histogram((1, 0.5))
+        for value in (0.1, 0.7, 2):
+            histogram.observe(value)
+        expected = [
+            ('latency_bucket', (('le', '0.5'),), 1),
+            ('latency_bucket', (('le', '1'),), 2),
+            ('latency_bucket', (('le', '+Inf'),), 3),
+            ('latency_sum', (), 2.8),
+            ('latency_count', (), 3),
+        ]
+        self.assertEqual(expected, histogram.samples('latency', ()))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = metrics.Metrics()
+
+    def make_connection(self, messages_received=0, messages_sent=0,
+                        queue_length=0):
+        """Create and return a mock connection added to the metrics."""
+        connection = mock.Mock(
+            messages_received=messages_received, messages_sent=messages_sent)
+        connection.queue_length.return_value = queue_length
+        connection.metrics_id = self.metrics.add_connection(connection)
+        return connection
+
+    def test_counter(self):
+        # Counters are created once for each set of labels.
+        counter = self.metrics.counter('requests', 'Requests.', method='GET')
+        self.assertIsInstance(counter, metrics.Counter)
+        self.assertIs(
+            counter, self.metrics.counter('requests', '', method='GET'))
+        self.assertIsNot(
+            counter, self.metrics.counter('requests', '', method='POST'))
+
+    def test_histogram(self):
+        # Histograms are created once for each set of labels.
+        histogram = self.metrics.histogram('latency', 'Latency.', (1, 2))
+        self.assertIsInstance(histogram, metrics.Histogram)
+        self.assertEqual((1, 2), histogram.buckets)
+        self.assertIs(histogram, self.metrics.histogram('latency', '', ()))
+
+    def test_kind_mismatch(self):
+        # A ValueError is raised if a metric is reused with another kind.
+        self.metrics.counter('requests', 'Requests.')
+        with self.assertRaises(ValueError) as context_manager:
+            self.metrics.histogram('requests', 'Requests.', (1, 2))
+        self.assertEqual(
+            'requests is a counter', str(context_manager.exception))
+
+    def test_connections(self):
+        # Connections are tracked, and identifiers are assigned to them.
+        connection1 = self.make_connection()
+        connection2 = self.make_connection()
+        self.assertEqual(1, connection1.metrics_id)
+        self.assertEqual(2, connection2.metrics_id)
+        self.assertEqual({connection1, connection2}, self.metrics.connections)
+        self.metrics.remove_connection(connection1)
+        self.assertEqual({connection2}, self.metrics.connections)
+        # Removing a connection twice is a no-op.
+        self.metrics.remove_connection(connection1)
+        self.assertEqual({connection2}, self.metrics.connections)
+
+    def test_render(self):
+        # The metrics are rendered using the Prometheus text format.
+        self.metrics.counter('requests_total', 'Requests.', method='GET').inc()
+        self.metrics.histogram('latency_seconds', 'Latency.', (1,)).observe(2)
+        self.metrics.gauge('queued', 'Queued jobs.', lambda: 3)
+        self.make_connection(messages_received=4, messages_sent=5,
+                             queue_length=6)
+        expected = '\n'.join([
+            '# HELP guiserver_connections_total WebSocket connections opened.',
+            '# TYPE guiserver_connections_total counter',
+            'guiserver_connections_total 1',
+            '# HELP guiserver_connections Open WebSocket connections.',
+            '# TYPE guiserver_connections gauge',
+            'guiserver_connections 1',
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{method="GET"} 1',
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="1"} 0',
+            'latency_seconds_bucket{le="+Inf"} 1',
+            'latency_seconds_sum 2',
+            'latency_seconds_count 1',
+            '# HELP queued Queued jobs.',
+            '# TYPE queued gauge',
+            'queued 3',
+            '# HELP guiserver_connection_messages_received_total Messages '
+            'received from the browser by open connections.',
+            '# TYPE guiserver_connection_messages_received_total counter',
+            'guiserver_connection_messages_received_total{connection="1"} 4',
+            '# HELP guiserver_connection_messages_sent_total Messages sent '
+            'to the browser by open connections.',
+            '# TYPE guiserver_connection_messages_sent_total counter',
+            'guiserver_connection_messages_sent_total{connection="1"} 5',
+            '# HELP guiserver_connection_queue_length Messages waiting for '
+            'the Juju API connection to be established.',
+            '# TYPE guiserver_connection_queue_length gauge',
+            'guiserver_connection_queue_length{connection="1"} 6',
+        ]) + '\n'
+        self.assertEqual(expected, self.metrics.render())
+
+    def test_render_connections_order(self):
+        # Connections are rendered in the order they were added.
+        for _ in range(10):
+            self.make_connection()
+        lines = [
+            line for line in self.metrics.render().splitlines()
+            if line.startswith('guiserver_connection_queue_length')]
+        expected = [
+            'guiserver_connection_queue_length{{connection="{}"}} 0'.format(i)
+            for i in range(1, 11)]
+        self.assertEqual(expected, lines)
+
+    def test_render_labels(self):
+        # The labels given to the metrics are added to all the samples.
+        server_metrics = metrics.Metrics(process=2)
+        server_metrics.counter('requests', 'Requests.', method='GET').inc()
+        server_metrics.histogram('latency', 'Latency.', (1,)).observe(0.5)
+        self.assertEqual(
+            ['guiserver_connections_total{process="2"} 0',
+             'guiserver_connections{process="2"} 0',
+             'requests{process="2",method="GET"} 1',
+             'latency_bucket{process="2",le="1"} 1',
+             'latency_bucket{process="2",le="+Inf"} 1',
+             'latency_sum{process="2"} 0.5',
+             'latency_count{process="2"} 1'],
+            [line for line in server_metrics.render().splitlines()
+             if not line.startswith('#')])
+
+    def test_render_escaped_labels(self):
+        # Label values are escaped.
+        self.metrics.counter('requests', 'Requests.', path='a"b\\c\nd').inc()
+        self.assertIn(
+            'requests{path="a\\"b\\\\c\\nd"} 1', self.metrics.render())
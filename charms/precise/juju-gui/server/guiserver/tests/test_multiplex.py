@@ -0,0 +1,413 @@
+# This file is part of the Juju GUI, which lets users view and manage Juju
+# environments within a graphical interface (https://launchpad.net/juju-gui).
+# Copyright (C) 2014 Canonical Ltd.
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Affero General Public License version 3, as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranties of MERCHANTABILITY,
+# SATISFACTORY QUALITY, or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the Juju GUI server shared Juju API connections."""
+
+import json
+
+import mock
+from tornado import (
+    concurrent,
+    gen,
+)
+from tornado.testing import (
+    AsyncTestCase,
+    gen_test,
+    LogTrapTestCase,
+)
+
+from guiserver import multiplex
+
+
+class FakeClient(object):
+    """A shared connection client storing the received responses."""
+
+    def __init__(self):
+        self.messages = []
+        self.closed = False
+
+    def on_shared_message(self, data):
+        self.messages.append(data)
+
+    def on_juju_close(self):
+        self.closed = True
+
+
+class FakeUpstream(object):
+    """A fake Juju API connection.
+
+    Login, WatchAll and AllWatcher requests are answered like the Juju API
+    server would do; AllWatcher.Next requests are answered when deltas are
+    pushed. Other requests are echoed back in the response.
+    """
+
+    def __init__(self, io_loop, login_error=None):
+        self.io_loop = io_loop
+        self.login_error = login_error
+        self.requests = []
+        self.closed = False
+        self.on_message = None
+        self._next_request_id = None
+
+    def respond(self, request_id, **kwargs):
+        message = json.dumps(dict(kwargs, RequestId=request_id))
+        self.io_loop.add_callback(self.on_message, message)
+
+    def write_message(self, message):
+        data = json.loads(message)
+        self.requests.append(data)
+        request_id = data['RequestId']
+        kind = (data.get('Type'), data.get('Request'))
+        if kind == ('Admin', 'Login'):
+            if self.login_error is None:
+                return self.respond(request_id, Response={})
+            return self.respond(
+                request_id, Error=self.login_error, Response={})
+        if kind == ('Client', 'WatchAll'):
+            return self.respond(request_id, Response={'AllWatcherId': '1'})
+        if kind == ('AllWatcher', 'Next'):
+            self._next_request_id = request_id
+            return
+        self.respond(request_id, Response={'Echo': data})
+
+    def push(self, deltas):
+        """Answer the pending AllWatcher.Next request with the given deltas."""
+        request_id, self._next_request_id = self._next_request_id, None
+        self.respond(request_id, Response={'Deltas': deltas})
+
+    def fail(self, error):
+        """Answer the pending AllWatcher.Next request with the given error."""
+        request_id, self._next_request_id = self._next_request_id, None
+        self.respond(request_id, Error=error, Response={})
+
+    def close(self):
+        self.closed = True
+        self.io_loop.add_callback(self.on_message, None)
+
+
+class SharedConnectionTestMixin(object):
+    """Set up a fake Juju API server for shared connections."""
+
+    login_error = None
+
+    def setUp(self):
+        super(SharedConnectionTestMixin, self).setUp()
+        self.upstreams = []
+        patcher = mock.patch(
+            'guiserver.multiplex.websocket_connect', self.websocket_connect)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def websocket_connect(self, io_loop, url, callback, headers=None):
+        upstream = FakeUpstream(self.io_loop, login_error=self.login_error)
+        upstream.on_message = callback
+        self.upstreams.append(upstream)
+        future = concurrent.Future()
+        future.set_result(upstream)
+        return future
+
+    @gen.coroutine
+    def wait_for(self, condition):
+        """Run the IO loop until the given condition is satisfied."""
+        for _ in range(100):
+            if condition():
+                raise gen.Return()
+            yield gen.Task(self.io_loop.add_callback)
+        self.fail('condition not satisfied')
+
+
+class TestSharedConnection(
+        SharedConnectionTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    @gen.coroutine
+    def make_connection(self, *clients):
+        """Create, connect and return a shared connection."""
+        connection = multiplex.SharedConnection(
+            'wss://api.example.com', ('user-admin', 'secret'),
+            io_loop=self.io_loop)
+        for client in clients:
+            connection.add_client(client)
+        yield connection.connect()
+        raise gen.Return(connection)
+
+    @gen_test
+    def test_login(self):
+        # The connection logs in using the credentials.
+        connection = yield self.make_connection()
+        self.assertEqual(
+            [{'RequestId': 1, 'Type': 'Admin', 'Request': 'Login',
+              'Params': {'AuthTag': 'user-admin', 'Password': 'secret'}}],
+            self.upstreams[0].requests)
+        self.assertEqual(
+            {'RequestId': 1, 'Response': {}}, connection.login_response)
+
+    @gen_test
+    def test_request_ids_rewritten(self):
+        # Requests from different clients are multiplexed and the responses
+        # are routed back to the clients using the original request ids.
+        client1, client2 = FakeClient(), FakeClient()
+        connection = yield self.make_connection(client1, client2)
+        connection.send(client1, {'RequestId': 1, 'Type': 'Client'})
+        connection.send(client2, {'RequestId': 1, 'Type': 'Client'})
+        yield self.wait_for(lambda: client1.messages and client2.messages)
+        upstream_ids = [
+            request['RequestId'] for request in self.upstreams[0].requests]
+        self.assertEqual([1, 2, 3], upstream_ids)
+        self.assertEqual(1, client1.messages[0]['RequestId'])
+        self.assertEqual(
+            2, client1.messages[0]['Response']['Echo']['RequestId'])
+        self.assertEqual(1, client2.messages[0]['RequestId'])
+        self.assertEqual(
+            3, client2.messages[0]['Response']['Echo']['RequestId'])
+
+    @gen_test
+    def test_login_handled_locally(self):
+        # Login requests are answered without contacting the Juju API.
+        client = FakeClient()
+        connection = yield self.make_connection(client)
+        connection.send(client, {
+            'RequestId': 42, 'Type': 'Admin', 'Request': 'Login',
+            'Params': {'AuthTag': 'user-admin', 'Password': 'secret'}})
+        self.assertEqual([{'RequestId': 42, 'Response': {}}], client.messages)
+        self.assertEqual(1, len(self.upstreams[0].requests))
+
+    @gen_test
+    def test_removed_client(self):
+        # Responses to requests sent by removed clients are discarded.
+        client = FakeClient()
+        connection = yield self.make_connection(client)
+        connection.send(client, {'RequestId': 1, 'Type': 'Client'})
+        connection.remove_client(client)
+        yield self.wait_for(lambda: not connection._pending)
+        self.assertEqual([], client.messages)
+
+    @gen.coroutine
+    def watch_all(self, connection, client, request_id=1):
+        """Start watching the environment on behalf of the given client."""
+        connection.send(client, {
+            'RequestId': request_id, 'Type': 'Client', 'Request': 'WatchAll'})
+        self.assertEqual(
+            {'RequestId': request_id,
+             'Response': {'AllWatcherId': multiplex.SHARED_WATCHER_ID}},
+            client.messages.pop())
+        yield self.wait_for(
+            lambda: self.upstreams[0]._next_request_id is not None)
+
+    def next(self, connection, client, request_id=2):
+        """Request the next deltas on behalf of the given client."""
+        connection.send(client, {
+            'RequestId': request_id, 'Type': 'AllWatcher', 'Request': 'Next',
+            'Id': multiplex.SHARED_WATCHER_ID})
+
+    @gen_test
+    def test_shared_all_watcher(self):
+        # A single upstream AllWatcher is used by all the clients.
+        client1, client2 = FakeClient(), FakeClient()
+        connection = yield self.make_connection(client1, client2)
+        yield self.watch_all(connection, client1)
+        yield self.watch_all(connection, client2)
+        self.next(connection, client1)
+        self.next(connection, client2)
+        self.upstreams[0].push([['service', 'change', {'Name': 'mysql'}]])
+        yield self.wait_for(lambda: client1.messages and client2.messages)
+        expected = {
+            'RequestId': 2,
+            'Response': {'Deltas': [['service', 'change', {'Name': 'mysql'}]]},
+        }
+        self.assertEqual([expected], client1.messages)
+        self.assertEqual([expected], client2.messages)
+        requests = [
+            request for request in self.upstreams[0].requests
+            if request['Request'] == 'WatchAll']
+        self.assertEqual(1, len(requests))
+
+    @gen.coroutine
+    def push(self, connection, deltas):
+        """Send deltas from the upstream AllWatcher and wait for them."""
+        changes = connection.environment.changes
+        before = len(changes._changes)
+        self.upstreams[0].push(deltas)
+        yield self.wait_for(lambda: len(changes._changes) > before)
+        yield self.wait_for(
+            lambda: self.upstreams[0]._next_request_id is not None)
+
+    @gen_test
+    def test_late_watcher(self):
+        # A client starting to watch later receives a snapshot of the
+        # environment, and then the following deltas.
+        client1, client2 = FakeClient(), FakeClient()
+        connection = yield self.make_connection(client1, client2)
+        yield self.watch_all(connection, client1)
+        yield self.push(connection, [
+            ['service', 'change', {'Name': 'mysql', 'Exposed': False}],
+            ['unit', 'change', {'Name': 'mysql/0'}],
+            ['unit', 'change', {'Name': 'mysql/1'}],
+        ])
+        yield self.push(connection, [
+            ['service', 'change', {'Name': 'mysql', 'Exposed': True}],
+            ['unit', 'remove', {'Name': 'mysql/1'}],
+        ])
+        yield self.watch_all(connection, client2)
+        self.next(connection, client2)
+        yield self.wait_for(lambda: client2.messages)
+        expected = [
+            ['service', 'change', {'Name': 'mysql', 'Exposed': True}],
+            ['unit', 'change', {'Name': 'mysql/0'}],
+        ]
+        self.assertEqual(expected, client2.messages[0]['Response']['Deltas'])
+        # Subsequent deltas are sent as they arrive.
+        self.next(connection, client2, request_id=3)
+        self.upstreams[0].push([['machine', 'change', {'Id': '1'}]])
+        yield self.wait_for(lambda: len(client2.messages) == 2)
+        self.assertEqual(
+            [['machine', 'change', {'Id': '1'}]],
+            client2.messages[1]['Response']['Deltas'])
+
+    @gen_test
+    def test_stop_watcher(self):
+        # Stopping the watcher fails the pending Next request.
+        client = FakeClient()
+        connection = yield self.make_connection(client)
+        yield self.watch_all(connection, client)
+        self.next(connection, client)
+        connection.send(client, {
+            'RequestId': 3, 'Type': 'AllWatcher', 'Request': 'Stop',
+            'Id': multiplex.SHARED_WATCHER_ID})
+        self.assertEqual(
+            [multiplex.make_error(2, 'watcher was stopped', ''),
+             {'RequestId': 3, 'Response': {}}],
+            client.messages)
+
+    @gen_test
+    def test_watcher_failure(self):
+        # When the upstream AllWatcher fails, clients get the error and the
+        # next WatchAll request starts a new upstream watcher.
+        client1, client2 = FakeClient(), FakeClient()
+        connection = yield self.make_connection(client1, client2)
+        yield self.watch_all(connection, client1)
+        yield self.watch_all(connection, client2)
+        self.next(connection, client1)
+        upstream = self.upstreams[0]
+        yield self.wait_for(lambda: upstream._next_request_id is not None)
+        upstream.fail('watcher was stopped')
+        yield self.wait_for(lambda: client1.messages)
+        self.assertEqual(
+            [multiplex.make_error(2, 'watcher was stopped', '')],
+            client1.messages)
+        self.assertFalse(connection._watching)
+        self.assertIsNone(connection._watcher_id)
+        # Clients not waiting for deltas get the error on their next request.
+        self.next(connection, client2)
+        self.assertEqual(
+            [multiplex.make_error(2, 'watcher was stopped', '')],
+            client2.messages)
+        # The upstream watcher is restarted.
+        yield self.watch_all(connection, client1, request_id=3)
+        self.next(connection, client1, request_id=4)
+        upstream.push([['service', 'change', {'Name': 'mysql'}]])
+        yield self.wait_for(lambda: len(client1.messages) == 2)
+        self.assertEqual(
+            [['service', 'change', {'Name': 'mysql'}]],
+            client1.messages[1]['Response']['Deltas'])
+        requests = [
+            request for request in upstream.requests
+            if request['Request'] == 'WatchAll']
+        self.assertEqual(2, len(requests))
+
+    @gen_test
+    def test_upstream_closed(self):
+        # Clients are notified when the upstream connection is terminated.
+        client = FakeClient()
+        connection = yield self.make_connection(client)
+        self.upstreams[0].close()
+        yield self.wait_for(lambda: connection.closed)
+        self.assertTrue(client.closed)
+        self.assertEqual(set(), connection.clients)
+
+
+class TestConnectionPool(
+        SharedConnectionTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    def setUp(self):
+        super(TestConnectionPool, self).setUp()
+        self.pool = multiplex.ConnectionPool(
+            'wss://api.example.com', io_loop=self.io_loop)
+
+    @gen_test
+    def test_acquire(self):
+        # A logged in connection is returned with the login response.
+        client = FakeClient()
+        connection, response = yield self.pool.acquire(
+            client, ('user-admin', 'secret'))
+        self.assertIsInstance(connection, multiplex.SharedConnection)
+        self.assertEqual({'RequestId': 1, 'Response': {}}, response)
+        self.assertEqual(set([client]), connection.clients)
+
+    @gen_test
+    def test_same_credentials(self):
+        # Clients using the same credentials share the same connection.
+        connection1, _ = yield self.pool.acquire(
+            FakeClient(), ('user-admin', 'secret'))
+        connection2, _ = yield self.pool.acquire(
+            FakeClient(), ('user-admin', 'secret'))
+        self.assertIs(connection1, connection2)
+        self.assertEqual(1, len(self.upstreams))
+
+    @gen_test
+    def test_different_credentials(self):
+        # Clients using different credentials use different connections.
+        connection1, _ = yield self.pool.acquire(
+            FakeClient(), ('user-admin', 'secret'))
+        connection2, _ = yield self.pool.acquire(
+            FakeClient(), ('user-admin', 'another secret'))
+        self.assertIsNot(connection1, connection2)
+        self.assertEqual(2, len(self.upstreams))
+
+    @gen_test
+    def test_release(self):
+        # The connection is closed when the last client releases it.
+        client1, client2 = FakeClient(), FakeClient()
+        connection, _ = yield self.pool.acquire(
+            client1, ('user-admin', 'secret'))
+        yield self.pool.acquire(client2, ('user-admin', 'secret'))
+        self.pool.release(connection, client1)
+        self.assertFalse(connection.closed)
+        self.pool.release(connection, client2)
+        self.assertTrue(connection.closed)
+        self.assertTrue(self.upstreams[0].closed)
+        # A new connection is created for subsequent clients.
+        new_connection, _ = yield self.pool.acquire(
+            FakeClient(), ('user-admin', 'secret'))
+        self.assertIsNot(connection, new_connection)
+
+
+class TestConnectionPoolLoginFailure(
+        SharedConnectionTestMixin, LogTrapTestCase, AsyncTestCase):
+
+    login_error = 'invalid entity name or password'
+
+    @gen_test
+    def test_login_failure(self):
+        # If the login fails the connection is closed and the error returned.
+        pool = multiplex.ConnectionPool(
+            'wss://api.example.com', io_loop=self.io_loop)
+        client = FakeClient()
+        connection, response = yield pool.acquire(
+            client, ('user-admin', 'wrong'))
+        self.assertIsNone(connection)
+        self.assertEqual(self.login_error, response['Error'])
+        self.assertTrue(self.upstreams[0].closed)
+        self.assertFalse(client.closed)
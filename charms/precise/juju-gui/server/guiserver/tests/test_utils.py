@@ -17,6 +17,11 @@
 """Tests for the Juju GUI server utilities."""
 
 import json
+import os
+import shutil
+import sqlite3
+import stat
+import tempfile
 import unittest
 
 import mock
@@ -33,6 +38,34 @@ from tornado.testing import (
 from guiserver import utils
 
 
+class TestAcceptsGzip(unittest.TestCase):
+
+    def assert_accepts(self, expected, header=None):
+        """Ensure the result of accepts_gzip given the Accept-Encoding header.
+        """
+        headers = {} if header is None else {'Accept-Encoding': header}
+        request = mock.Mock(headers=headers)
+        self.assertEqual(expected, utils.accepts_gzip(request))
+
+    def test_gzip(self):
+        # True is returned if the request accepts gzip encoded responses.
+        self.assert_accepts(True, 'gzip')
+        self.assert_accepts(True, 'deflate, gzip')
+        self.assert_accepts(True, 'x-gzip')
+
+    def test_quality(self):
+        # The quality value is taken into account.
+        self.assert_accepts(True, 'gzip;q=0.5, identity')
+        self.assert_accepts(False, 'gzip;q=0, identity')
+        self.assert_accepts(False, 'gzip;q=bad')
+
+    def test_not_accepted(self):
+        # False is returned if the request does not accept gzip.
+        self.assert_accepts(False)
+        self.assert_accepts(False, 'identity')
+        self.assert_accepts(False, 'deflate')
+
+
 class TestAddFuture(AsyncTestCase):
 
     def setUp(self):
@@ -87,6 +120,20 @@ class TestGetHeaders(unittest.TestCase):
         self.assertEqual({'Origin': 'https://server.example.com'}, headers)
 
 
+class TestIsLocked(unittest.TestCase):
+
+    def test_locked(self):
+        # Errors due to a locked database are recognized.
+        err = sqlite3.OperationalError('database is locked')
+        self.assertTrue(utils.is_locked(err))
+
+    def test_other_errors(self):
+        # Other database errors are not considered lock errors.
+        self.assertFalse(utils.is_locked(
+            sqlite3.OperationalError('no such table: tokens')))
+        self.assertFalse(utils.is_locked(ValueError('locked')))
+
+
 class TestJsonDecodeDict(unittest.TestCase):
 
     def test_valid(self):
@@ -110,6 +157,38 @@ class TestJsonDecodeDict(unittest.TestCase):
             self.assertIsNone(utils.json_decode_dict('"not-a-dict"'))
 
 
+class TestOpenDatabase(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'store.db')
+
+    def test_private(self):
+        # The database file is only accessible by the current user.
+        utils.open_database(self.path).close()
+        self.assertEqual(0600, stat.S_IMODE(os.stat(self.path).st_mode))
+
+    def test_autocommit(self):
+        # Changes are visible to other connections without committing.
+        connection = utils.open_database(self.path)
+        connection.execute('CREATE TABLE example (value INTEGER)')
+        connection.execute('INSERT INTO example VALUES (42)')
+        other = utils.open_database(self.path)
+        rows = other.execute('SELECT value FROM example').fetchall()
+        self.assertEqual([(42,)], rows)
+
+    def test_locked(self):
+        # Statements fail immediately if the database is locked by another
+        # connection.
+        connection = utils.open_database(self.path)
+        connection.execute('BEGIN IMMEDIATE')
+        other = utils.open_database(self.path)
+        with self.assertRaises(sqlite3.OperationalError) as context:
+            other.execute('BEGIN IMMEDIATE')
+        self.assertTrue(utils.is_locked(context.exception))
+
+
 class TestRequestSummary(unittest.TestCase):
 
     def test_summary(self):
@@ -119,6 +198,90 @@ class TestRequestSummary(unittest.TestCase):
         self.assertEqual('GET /path (127.0.0.1)', summary)
 
 
+class TestRetryLocked(AsyncTestCase):
+
+    def make_function(self, *results):
+        """Return a mock function returning or raising the given results."""
+        return mock.Mock(side_effect=results)
+
+    @gen_test
+    def test_result(self):
+        # The function result is returned.
+        function = self.make_function(42)
+        result = yield utils.retry_locked(self.io_loop, function, 'arg')
+        self.assertEqual(42, result)
+        function.assert_called_once_with('arg')
+
+    @gen_test
+    def test_retried(self):
+        # The function is called again while the database is locked.
+        locked = sqlite3.OperationalError('database is locked')
+        function = self.make_function(locked, locked, 42)
+        result = yield utils.retry_locked(self.io_loop, function)
+        self.assertEqual(42, result)
+        self.assertEqual(3, function.call_count)
+
+    @gen_test
+    def test_not_blocking(self):
+        # The IO loop is not blocked while waiting for the lock.
+        locked = sqlite3.OperationalError('database is locked')
+        function = self.make_function(locked, 42)
+        future = utils.retry_locked(self.io_loop, function)
+        self.assertFalse(future.done())
+        result = yield future
+        self.assertEqual(42, result)
+
+    @gen_test
+    def test_timeout(self):
+        # The lock error is raised if the database stays locked for too long.
+        function = mock.Mock(
+            side_effect=sqlite3.OperationalError('database is locked'))
+        with mock.patch('guiserver.utils.DATABASE_RETRY_TIMEOUT', 0.05):
+            with self.assertRaises(sqlite3.OperationalError):
+                yield utils.retry_locked(self.io_loop, function)
+        self.assertGreater(function.call_count, 1)
+
+    @gen_test
+    def test_other_errors(self):
+        # Other errors are raised without retrying.
+        function = self.make_function(sqlite3.OperationalError('bad'))
+        with self.assertRaises(sqlite3.OperationalError):
+            yield utils.retry_locked(self.io_loop, function)
+        self.assertEqual(1, function.call_count)
+
+
+class TestTransaction(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'store.db')
+        self.connection = utils.open_database(self.path)
+        self.connection.execute('CREATE TABLE example (value INTEGER)')
+
+    def get_values(self):
+        """Return the values stored in the example table."""
+        other = utils.open_database(self.path)
+        return other.execute('SELECT value FROM example').fetchall()
+
+    def test_commit(self):
+        # Changes are committed if the block succeeds.
+        with utils.transaction(self.connection) as connection:
+            connection.execute('INSERT INTO example VALUES (42)')
+        self.assertEqual([(42,)], self.get_values())
+
+    def test_rollback(self):
+        # Changes are rolled back if the block fails.
+        with self.assertRaises(ValueError):
+            with utils.transaction(self.connection) as connection:
+                connection.execute('INSERT INTO example VALUES (42)')
+                raise ValueError('bad wolf')
+        self.assertEqual([], self.get_values())
+        # The transaction is closed: a new one can be started.
+        with utils.transaction(self.connection):
+            pass
+
+
 class TestWrapWriteMessage(unittest.TestCase):
 
     expected_log = "discarding message \(closed connection\): 'hello'"
@@ -123,6 +123,105 @@ class TestAsyncWatcher(unittest.TestCase):
         self.assert_results(future1, [{'foo': 'bar'}])
         self.assert_results(future2, [{'foo': 'bar'}])
 
+    def test_skip(self):
+        # A listener can skip the changes already in the watcher.
+        self.watcher.put('change1')
+        self.watcher.skip('watcher1')
+        future = self.watcher.next('watcher1')
+        self.assertFalse(future.done())
+        self.watcher.put('change2')
+        self.assert_results(future, ['change2'])
+
+    def test_maxsize(self):
+        # A bounded watcher only retains the most recent changes.
+        watcher = watchers.AsyncWatcher(maxsize=2)
+        for change in ('change1', 'change2', 'change3'):
+            watcher.put(change)
+        future = watcher.next('watcher1')
+        self.assert_results(future, ['change2', 'change3'])
+
+    def test_maxsize_positions(self):
+        # Listeners only receive the retained changes they did not see.
+        watcher = watchers.AsyncWatcher(maxsize=2)
+        watcher.put('change1')
+        watcher.next('watcher1')
+        watcher.put('change2')
+        watcher.put('change3')
+        future = watcher.next('watcher1')
+        self.assert_results(future, ['change2', 'change3'])
+
+    def test_lagging(self):
+        # Listeners which missed dropped changes are lagging.
+        watcher = watchers.AsyncWatcher(maxsize=1)
+        watcher.put('change1')
+        watcher.next('watcher1')
+        self.assertFalse(watcher.lagging('watcher1'))
+        watcher.put('change2')
+        self.assertFalse(watcher.lagging('watcher1'))
+        watcher.put('change3')
+        self.assertTrue(watcher.lagging('watcher1'))
+        # Skipping changes resynchronizes the listener.
+        watcher.skip('watcher1')
+        self.assertFalse(watcher.lagging('watcher1'))
+
+    def test_not_lagging(self):
+        # Listeners of unbounded watchers are never lagging.
+        for change in range(10):
+            self.watcher.put(change)
+        self.assertFalse(self.watcher.lagging('watcher1'))
+
+    def test_compaction(self):
+        # Changes with the same key supersede older ones.
+        watcher = watchers.AsyncWatcher(key=lambda change: change[0])
+        watcher.put(('a', 1))
+        watcher.put(('b', 1))
+        watcher.put(('a', 2))
+        future = watcher.next('watcher1')
+        self.assert_results(future, [('b', 1), ('a', 2)])
+        self.assertEqual(('a', 2), watcher.getlast())
+
+    def test_compaction_positions(self):
+        # Slow listeners only receive the latest change for each key.
+        watcher = watchers.AsyncWatcher(key=lambda change: change[0])
+        watcher.put(('a', 1))
+        watcher.next('watcher1')
+        watcher.put(('a', 2))
+        watcher.put(('b', 1))
+        watcher.put(('a', 3))
+        future = watcher.next('watcher1')
+        self.assert_results(future, [('b', 1), ('a', 3)])
+        # Compacted changes are not dropped changes.
+        self.assertFalse(watcher.lagging('watcher1'))
+
+    def test_compaction_pending(self):
+        # Pending listeners are notified of every change.
+        watcher = watchers.AsyncWatcher(key=lambda change: change[0])
+        watcher.put(('a', 1))
+        watcher.next('watcher1')
+        future = watcher.next('watcher1')
+        watcher.put(('a', 2))
+        self.assert_results(future, [('a', 2)])
+
+    def test_discard(self):
+        # A discarded listener starts again from the first change.
+        self.watcher.put('change1')
+        self.watcher.next('watcher1')
+        self.watcher.discard('watcher1')
+        future = self.watcher.next('watcher1')
+        self.assert_results(future, ['change1'])
+
+    def test_discard_pending(self):
+        # The pending future of a discarded listener is not fired.
+        future = self.watcher.next('watcher1')
+        self.watcher.discard('watcher1')
+        self.watcher.put('change1')
+        self.assertFalse(future.done())
+
+    def test_discard_unknown(self):
+        # Discarding an unknown listener is a no-op.
+        self.watcher.discard('watcher1')
+        self.assertTrue(self.watcher.empty)
+
     def test_getlast(self):
         # It is possible to retrieve the last change from the watcher.
         self.watcher.put('change1')
@@ -191,3 +290,111 @@ class TestAsyncWatcher(unittest.TestCase):
         # The first listener is not affected by the error.
         self.watcher.put('change1')
         self.assert_results(future, ['change1'])
+
+
+class TestEntityId(unittest.TestCase):
+
+    def test_known_kinds(self):
+        # The identifier of known entities is correctly returned.
+        self.assertEqual(
+            'mysql', watchers.entity_id('service', {'Name': 'mysql'}))
+        self.assertEqual('0', watchers.entity_id('machine', {'Id': '0'}))
+        self.assertEqual(
+            'wordpress:db mysql:db',
+            watchers.entity_id('relation', {'Key': 'wordpress:db mysql:db'}))
+
+    def test_unknown_kind(self):
+        # The usual identifiers are used for unknown entities.
+        self.assertEqual('42', watchers.entity_id('new-kind', {'Id': '42'}))
+        self.assertIsNone(watchers.entity_id('new-kind', {}))
+
+
+class TestEnvironmentWatcher(unittest.TestCase):
+
+    def setUp(self):
+        # Set up an environment watcher.
+        self.watcher = watchers.EnvironmentWatcher()
+
+    def assert_results(self, future, expected):
+        """Ensure the future is done and it contains the expected results."""
+        self.assertTrue(future.done())
+        self.assertEqual(expected, future.result())
+
+    def test_not_ready(self):
+        # The watcher is not ready until deltas are received.
+        self.assertFalse(self.watcher.ready)
+        self.watcher.put([])
+        self.assertTrue(self.watcher.ready)
+
+    def test_state(self):
+        # Deltas are applied to the environment state.
+        self.watcher.put([
+            ['service', 'change', {'Name': 'mysql', 'Exposed': False}],
+            ['unit', 'change', {'Name': 'mysql/0'}],
+            ['unit', 'change', {'Name': 'mysql/1'}],
+        ])
+        self.watcher.put([
+            ['service', 'change', {'Name': 'mysql', 'Exposed': True}],
+            ['unit', 'remove', {'Name': 'mysql/0'}],
+        ])
+        expected = [
+            ['service', 'change', {'Name': 'mysql', 'Exposed': True}],
+            ['unit', 'change', {'Name': 'mysql/1'}],
+        ]
+        self.assertEqual(expected, self.watcher.snapshot())
+
+    def test_subscribe_before_ready(self):
+        # Listeners subscribing before deltas are received get all of them.
+        self.watcher.subscribe('watcher1')
+        future = self.watcher.next('watcher1')
+        self.assertFalse(future.done())
+        deltas = [['service', 'change', {'Name': 'mysql'}]]
+        self.watcher.put(deltas)
+        self.assert_results(future, [deltas])
+
+    def test_subscribe_snapshot(self):
+        # Listeners subscribing later first get a snapshot of the environment.
+        self.watcher.put([['service', 'change', {'Name': 'mysql'}]])
+        self.watcher.put([['service', 'change', {'Name': 'wordpress'}]])
+        self.watcher.subscribe('watcher1')
+        future = self.watcher.next('watcher1')
+        self.assert_results(future, [[
+            ['service', 'change', {'Name': 'mysql'}],
+            ['service', 'change', {'Name': 'wordpress'}],
+        ]])
+        # Subsequent requests return new deltas.
+        future = self.watcher.next('watcher1')
+        self.assertFalse(future.done())
+        deltas = [['unit', 'change', {'Name': 'mysql/0'}]]
+        self.watcher.put(deltas)
+        self.assert_results(future, [deltas])
+
+    def test_discard(self):
+        # A discarded listener is no longer waiting for the snapshot.
+        self.watcher.put([['service', 'change', {'Name': 'mysql'}]])
+        self.watcher.subscribe('watcher1')
+        self.watcher.discard('watcher1')
+        future = self.watcher.next('watcher1')
+        self.assert_results(
+            future, [[['service', 'change', {'Name': 'mysql'}]]])
+
+    def test_lagging_snapshot(self):
+        # Slow listeners receive a snapshot in place of the missed deltas.
+        watcher = watchers.EnvironmentWatcher(maxsize=2)
+        watcher.subscribe('watcher1')
+        watcher.put([['service', 'change', {'Name': 'mysql'}]])
+        watcher.next('watcher1')
+        watcher.put([['service', 'change', {'Name': 'wordpress'}]])
+        watcher.put([['unit', 'change', {'Name': 'mysql/0'}]])
+        watcher.put([['service', 'remove', {'Name': 'wordpress'}]])
+        future = watcher.next('watcher1')
+        self.assert_results(future, [[
+            ['service', 'change', {'Name': 'mysql'}],
+            ['unit', 'change', {'Name': 'mysql/0'}],
+        ]])
+        # Subsequent requests return new deltas.
+        future = watcher.next('watcher1')
+        self.assertFalse(future.done())
+        deltas = [['unit', 'change', {'Name': 'mysql/1'}]]
+        watcher.put(deltas)
+        self.assert_results(future, [deltas])
@@ -17,12 +17,42 @@
 """Juju GUI server utility functions and classes."""
 
 import collections
+from contextlib import contextmanager
 import functools
 import logging
+import os
+import sqlite3
 import urlparse
 import weakref
 
-from tornado import escape
+from tornado import (
+    escape,
+    gen,
+)
+
+
+# How often, in seconds, operations on a database locked by another GUI
+# server process are retried, and for how long.
+DATABASE_RETRY_INTERVAL = 0.02
+DATABASE_RETRY_TIMEOUT = 10
+
+
+def accepts_gzip(request):
+    """Return True if the given request accepts gzip encoded responses."""
+    header = request.headers.get('Accept-Encoding', '')
+    for coding in header.split(','):
+        parts = coding.split(';')
+        if parts[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
 
 
 def add_future(io_loop, future, callback, *args):
@@ -66,6 +96,68 @@ def json_decode_dict(message):
     return data
 
 
+def open_database(path):
+    """Return a connection to the SQLite database shared by the processes.
+
+    The database file is created if required, and only the current user can
+    read it. Statements are automatically committed: transactions must be
+    explicitly started when required, see transaction().
+
+    Statements do not wait for locks held by other processes, which would
+    block the IO loop: they fail instead, and can be retried later using
+    retry_locked().
+    """
+    os.close(os.open(path, os.O_CREAT | os.O_WRONLY, 0600))
+    return sqlite3.connect(path, timeout=0, isolation_level=None)
+
+
+@contextmanager
+def transaction(connection):
+    """Run the block in an immediate transaction on the given connection.
+
+    The transaction is committed if the block succeeds, and rolled back
+    otherwise, including when the commit fails.
+    """
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        yield connection
+        connection.execute('COMMIT')
+    except:
+        connection.execute('ROLLBACK')
+        raise
+
+
+def is_locked(err):
+    """Return True if the given error is due to a locked database."""
+    return (
+        isinstance(err, sqlite3.OperationalError) and
+        'locked' in str(err))
+
+
+@gen.coroutine
+def retry_locked(io_loop, function, *args):
+    """Call function with args, retrying while the database is locked.
+
+    Return a Future whose result is the value returned by the function.
+    While another process holds the database lock, the call is retried on
+    the IO loop every DATABASE_RETRY_INTERVAL seconds, for up to
+    DATABASE_RETRY_TIMEOUT seconds.
+    """
+    deadline = None
+    while True:
+        try:
+            raise gen.Return(function(*args))
+        except sqlite3.OperationalError as err:
+            if not is_locked(err):
+                raise
+            if deadline is None:
+                deadline = io_loop.time() + DATABASE_RETRY_TIMEOUT
+            elif io_loop.time() >= deadline:
+                raise
+        yield gen.Task(
+            io_loop.add_timeout, io_loop.time() + DATABASE_RETRY_INTERVAL)
+
+
 def request_summary(request):
     """Return a string representing a summary for the given request."""
     return '{} {} ({})'.format(request.method, request.uri, request.remote_ip)
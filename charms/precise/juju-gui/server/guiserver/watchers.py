@@ -16,6 +16,9 @@
 
 """Juju GUI server watchers."""
 
+import bisect
+from collections import OrderedDict
+
 from concurrent.futures import Future
 
 
@@ -53,16 +56,35 @@ class AsyncWatcher(object):
     A watcher can be closed with a final change by invoking its close() method.
     When a watcher is closed, it is no longer possible to put new changes in
     it, and subsequent listeners will receive only the closing change.
+
+    The watcher can be bounded passing the maximum number of changes to keep
+    (maxsize): when the limit is exceeded, the oldest changes are dropped, and
+    listeners which did not see them are considered lagging (see the lagging
+    method below). Superseded changes can also be compacted passing a key
+    function: when a change is put, an older change with the same key is
+    removed, so that slow listeners only receive the latest one, e.g.:
+
+        watcher = AsyncWatcher(key=operator.itemgetter('DeploymentId'))
     """
 
-    def __init__(self):
+    def __init__(self, maxsize=None, key=None):
         self.closed = False
+        self.maxsize = maxsize
+        self._key = key
         self._changes = []
+        # The _seqs attribute stores the sequence number of each change in
+        # self._changes. Sequence numbers increase by one for each put change.
+        self._seqs = []
+        # The sequence number of the next change.
+        self._seq = 0
+        # Changes with a sequence number lower than this one have been
+        # dropped because the watcher exceeded its maximum size.
+        self._dropped = 0
 
         # The _futures attribute maps watcher identifiers to pending Futures.
         self._futures = {}
-        # The _positions attribute maps watcher identifiers to the
-        # corresponding position in the changes list.
+        # The _positions attribute maps watcher identifiers to the sequence
+        # number of the next change to be sent to the corresponding listener.
         self._positions = {}
 
     def _fire_futures(self, changes):
@@ -70,9 +92,8 @@ class AsyncWatcher(object):
 
         Update the position for all involved listeners.
         """
-        position = len(self._changes)
         for watcher_id, future in self._futures.items():
-            self._positions[watcher_id] = position
+            self._positions[watcher_id] = self._seq
             future.set_result(changes)
         self._futures = {}
 
@@ -93,19 +114,43 @@ class AsyncWatcher(object):
         if self.closed:
             future.set_result(self._changes)
             return future
-        position = len(self._changes)
         watcher_position = self._positions.get(watcher_id, 0)
-        if watcher_position < position:
+        if watcher_position < self._seq:
             # There are already unseen changes to send.
-            missing_changes = self._changes[watcher_position:]
-            future.set_result(missing_changes)
-            self._positions[watcher_id] = position
+            index = bisect.bisect_left(self._seqs, watcher_position)
+            future.set_result(self._changes[index:])
+            self._positions[watcher_id] = self._seq
         else:
             # There are not unseen changes, the returned future will be
             # probably fired later.
             self._futures[watcher_id] = future
         return future
 
+    def lagging(self, watcher_id):
+        """Return True if the given listener missed dropped changes.
+
+        This happens when the watcher is bounded and the listener is too slow
+        in requesting changes. Lagging listeners should resynchronize, e.g.
+        by using skip() and retrieving the current state in some other way.
+        """
+        return self._positions.get(watcher_id, 0) < self._dropped
+
+    def skip(self, watcher_id):
+        """Mark all the changes currently in the watcher as seen.
+
+        The given watcher id will only receive changes put from now on.
+        """
+        self._positions[watcher_id] = self._seq
+
+    def discard(self, watcher_id):
+        """Forget the given watcher id.
+
+        A pending Future for the listener is discarded without being fired,
+        and a subsequent request for changes starts from the first change.
+        """
+        self._futures.pop(watcher_id, None)
+        self._positions.pop(watcher_id, None)
+
     def getlast(self):
         """Return the last notified change.
 
@@ -119,7 +164,22 @@ class AsyncWatcher(object):
         """Put a change into the watcher."""
         if self.closed:
             raise WatcherError('unable to put changes in a closed watcher')
+        if self._key is not None:
+            # Compact the changes superseded by this one.
+            key = self._key(change)
+            for index, existing in enumerate(self._changes):
+                if self._key(existing) == key:
+                    del self._changes[index]
+                    del self._seqs[index]
+                    break
         self._changes.append(change)
+        self._seqs.append(self._seq)
+        self._seq += 1
+        if self.maxsize is not None and len(self._changes) > self.maxsize:
+            excess = len(self._changes) - self.maxsize
+            self._dropped = self._seqs[excess - 1] + 1
+            del self._changes[:excess]
+            del self._seqs[:excess]
         self._fire_futures([change])
 
     def close(self, change):
@@ -128,5 +188,117 @@ class AsyncWatcher(object):
             raise WatcherError('the watcher is already closed')
         self.closed = True
         self._changes = [change]
+        self._seqs = [self._seq]
+        self._seq += 1
         self._fire_futures([change])
         self._positions = {}
+
+
+# The keys identifying Juju entities in AllWatcher deltas, by entity kind.
+ENTITY_KEYS = {
+    'annotation': 'Tag',
+    'machine': 'Id',
+    'relation': 'Key',
+    'service': 'Name',
+    'unit': 'Name',
+}
+
+
+# The maximum number of deltas lists retained by environment watchers.
+ENVIRONMENT_MAXSIZE = 1000
+
+
+def entity_id(kind, data):
+    """Return the identifier of the entity described by an AllWatcher delta.
+    """
+    key = ENTITY_KEYS.get(kind)
+    if key is None:
+        # Unknown entity kind: try the usual identifiers.
+        for key in ('Id', 'Name', 'Key', 'Tag'):
+            if key in data:
+                break
+    return data.get(key)
+
+
+class EnvironmentWatcher(object):
+    """A copy of the Juju environment state, built from AllWatcher deltas.
+
+    Deltas are lists of [kind, 'change' or 'remove', entity data] items, as
+    returned by the Juju API AllWatcher:
+
+        watcher = EnvironmentWatcher()
+        watcher.put([['service', 'change', {'Name': 'mysql'}]])
+
+    Besides keeping the current state of every entity, the watcher stores
+    the deltas in an AsyncWatcher. Listeners subscribe using a watcher id and
+    then request changes as they would do with an AsyncWatcher:
+
+        watcher.subscribe(42)
+        deltas_future = watcher.next(42)
+
+    The result of the returned future is a list of deltas. Listeners
+    subscribing when the environment state is already known first receive a
+    snapshot of it, as a single compacted list of deltas, and then the deltas
+    put after they subscribed.
+
+    At most maxsize deltas lists are retained: listeners too slow to keep up
+    with the environment changes receive a new snapshot instead of the deltas
+    they missed.
+    """
+
+    def __init__(self, maxsize=ENVIRONMENT_MAXSIZE):
+        self.changes = AsyncWatcher(maxsize=maxsize)
+        # The entities attribute maps (kind, id) tuples to entity data.
+        self.entities = OrderedDict()
+        # The listeners which did not yet receive the environment snapshot.
+        self._snapshots = set()
+
+    @property
+    def ready(self):
+        """Return True if the environment state is known, False otherwise."""
+        return not self.changes.empty
+
+    def put(self, deltas):
+        """Apply the given deltas to the environment and notify listeners."""
+        for kind, action, data in deltas:
+            key = (kind, entity_id(kind, data))
+            if action == 'remove':
+                self.entities.pop(key, None)
+            else:
+                self.entities[key] = data
+        self.changes.put(deltas)
+
+    def snapshot(self):
+        """Return the deltas describing the current environment state."""
+        return [
+            [kind, 'change', data]
+            for (kind, _), data in self.entities.items()]
+
+    def subscribe(self, watcher_id):
+        """Subscribe the given watcher id, starting from the current state."""
+        self.changes.discard(watcher_id)
+        self._snapshots.discard(watcher_id)
+        if self.ready:
+            self.changes.skip(watcher_id)
+            self._snapshots.add(watcher_id)
+
+    def next(self, watcher_id):
+        """Request changes for the given watcher id.
+
+        Return a Future whose result is a list of deltas lists.
+        """
+        if self.changes.lagging(watcher_id):
+            # Coalesce the missed deltas into a snapshot.
+            self.changes.skip(watcher_id)
+            self._snapshots.add(watcher_id)
+        if watcher_id in self._snapshots:
+            self._snapshots.remove(watcher_id)
+            future = Future()
+            future.set_result([self.snapshot()])
+            return future
+        return self.changes.next(watcher_id)
+
+    def discard(self, watcher_id):
+        """Forget the given watcher id."""
+        self.changes.discard(watcher_id)
+        self._snapshots.discard(watcher_id)
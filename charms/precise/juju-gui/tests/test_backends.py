@@ -202,6 +202,9 @@ class TestBackendCommands(unittest.TestCase):
         config = {
             'builtin-server': True,
             'builtin-server-logging': 'info',
+            'builtin-server-processes': 1,
+            'builtin-server-multiplex': False,
+            'builtin-server-deploy-workers': 1,
             'charmworld-url': 'http://charmworld.example.com/',
             'command-log-file': self.command_log_file,
             'default-viewmode': 'sidebar',
@@ -438,7 +441,10 @@ class TestBackendCommands(unittest.TestCase):
             mocks.compute_build_dir(), self.ssl_cert_path,
             config['serve-tests'], config['sandbox'],
             config['builtin-server-logging'], not config['secure'],
-            config['charmworld-url'])
+            config['charmworld-url'],
+            processes=config['builtin-server-processes'],
+            multiplex=config['builtin-server-multiplex'],
+            deploy_workers=config['builtin-server-deploy-workers'])
         self.assertFalse(mocks.start_haproxy_apache.called)
 
     def test_start_go_builtin(self):
@@ -457,7 +463,10 @@ class TestBackendCommands(unittest.TestCase):
             mocks.compute_build_dir(), self.ssl_cert_path,
             config['serve-tests'], config['sandbox'],
             config['builtin-server-logging'], not config['secure'],
-            config['charmworld-url'])
+            config['charmworld-url'],
+            processes=config['builtin-server-processes'],
+            multiplex=config['builtin-server-multiplex'],
+            deploy_workers=config['builtin-server-deploy-workers'])
         self.assertFalse(mocks.start_haproxy_apache.called)
 
     def test_stop_python_legacy(self):
@@ -504,6 +513,102 @@ class TestBackendCommands(unittest.TestCase):
         mocks.stop_builtin_server.assert_called_once_with()
         self.assertFalse(mocks.stop_haproxy_apache.called)
 
+    def update(self, prev_options, options):
+        """Update a juju-core backend, returning the mocks."""
+        prev_config = self.make_config(prev_options)
+        config = self.make_config(options)
+        with simulate_juju_core:
+            test_backend = backend.Backend(
+                config=config, prev_config=prev_config)
+            with self.mock_all() as mocks:
+                test_backend.update()
+        return mocks
+
+    def get_plan(self, prev_options, options):
+        """Return the planned steps as (name, mixin name) tuples."""
+        with simulate_juju_core:
+            prev_backend = backend.Backend(
+                config=self.make_config(prev_options))
+            test_backend = backend.Backend(
+                config=self.make_config(options),
+                prev_config=prev_backend.config)
+            steps = test_backend.plan(prev_backend)
+        return [(name, mixin.__class__.__name__) for name, mixin, _ in steps]
+
+    def test_no_changes(self):
+        # Nothing is done if the configuration did not change.
+        self.assertEqual([], self.get_plan({}, {}))
+
+    def test_gui_config(self):
+        # Only the GUI configuration file is written if a GUI option changes.
+        mocks = self.update(
+            {'juju-gui-console-enabled': False},
+            {'juju-gui-console-enabled': True})
+        self.assert_write_gui_config_called(
+            mocks, self.make_config({'juju-gui-console-enabled': True}))
+        self.assertFalse(mocks.stop_builtin_server.called)
+        self.assertFalse(mocks.start_builtin_server.called)
+        self.assertFalse(mocks.open_port.called)
+        self.assertFalse(mocks.install_missing_packages.called)
+
+    def test_server_restart(self):
+        # The server is restarted if one of its options changes.
+        mocks = self.update(
+            {'builtin-server-logging': 'info'},
+            {'builtin-server-logging': 'debug'})
+        mocks.stop_builtin_server.assert_called_once_with()
+        self.assertTrue(mocks.start_builtin_server.called)
+        self.assertFalse(mocks.install_builtin_server.called)
+        self.assertFalse(mocks.write_gui_config.called)
+
+    def test_gui_source(self):
+        # A new GUI release is installed and the builtin server is restarted.
+        self.assertEqual([
+            ('stop', 'BuiltinServerMixin'),
+            ('install', 'GuiMixin'),
+            ('write_config', 'GuiMixin'),
+            ('start', 'BuiltinServerMixin'),
+        ], self.get_plan(
+            {'juju-gui-source': 'stable'}, {'juju-gui-source': 'trunk'}))
+
+    def test_gui_source_legacy_server(self):
+        # Apache and haproxy are not restarted when the GUI release changes.
+        self.assertEqual([
+            ('install', 'GuiMixin'),
+            ('write_config', 'GuiMixin'),
+        ], self.get_plan(
+            {'builtin-server': False, 'juju-gui-source': 'stable'},
+            {'builtin-server': False, 'juju-gui-source': 'trunk'}))
+
+    def test_certificates(self):
+        # The certificates are saved and the server is restarted.
+        self.assertEqual([
+            ('stop', 'HaproxyApacheMixin'),
+            ('install', 'HaproxyApacheMixin'),
+            ('start', 'HaproxyApacheMixin'),
+        ], self.get_plan(
+            {'builtin-server': False, 'ssl-cert-contents': 'cert1'},
+            {'builtin-server': False, 'ssl-cert-contents': 'cert2'}))
+
+    def test_switch_server(self):
+        # Switching to the builtin server stops haproxy and Apache, and
+        # installs and starts the new server.
+        mocks = self.update(
+            {'builtin-server': False}, {'builtin-server': True})
+        mocks.stop_haproxy_apache.assert_called_once_with()
+        mocks.install_builtin_server.assert_called_once_with()
+        self.assertTrue(mocks.start_builtin_server.called)
+        self.assertFalse(mocks.write_gui_config.called)
+        mocks.install_missing_packages.assert_called_once_with(
+            set(EXPECTED_GO_BUILTIN_DEBS), repository=None)
+
+    def test_sandbox(self):
+        # Mixins are stopped in reverse order and started in order.
+        self.assertEqual([
+            ('stop', 'BuiltinServerMixin'),
+            ('write_config', 'GuiMixin'),
+            ('start', 'BuiltinServerMixin'),
+        ], self.get_plan({'sandbox': False}, {'sandbox': True}))
 
 class TestBackendUtils(unittest.TestCase):
 
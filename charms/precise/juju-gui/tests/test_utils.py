@@ -17,11 +17,14 @@
 """Juju GUI utils tests."""
 
 from contextlib import contextmanager
+import gzip
 import json
 import os
 import shutil
 from subprocess import CalledProcessError
+import tarfile
 import tempfile
+import time
 import unittest
 
 import charmhelpers
@@ -32,11 +35,13 @@ import yaml
 
 from utils import (
     API_PORT,
+    CACHE_TTL,
     JUJU_GUI_DIR,
     JUJU_PEM,
     WEB_PORT,
     _get_by_attr,
     cmd_log,
+    compress_static_files,
     compute_build_dir,
     download_release,
     fetch_gui_release,
@@ -54,8 +59,10 @@ from utils import (
     remove_apache_setup,
     remove_haproxy_setup,
     render_to_file,
+    resolve_launchpad_release,
     save_or_create_certificates,
     setup_apache_config,
+    setup_gui,
     setup_haproxy_config,
     start_agent,
     start_builtin_server,
@@ -96,23 +103,122 @@ class TestAttrDict(unittest.TestCase):
             AttrDict().myattr
 
 
-@mock.patch('utils.run')
-@mock.patch('utils.log')
+class CacheTestMixin(object):
+    """Set up a temporary local cache for the test."""
+
+    def setUp(self):
+        super(CacheTestMixin, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        patcher = mock.patch('utils.CACHE_DIR', self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+@mock.patch('utils.log', mock.Mock())
 @mock.patch('utils.cmd_log', mock.Mock())
-class TestDownloadRelease(unittest.TestCase):
-
-    def test_download(self, mock_log, mock_run):
-        # A release is properly downloaded using curl.
-        url = 'http://download.example.com/release.tgz'
-        filename = 'local-release.tgz'
-        destination = download_release(url, filename)
-        expected_destination = os.path.join(os.getcwd(), 'releases', filename)
+class TestDownloadRelease(CacheTestMixin, unittest.TestCase):
+
+    url = 'http://download.example.com/release.tgz'
+    filename = 'local-release.tgz'
+
+    def make_run(self, contents='release contents'):
+        """Return a mock run function simulating curl downloads."""
+        def run(*args):
+            path = args[args.index('-o') + 1]
+            with open(path, 'a' if '-C' in args else 'w') as f:
+                f.write(contents)
+        return mock.Mock(side_effect=run)
+
+    def get_partial_path(self):
+        """Return the path where the release is temporarily downloaded."""
+        name = utils.hashlib.sha256('download:' + self.url).hexdigest()
+        return os.path.join(self.cache_dir, 'partial', name)
+
+    def test_download(self):
+        # A release is properly downloaded using curl, and stored in the
+        # cache in a directory named after its SHA256 digest.
+        mock_run = self.make_run()
+        with mock.patch('utils.run', mock_run):
+            destination = download_release(self.url, self.filename)
+        digest = utils.hashlib.sha256('release contents').hexdigest()
+        expected_destination = os.path.join(
+            self.cache_dir, 'files', digest, self.filename)
         self.assertEqual(expected_destination, destination)
-        expected_log = 'Downloading release file: {} --> {}.'.format(
-            url, expected_destination)
-        mock_log.assert_called_once_with(expected_log)
+        with open(destination) as f:
+            self.assertEqual('release contents', f.read())
+        mock_run.assert_called_once_with(
+            'curl', '-L', '-f', '-o', self.get_partial_path(), self.url)
+
+    def test_cached(self):
+        # A release already in the cache is not downloaded again.
+        mock_run = self.make_run()
+        with mock.patch('utils.run', mock_run):
+            destination = download_release(self.url, self.filename)
+            self.assertEqual(
+                destination, download_release(self.url, self.filename))
+        self.assertEqual(1, mock_run.call_count)
+
+    def test_expired(self):
+        # A file cached more than ttl seconds ago is downloaded again.
+        mock_run = self.make_run()
+        with mock.patch('utils.run', mock_run):
+            with mock.patch('utils.time.time', mock.Mock(return_value=1000)):
+                download_release(self.url, self.filename, ttl=10)
+            with mock.patch('utils.time.time', mock.Mock(return_value=1005)):
+                download_release(self.url, self.filename, ttl=10)
+            self.assertEqual(1, mock_run.call_count)
+            with mock.patch('utils.time.time', mock.Mock(return_value=1010)):
+                download_release(self.url, self.filename, ttl=10)
+        self.assertEqual(2, mock_run.call_count)
+
+    def test_corrupted(self):
+        # A cached file not matching its digest is downloaded again.
+        with mock.patch('utils.run', self.make_run()):
+            destination = download_release(self.url, self.filename)
+        with open(destination, 'w') as f:
+            f.write('corrupted')
+        mock_run = self.make_run()
+        with mock.patch('utils.run', mock_run):
+            self.assertEqual(
+                destination, download_release(self.url, self.filename))
+        self.assertEqual(1, mock_run.call_count)
+        with open(destination) as f:
+            self.assertEqual('release contents', f.read())
+
+    def test_resume(self):
+        # Interrupted downloads are resumed.
+        partial = self.get_partial_path()
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'w') as f:
+            f.write('release ')
+        mock_run = self.make_run(contents='contents')
+        with mock.patch('utils.run', mock_run):
+            destination = download_release(self.url, self.filename)
+        with open(destination) as f:
+            self.assertEqual('release contents', f.read())
         mock_run.assert_called_once_with(
-            'curl', '-L', '-o', expected_destination, url)
+            'curl', '-L', '-f', '-C', '-', '-o', partial, self.url)
+
+    def test_resume_failure(self):
+        # The download starts over if it cannot be resumed.
+        partial = self.get_partial_path()
+        os.makedirs(os.path.dirname(partial))
+        with open(partial, 'w') as f:
+            f.write('garbage')
+        mock_run = self.make_run()
+        download = mock_run.side_effect
+
+        def run(*args):
+            if '-C' in args:
+                raise CalledProcessError(33, 'curl')
+            download(*args)
+        mock_run.side_effect = run
+        with mock.patch('utils.run', mock_run):
+            destination = download_release(self.url, self.filename)
+        with open(destination) as f:
+            self.assertEqual('release contents', f.read())
+        self.assertEqual(2, mock_run.call_count)
 
 
 @mock.patch('utils.log', mock.Mock())
@@ -130,23 +236,18 @@ class TestFetchGuiRelease(unittest.TestCase):
         Ensure all the functions are called correctly.
         """
         url = 'http://launchpad.example.com/' + source['filename'] + '/file'
-        patch_launchpad = mock.patch('utils.Launchpad')
-        patch_get_launchpad_release = mock.patch(
-            'utils.get_launchpad_release',
+        patch_resolve_launchpad_release = mock.patch(
+            'utils.resolve_launchpad_release',
             mock.Mock(return_value=(url, source['filename'])),
         )
         patch_download_release = mock.patch(
             'utils.download_release',
             mock.Mock(return_value=source['release_path']),
         )
-        with patch_launchpad as mock_launchpad:
-            with patch_get_launchpad_release as mock_get_launchpad_release:
-                with patch_download_release as mock_download_release:
-                    yield
-        login = mock_launchpad.login_anonymously
-        login.assert_called_once_with('Juju GUI charm', 'production')
-        mock_get_launchpad_release.assert_called_once_with(
-            login().projects['juju-gui'], origin, version)
+        with patch_resolve_launchpad_release as mock_resolve:
+            with patch_download_release as mock_download_release:
+                yield
+        mock_resolve.assert_called_once_with(origin, version)
         mock_download_release.assert_called_once_with(url, source['filename'])
 
     @mock.patch('utils.download_release')
@@ -158,7 +259,7 @@ class TestFetchGuiRelease(unittest.TestCase):
             path = fetch_gui_release('url', url)
             self.assertEqual(source['release_path'], path)
             mock_download_release.assert_called_once_with(
-                url, 'url-' + source['filename'])
+                url, 'url-' + source['filename'], ttl=CACHE_TTL)
             mock_download_release.reset_mock()
 
     @mock.patch('utils.get_release_file_path')
@@ -211,6 +312,191 @@ class TestFetchGuiRelease(unittest.TestCase):
             self.assertFalse(mock_get_release_file_path.called)
 
 
+@mock.patch('utils.log', mock.Mock())
+@mock.patch('utils.cmd_log', mock.Mock())
+class TestSetupGui(CacheTestMixin, unittest.TestCase):
+
+    def setUp(self):
+        super(TestSetupGui, self).setUp()
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.releases_dir = os.path.join(self.base_dir, 'releases')
+        self.juju_gui_dir = os.path.join(self.base_dir, 'juju-gui')
+        for name, value in (
+                ('BASE_DIR', self.base_dir),
+                ('JUJU_GUI_DIR', self.juju_gui_dir),
+                ('UNPACKED_RELEASES_DIR', self.releases_dir)):
+            patcher = mock.patch('utils.' + name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_tarball(self, version):
+        """Create and return the path of a release tarball."""
+        source_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, source_dir)
+        release_dir = os.path.join(source_dir, 'juju-gui-' + version)
+        os.mkdir(release_dir)
+        with open(os.path.join(release_dir, 'index.html'), 'w') as f:
+            f.write('<html>{}</html>'.format(version) * 100)
+        path = os.path.join(source_dir, 'juju-gui-{}.tgz'.format(version))
+        tarball = tarfile.open(path, 'w:gz')
+        tarball.add(release_dir, 'juju-gui-' + version)
+        tarball.close()
+        return path
+
+    def get_installed_version(self):
+        """Return the contents of the Juju GUI index."""
+        with open(os.path.join(self.juju_gui_dir, 'index.html')) as f:
+            return f.read()
+
+    def test_setup(self):
+        # The release is unpacked in a directory named after its digest, and
+        # the Juju GUI dir is linked to its contents.
+        tarball = self.make_tarball('1.0.0')
+        setup_gui(tarball)
+        digest = utils.sha256sum(tarball)
+        self.assertEqual(
+            os.path.join(self.releases_dir, digest, 'juju-gui-1.0.0'),
+            os.readlink(self.juju_gui_dir))
+        self.assertEqual('<html>1.0.0</html>' * 100,
+                         self.get_installed_version())
+        # Static files are precompressed.
+        self.assertTrue(
+            os.path.exists(os.path.join(self.juju_gui_dir, 'index.html.gz')))
+        # No temporary files are left around.
+        self.assertEqual([digest], os.listdir(self.releases_dir))
+        self.assertEqual(
+            ['juju-gui', 'releases'], sorted(os.listdir(self.base_dir)))
+
+    def test_same_release(self):
+        # Nothing is unpacked if the release is already installed.
+        tarball = self.make_tarball('1.0.0')
+        setup_gui(tarball)
+        with mock.patch('utils.command') as mock_command:
+            with mock.patch('utils.os.rename') as mock_rename:
+                setup_gui(tarball)
+        self.assertFalse(mock_command.called)
+        self.assertFalse(mock_rename.called)
+
+    def test_cached_tarball(self):
+        # The digest of files in the local cache is not computed again.
+        tarball = self.make_tarball('1.0.0')
+        digest_dir = os.path.join(self.cache_dir, 'files', 'mydigest')
+        os.makedirs(digest_dir)
+        cached = os.path.join(digest_dir, 'release.tgz')
+        shutil.copy(tarball, cached)
+        with mock.patch('utils.sha256sum') as mock_sha256sum:
+            setup_gui(cached)
+        self.assertFalse(mock_sha256sum.called)
+        self.assertEqual(['mydigest'], os.listdir(self.releases_dir))
+
+    def test_upgrade(self):
+        # The Juju GUI dir is switched to the new release, and previous ones
+        # can be reused.
+        tarball1 = self.make_tarball('1.0.0')
+        tarball2 = self.make_tarball('2.0.0')
+        setup_gui(tarball1)
+        setup_gui(tarball2)
+        self.assertEqual('<html>2.0.0</html>' * 100,
+                         self.get_installed_version())
+        with mock.patch('utils.command') as mock_command:
+            setup_gui(tarball1)
+        self.assertFalse(mock_command.called)
+        self.assertEqual('<html>1.0.0</html>' * 100,
+                         self.get_installed_version())
+
+    def test_garbage_collection(self):
+        # Only the most recently used releases are kept.
+        tarballs = [self.make_tarball(str(i)) for i in range(5)]
+        for num, tarball in enumerate(tarballs):
+            setup_gui(tarball)
+            # Ensure releases have different modification times.
+            release_dir = os.path.dirname(os.readlink(self.juju_gui_dir))
+            os.utime(release_dir, (num, num))
+        expected = sorted(utils.sha256sum(path) for path in tarballs[-3:])
+        self.assertEqual(expected, sorted(os.listdir(self.releases_dir)))
+        self.assertEqual('<html>4</html>' * 100, self.get_installed_version())
+
+    def test_unpacking_dirs(self):
+        # Temporary directories are only removed once expired, as another
+        # hook may still be unpacking a release in them.
+        os.mkdir(self.releases_dir)
+        unpacking = tempfile.mkdtemp(prefix='.unpack-', dir=self.releases_dir)
+        expired = tempfile.mkdtemp(prefix='.unpack-', dir=self.releases_dir)
+        past = time.time() - utils.UNPACK_EXPIRY - 1
+        os.utime(expired, (past, past))
+        tarball = self.make_tarball('1.0.0')
+        setup_gui(tarball)
+        self.assertEqual(
+            sorted([utils.sha256sum(tarball), os.path.basename(unpacking)]),
+            sorted(os.listdir(self.releases_dir)))
+
+    def test_legacy_release_dir(self):
+        # The release directory used by previous charm versions is removed.
+        legacy_dir = os.path.join(self.base_dir, 'release')
+        os.mkdir(legacy_dir)
+        setup_gui(self.make_tarball('1.0.0'))
+        self.assertFalse(os.path.exists(legacy_dir))
+
+    def test_unpack_failure(self):
+        # Partially unpacked releases are removed.
+        tarball = os.path.join(self.base_dir, 'bad.tgz')
+        with open(tarball, 'w') as f:
+            f.write('not a tarball')
+        with self.assertRaises(CalledProcessError):
+            setup_gui(tarball)
+        self.assertEqual([], os.listdir(self.releases_dir))
+        self.assertFalse(os.path.lexists(self.juju_gui_dir))
+
+
+class TestResolveLaunchpadRelease(CacheTestMixin, unittest.TestCase):
+
+    url = 'http://launchpad.example.com/release.tgz/file'
+
+    def call(self, series_name, release_version, now=1000):
+        """Call resolve_launchpad_release at the given time.
+
+        Return the result and the mock get_launchpad_release.
+        """
+        mock_launchpad = mock.MagicMock()
+        mock_get_launchpad_release = mock.Mock(
+            return_value=(self.url, 'release.tgz'))
+        with mock.patch('utils.get_launchpad_release',
+                        mock_get_launchpad_release):
+            with mock.patch('utils.time.time', mock.Mock(return_value=now)):
+                result = resolve_launchpad_release(
+                    series_name, release_version, Launchpad=mock_launchpad)
+        return result, mock_get_launchpad_release
+
+    def test_lookup(self):
+        # The release is looked up on Launchpad.
+        result, mock_get_launchpad_release = self.call('stable', '0.1.42')
+        self.assertEqual((self.url, 'release.tgz'), result)
+        mock_get_launchpad_release.assert_called_once_with(
+            mock.ANY, 'stable', '0.1.42')
+
+    def test_version_cached(self):
+        # Specific release versions are only looked up once.
+        self.call('stable', '0.1.42')
+        result, mock_get_launchpad_release = self.call(
+            'stable', '0.1.42', now=1000 + CACHE_TTL * 10)
+        self.assertEqual((self.url, 'release.tgz'), result)
+        self.assertFalse(mock_get_launchpad_release.called)
+        # Other versions are still looked up.
+        _, mock_get_launchpad_release = self.call('stable', '0.1.43')
+        self.assertTrue(mock_get_launchpad_release.called)
+
+    def test_latest_cached(self):
+        # The latest release is looked up again when the cache expires.
+        self.call('trunk', None)
+        _, mock_get_launchpad_release = self.call(
+            'trunk', None, now=1000 + CACHE_TTL - 1)
+        self.assertFalse(mock_get_launchpad_release.called)
+        _, mock_get_launchpad_release = self.call(
+            'trunk', None, now=1000 + CACHE_TTL)
+        self.assertTrue(mock_get_launchpad_release.called)
+
+
 class TestFirstPathInDir(unittest.TestCase):
 
     def setUp(self):
@@ -233,6 +519,72 @@ class TestFirstPathInDir(unittest.TestCase):
         self.assertRaises(IndexError, first_path_in_dir, self.directory)
 
 
+class TestCompressStaticFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.contents = 'juju gui ' * 1000
+
+    def make_file(self, name, contents=None):
+        """Create a file in the temporary directory, returning its path."""
+        path = os.path.join(self.directory, name)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(path, 'w') as f:
+            f.write(self.contents if contents is None else contents)
+        return path
+
+    def assert_compressed(self, path):
+        """Ensure the gzipped copy of the given path exists and is valid."""
+        with open(path) as f:
+            expected = f.read()
+        with gzip.open(path + '.gz') as f:
+            self.assertEqual(expected, f.read())
+
+    def test_compression(self):
+        # Static files are compressed, including the ones in subdirectories.
+        paths = [
+            self.make_file('index.html'),
+            self.make_file('juju-ui/app.js'),
+            self.make_file('juju-ui/assets/stack.css'),
+        ]
+        self.assertEqual(3, compress_static_files(self.directory))
+        for path in paths:
+            self.assert_compressed(path)
+
+    def test_not_compressible(self):
+        # Files with unknown extensions are not compressed.
+        path = self.make_file('juju-ui/assets/logo.png')
+        self.assertEqual(0, compress_static_files(self.directory))
+        self.assertFalse(os.path.exists(path + '.gz'))
+
+    def test_small_files(self):
+        # Files smaller than the given threshold are not compressed.
+        path = self.make_file('robots.txt', 'User-agent: *')
+        self.assertEqual(0, compress_static_files(self.directory))
+        self.assertFalse(os.path.exists(path + '.gz'))
+
+    def test_up_to_date(self):
+        # Files are not compressed again if their gzipped copy is up to date.
+        path = self.make_file('index.html')
+        compress_static_files(self.directory)
+        self.assertEqual(0, compress_static_files(self.directory))
+        self.assert_compressed(path)
+
+    def test_stale(self):
+        # Outdated gzipped copies are replaced.
+        path = self.make_file('index.html')
+        compress_static_files(self.directory)
+        self.contents = 'new contents ' * 1000
+        self.make_file('index.html')
+        mtime = os.path.getmtime(path + '.gz') + 10
+        os.utime(path, (mtime, mtime))
+        self.assertEqual(1, compress_static_files(self.directory))
+        self.assert_compressed(path)
+
+
 class TestGetApiAddress(unittest.TestCase):
 
     env_address = 'env.example.com:17070'
@@ -994,6 +1346,9 @@ class TestStartImprovAgentGui(unittest.TestCase):
             '--testsroot="{}/test/"'.format(JUJU_GUI_DIR), guiserver_conf)
         self.assertIn('--insecure', guiserver_conf)
         self.assertNotIn('--sandbox', guiserver_conf)
+        self.assertIn('--processes="1" --deployworkers="1"', guiserver_conf)
+        self.assertNotIn('--tokenstore', guiserver_conf)
+        self.assertNotIn('--multiplex', guiserver_conf)
         self.assertIn('--charmworldurl="http://charmworld.example.com/"',
                       guiserver_conf)
 
@@ -1011,6 +1366,26 @@ class TestStartImprovAgentGui(unittest.TestCase):
         self.assertNotIn('--apiurl', guiserver_conf)
         self.assertNotIn('--apiversion', guiserver_conf)
 
+    def test_write_builtin_server_startup_processes(self):
+        # The GUI server processes share a database.
+        with mock.patch('utils.legacy_juju', mock.Mock(return_value=False)):
+            with mock.patch('utils.get_api_address',
+                            mock.Mock(return_value='example.com:17070')):
+                write_builtin_server_startup(
+                    JUJU_GUI_DIR, self.ssl_cert_path, processes=0,
+                    multiplex=True, deploy_workers=4)
+        guiserver_conf = self.files['guiserver.conf']
+        self.assertIn('--processes="0" --deployworkers="4"', guiserver_conf)
+        self.assertIn(
+            '--tokenstore="{}"'.format(utils.GUISERVER_STORE), guiserver_conf)
+        self.assertIn('--multiplex', guiserver_conf)
+
+    def test_write_builtin_server_startup_multiplex_legacy(self):
+        # API connections are not shared with pyJuju.
+        write_builtin_server_startup(
+            JUJU_GUI_DIR, self.ssl_cert_path, multiplex=True)
+        self.assertNotIn('--multiplex', self.files['guiserver.conf'])
+
     def test_start_builtin_server(self):
         start_builtin_server(
             JUJU_GUI_DIR, self.ssl_cert_path, serve_tests=False, sandbox=False,
@@ -1219,7 +1594,7 @@ class TestInstallMissingPackages(unittest.TestCase):
         mock_log.assert_called_once_with('No missing deb packages.')
 
 
-class TestNpmCache(unittest.TestCase):
+class TestNpmCache(CacheTestMixin, unittest.TestCase):
     """To speed building from a branch we prepopulate the NPM cache."""
 
     def test_retrieving_cache_url(self):
@@ -153,6 +153,8 @@ class NeutronCCContext(context.NeutronContext):
 
 
 class IdentityServiceContext(context.IdentityServiceContext):
+    keys = context.IdentityServiceContext.keys + ['keystone_ec2_url']
+
     def __call__(self):
         ctxt = super(IdentityServiceContext, self).__call__()
         if not ctxt:
@@ -166,6 +168,8 @@ class IdentityServiceContext(context.IdentityServiceContext):
         return ctxt
 
 class OpenrcContext(context.IdentityServiceContext):
+    keys = ['os_username', 'os_password']
+
     def __call__(self):
         ctxt = {}
 
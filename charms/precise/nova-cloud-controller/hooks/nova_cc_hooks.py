@@ -97,6 +97,7 @@ def install():
             log('Installing %s to /usr/bin' % f)
             shutil.copy2(f, '/usr/bin')
     [open_port(port) for port in determine_ports()]
+    CONFIGS.precompile()
 
 @hooks.hook('config-changed')
 @restart_on_change(restart_map())
@@ -432,6 +433,7 @@ def nova_vmware_relation_changed():
 
 @hooks.hook('upgrade-charm')
 def upgrade_charm():
+    CONFIGS.precompile()
     for r_id in relation_ids('amqp'):
         amqp_joined(relation_id=r_id)
 
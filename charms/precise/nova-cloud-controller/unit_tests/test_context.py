@@ -0,0 +1,108 @@
+from collections import OrderedDict
+
+from charmhelpers.contrib.openstack import context
+from test_utils import CharmTestCase
+
+
+TO_PATCH = [
+    'config',
+    'log',
+    'relation_snapshot',
+]
+
+
+def snapshot(*relations):
+    """A relation snapshot of (rid, [(unit, settings), ...]) relations"""
+    return OrderedDict((rid, OrderedDict(units)) for rid, units in relations)
+
+
+class ContextTestCase(CharmTestCase):
+
+    def setUp(self):
+        super(ContextTestCase, self).setUp(context, TO_PATCH)
+        self.config.side_effect = self.test_config.get
+        self.relations = snapshot()
+        self.relation_snapshot.side_effect = lambda reltype: self.relations
+
+
+class SharedDBContextTest(ContextTestCase):
+
+    def test_context(self):
+        self.relations = snapshot(('shared-db:0', [
+            ('mysql/0', {'db_host': '10.0.0.1', 'password': 'secret'})]))
+        ctxt = context.SharedDBContext(database='nova', user='nova')()
+        self.assertEqual({'database_host': '10.0.0.1',
+                          'database': 'nova',
+                          'database_user': 'nova',
+                          'database_password': 'secret'}, ctxt)
+        self.relation_snapshot.assert_called_with('shared-db')
+
+    def test_first_complete_unit(self):
+        """Units which have not provided all settings yet are skipped"""
+        self.relations = snapshot(('shared-db:0', [
+            ('mysql/0', {'db_host': '10.0.0.1'}),
+            ('mysql/1', {'db_host': '10.0.0.2', 'password': 'secret'})]))
+        ctxt = context.SharedDBContext(database='nova', user='nova')()
+        self.assertEqual('10.0.0.2', ctxt['database_host'])
+
+    def test_relation_prefix(self):
+        self.relations = snapshot(('shared-db:0', [
+            ('mysql/0', {'db_host': '10.0.0.1', 'password': 'secret',
+                         'quantum_password': 'quantum-secret'})]))
+        ctxt = context.SharedDBContext(database='quantum', user='quantum',
+                                       relation_prefix='quantum')()
+        self.assertEqual('quantum-secret', ctxt['database_password'])
+
+    def test_incomplete(self):
+        self.relations = snapshot(('shared-db:0', [
+            ('mysql/0', {'db_host': '10.0.0.1'})]))
+        self.assertEqual(
+            {}, context.SharedDBContext(database='nova', user='nova')())
+
+    def test_no_relation(self):
+        self.assertEqual(
+            {}, context.SharedDBContext(database='nova', user='nova')())
+
+    def test_missing_config(self):
+        self.config.side_effect = lambda key: None
+        self.assertRaises(context.OSContextError, context.SharedDBContext())
+        self.assertFalse(self.relation_snapshot.called)
+
+
+class AMQPContextTest(ContextTestCase):
+
+    def setUp(self):
+        super(AMQPContextTest, self).setUp()
+        self.test_config.set('rabbit-user', 'nova')
+        self.test_config.set('rabbit-vhost', 'openstack')
+
+    def test_context(self):
+        self.relations = snapshot(('amqp:0', [
+            ('rabbitmq-server/0', {'private-address': '10.0.0.1',
+                                   'password': 'secret'}),
+            ('rabbitmq-server/1', {'private-address': '10.0.0.2'})]))
+        self.assertEqual({'rabbitmq_host': '10.0.0.1',
+                          'rabbitmq_hosts': ['10.0.0.1', '10.0.0.2'],
+                          'rabbitmq_user': 'nova',
+                          'rabbitmq_password': 'secret',
+                          'rabbitmq_virtual_host': 'openstack'},
+                         context.AMQPContext()())
+        self.relation_snapshot.assert_called_with('amqp')
+
+    def test_clustered(self):
+        self.relations = snapshot(('amqp:0', [
+            ('rabbitmq-server/0', {'private-address': '10.0.0.1',
+                                   'password': 'secret',
+                                   'clustered': 'yes',
+                                   'vip': '10.0.0.10'})]))
+        ctxt = context.AMQPContext()()
+        self.assertTrue(ctxt['clustered'])
+        self.assertEqual('10.0.0.10', ctxt['rabbitmq_host'])
+
+    def test_incomplete(self):
+        self.relations = snapshot(('amqp:0', [
+            ('rabbitmq-server/0', {'private-address': '10.0.0.1'})]))
+        self.assertEqual({}, context.AMQPContext()())
+
+    def test_no_relation(self):
+        self.assertEqual({}, context.AMQPContext()())
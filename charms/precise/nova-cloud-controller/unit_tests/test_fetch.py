@@ -0,0 +1,121 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import MagicMock, patch
+
+from charmhelpers import fetch
+
+
+class FakePackage(object):
+
+    def __init__(self, version=None):
+        self.current_ver = None
+        if version is not None:
+            self.current_ver = MagicMock(ver_str=version)
+
+
+class InstalledVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.dpkg_status = os.path.join(self.tmp_dir, 'status')
+        self.touch_dpkg_status(1000)
+        self.packages = {
+            'nova-common': FakePackage('1:2013.2-0ubuntu1'),
+            'nova-api-ec2': FakePackage(),
+        }
+        self.apt_pkg = self.patch('apt_pkg')
+        self.apt_pkg.Cache.side_effect = lambda: dict(self.packages)
+        self.patch('charm_dir').return_value = self.tmp_dir
+        self.patch('log')
+        self.patch('DPKG_STATUS', self.dpkg_status)
+        self.patch('_apt_cache', None)
+        self.patch('_installed_versions', None)
+
+    def patch(self, target, *args):
+        patcher = patch.object(fetch, target, *args)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def touch_dpkg_status(self, mtime):
+        with open(self.dpkg_status, 'a'):
+            os.utime(self.dpkg_status, (mtime, mtime))
+
+    def new_hook(self):
+        """Forget what this process loaded, as a new hook would"""
+        fetch._apt_cache = None
+        fetch._installed_versions = None
+
+    def index(self):
+        with open(os.path.join(self.tmp_dir, fetch.INSTALLED_VERSIONS)) as f:
+            return json.load(f)
+
+    def test_installed_version(self):
+        self.assertEqual('1:2013.2-0ubuntu1',
+                         fetch.installed_version('nova-common'))
+        self.assertEqual(None, fetch.installed_version('nova-api-ec2'))
+        self.assertRaises(KeyError, fetch.installed_version, 'nova-foo')
+        self.assertEqual(1, self.apt_pkg.Cache.call_count)
+
+    def test_persisted(self):
+        """Later hooks do not open the apt cache for indexed packages"""
+        fetch.installed_version('nova-common')
+        self.assertEqual({'dpkg-status': 1000,
+                          'versions': {'nova-common': '1:2013.2-0ubuntu1'}},
+                         self.index())
+        self.new_hook()
+        self.assertEqual('1:2013.2-0ubuntu1',
+                         fetch.installed_version('nova-common'))
+        self.assertEqual(1, self.apt_pkg.Cache.call_count)
+
+    def test_dpkg_status_changed(self):
+        """The index is discarded once packages were (un)installed"""
+        fetch.installed_version('nova-common')
+        self.new_hook()
+        self.packages['nova-common'] = FakePackage('1:2014.1-0ubuntu1')
+        self.touch_dpkg_status(2000)
+        self.assertEqual('1:2014.1-0ubuntu1',
+                         fetch.installed_version('nova-common'))
+        self.assertEqual(2000, self.index()['dpkg-status'])
+
+    def test_dpkg_status_changed_in_hook(self):
+        """Changes made during the hook drop the shared apt cache too"""
+        fetch.installed_version('nova-common')
+        self.packages['nova-common'] = FakePackage('1:2014.1-0ubuntu1')
+        self.touch_dpkg_status(2000)
+        self.assertEqual('1:2014.1-0ubuntu1',
+                         fetch.installed_version('nova-common'))
+        self.assertEqual(2, self.apt_pkg.Cache.call_count)
+
+    def test_corrupt_index(self):
+        with open(os.path.join(self.tmp_dir, fetch.INSTALLED_VERSIONS),
+                  'w') as f:
+            f.write('{')
+        self.assertEqual('1:2013.2-0ubuntu1',
+                         fetch.installed_version('nova-common'))
+
+    def test_apt_install_invalidates(self):
+        self.patch('subprocess')
+        fetch.installed_version('nova-common')
+        fetch.apt_install(['nova-api-ec2'], fatal=True)
+        self.touch_dpkg_status(2000)
+        self.packages['nova-api-ec2'] = FakePackage('1:2013.2-0ubuntu1')
+        self.assertEqual([], fetch.filter_installed_packages(
+            ['nova-common', 'nova-api-ec2']))
+        self.assertEqual(2, self.apt_pkg.Cache.call_count)
+
+    def test_filter_installed_packages(self):
+        self.assertEqual(
+            ['nova-api-ec2', 'nova-foo'],
+            fetch.filter_installed_packages(
+                ['nova-common', 'nova-api-ec2', 'nova-foo']))
+
+    def test_outside_hooks(self):
+        """Without a charm dir the index is only kept in memory"""
+        fetch.charm_dir.return_value = None
+        fetch.installed_version('nova-common')
+        self.assertEqual(['status'], os.listdir(self.tmp_dir))
@@ -0,0 +1,509 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.core import hookenv
+from test_utils import load_config
+
+
+class HookenvTestCase(unittest.TestCase):
+    """Runs hookenv as if in a hook of unit nova-cloud-controller/0"""
+
+    def setUp(self):
+        self.charm_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.charm_dir)
+        self.environ = {
+            'CHARM_DIR': self.charm_dir,
+            'JUJU_ENV_UUID': 'env-uuid',
+            'JUJU_UNIT_NAME': 'nova-cloud-controller/0',
+        }
+        self.patch_dict(os.environ, self.environ, clear=True)
+        self.check_output = self.patch(
+            'charmhelpers.core.hookenv.subprocess.check_output')
+        self.check_call = self.patch(
+            'charmhelpers.core.hookenv.subprocess.check_call')
+        self.patch('charmhelpers.core.hookenv.atexit')
+        self.patch('charmhelpers.core.hookenv._persistent_cache', None)
+        self.patch_dict(hookenv.cache, {}, clear=True)
+
+    def patch(self, target, *args, **kwargs):
+        patcher = patch(target, *args, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def patch_dict(self, target, values, clear=False):
+        patcher = patch.dict(target, values, clear=clear)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+
+class PersistentCacheTest(HookenvTestCase):
+
+    def setUp(self):
+        super(PersistentCacheTest, self).setUp()
+        self.hook_name = self.patch('charmhelpers.core.hookenv.hook_name')
+
+    def run_hook(self, hook, context, relation=None, remote_unit=None):
+        """Start a new hook execution, as seen by the persistent cache"""
+        hookenv.cache.clear()
+        if hookenv._persistent_cache is not None:
+            hookenv._persistent_cache.save()
+        hookenv._persistent_cache = None
+        os.environ['JUJU_CONTEXT_ID'] = context
+        for name in ('JUJU_RELATION', 'JUJU_RELATION_ID', 'JUJU_REMOTE_UNIT'):
+            os.environ.pop(name, None)
+        if relation is not None:
+            os.environ['JUJU_RELATION_ID'] = relation
+            os.environ['JUJU_RELATION'] = relation.split(':')[0]
+        if remote_unit is not None:
+            os.environ['JUJU_REMOTE_UNIT'] = remote_unit
+        self.hook_name.return_value = hook
+
+    def fill(self):
+        """Cache the config, relation ids, units and unit settings"""
+        self.check_output.side_effect = lambda cmd: json.dumps({
+            'config-get': {'debug': False},
+            'relation-ids': ['amqp:0'],
+            'relation-list': ['rabbitmq-server/0'],
+            'relation-get': {'password': 'secret'},
+        }[cmd[0]])
+        self.assertEqual({'debug': False}, hookenv.config())
+        self.assertEqual(['amqp:0'], hookenv.relation_ids('amqp'))
+        self.assertEqual(['rabbitmq-server/0'],
+                         hookenv.related_units('amqp:0'))
+        self.assertEqual(
+            'secret', hookenv.relation_get(
+                'password', unit='rabbitmq-server/0', rid='amqp:0'))
+        self.check_output.reset_mock()
+
+    def read_all(self):
+        """Read everything fill() cached, returning the hook tools run"""
+        hookenv.config()
+        hookenv.relation_ids('amqp')
+        hookenv.related_units('amqp:0')
+        hookenv.relation_get('password', unit='rabbitmq-server/0',
+                             rid='amqp:0')
+        tools = sorted(call[0][0][0]
+                       for call in self.check_output.call_args_list)
+        self.check_output.reset_mock()
+        return tools
+
+    def test_reused_across_hooks(self):
+        """A hook that changes nothing reuses the previous hook's results"""
+        self.run_hook('update-status', 'ctx-1')
+        self.fill()
+        self.run_hook('update-status', 'ctx-2')
+        self.assertEqual([], self.read_all())
+        self.assertTrue(os.path.exists(
+            os.path.join(self.charm_dir, hookenv.PERSISTENT_CACHE_FILE)))
+
+    def test_invalidated_once_per_context(self):
+        """Values cached during a hook are not dropped again later in it"""
+        self.run_hook('config-changed', 'ctx-1')
+        self.fill()
+        hookenv._persistent_cache.save()
+        hookenv._persistent_cache = None
+        hookenv.cache.clear()
+        self.assertEqual([], self.read_all())
+
+    def test_other_unit(self):
+        """The cache of another environment or unit is never used"""
+        self.run_hook('update-status', 'ctx-1')
+        self.fill()
+        os.environ['JUJU_ENV_UUID'] = 'other-env-uuid'
+        self.run_hook('update-status', 'ctx-2')
+        self.assertEqual(
+            ['config-get', 'relation-get', 'relation-ids', 'relation-list'],
+            self.read_all())
+
+    def test_install(self):
+        for hook in ('install', 'upgrade-charm'):
+            self.run_hook('update-status', 'ctx-1-' + hook)
+            self.fill()
+            self.run_hook(hook, 'ctx-2-' + hook)
+            self.assertEqual(
+                ['config-get', 'relation-get', 'relation-ids',
+                 'relation-list'],
+                self.read_all())
+
+    def test_config_changed(self):
+        self.run_hook('update-status', 'ctx-1')
+        self.fill()
+        self.run_hook('config-changed', 'ctx-2')
+        self.assertEqual(['config-get'], self.read_all())
+
+    def test_relation_joined(self):
+        self.run_hook('update-status', 'ctx-1')
+        self.fill()
+        self.run_hook('amqp-relation-joined', 'ctx-2', 'amqp:0',
+                      'rabbitmq-server/0')
+        self.assertEqual(['relation-get', 'relation-ids', 'relation-list'],
+                         self.read_all())
+
+    def test_relation_changed(self):
+        self.run_hook('update-status', 'ctx-1')
+        self.fill()
+        self.run_hook('amqp-relation-changed', 'ctx-2', 'amqp:0',
+                      'rabbitmq-server/0')
+        self.assertEqual(['relation-get'], self.read_all())
+
+    def test_relation_changed_other_unit(self):
+        """Only the settings of the remote unit are dropped"""
+        self.run_hook('update-status', 'ctx-1')
+        self.fill()
+        self.run_hook('amqp-relation-changed', 'ctx-2', 'amqp:0',
+                      'rabbitmq-server/1')
+        self.assertEqual([], self.read_all())
+
+    def test_relation_departed(self):
+        self.run_hook('update-status', 'ctx-1')
+        self.fill()
+        self.run_hook('amqp-relation-departed', 'ctx-2', 'amqp:0',
+                      'rabbitmq-server/0')
+        self.assertEqual(['relation-get', 'relation-list'], self.read_all())
+
+    def test_relation_broken(self):
+        self.run_hook('update-status', 'ctx-1')
+        self.fill()
+        self.run_hook('amqp-relation-broken', 'ctx-2', 'amqp:0')
+        self.assertEqual(['relation-get', 'relation-ids', 'relation-list'],
+                         self.read_all())
+
+    def test_other_relation(self):
+        """Hooks of other relations leave the amqp relation cached"""
+        self.run_hook('update-status', 'ctx-1')
+        self.fill()
+        self.run_hook('shared-db-relation-broken', 'ctx-2', 'shared-db:1',
+                      'mysql/0')
+        self.assertEqual([], self.read_all())
+
+    def local_settings(self, *rids):
+        """Read this unit's settings, returning the relations fetched"""
+        self.check_output.reset_mock()
+        self.check_output.side_effect = lambda cmd: json.dumps({})
+        for rid in rids:
+            hookenv.relation_get(unit='nova-cloud-controller/0', rid=rid)
+        return [call[0][0][3] for call in self.check_output.call_args_list]
+
+    def test_relation_set(self):
+        """Setting relation data drops this unit's settings for the
+        relation of the hook"""
+        self.run_hook('amqp-relation-joined', 'ctx-1', 'amqp:0',
+                      'rabbitmq-server/0')
+        self.local_settings('amqp:0', 'amqp:1')
+        hookenv.relation_set(username='nova')
+        self.check_call.assert_called_with(['relation-set', 'username=nova'])
+        self.assertEqual(['amqp:0'], self.local_settings('amqp:0', 'amqp:1'))
+
+    def test_relation_set_relation_id(self):
+        self.run_hook('update-status', 'ctx-1')
+        self.local_settings('amqp:0', 'amqp:1')
+        hookenv.relation_set(relation_id='amqp:1', username='nova')
+        self.assertEqual(['amqp:1'], self.local_settings('amqp:0', 'amqp:1'))
+
+    def test_relation_set_all_relations(self):
+        """Outside of relation hooks every cached relation is dropped"""
+        self.run_hook('update-status', 'ctx-1')
+        self.local_settings('amqp:0', 'amqp:1')
+        hookenv.relation_set(username='nova')
+        self.assertEqual(['amqp:0', 'amqp:1'],
+                         self.local_settings('amqp:0', 'amqp:1'))
+
+    def test_disabled_outside_hooks(self):
+        del os.environ['JUJU_UNIT_NAME']
+        self.assertEqual(None, hookenv.persistent_cache())
+
+
+class RelationSnapshotTest(HookenvTestCase):
+
+    def setUp(self):
+        super(RelationSnapshotTest, self).setUp()
+        self.relations = {
+            'cluster:1': {
+                'nova-cloud-controller/1': {'private-address': '10.0.0.2'},
+                'nova-cloud-controller/2': {'private-address': '10.0.0.3'},
+            },
+            'cluster:4': {},
+        }
+        self.check_output.side_effect = self.hook_tool
+
+    def hook_tool(self, cmd):
+        """Answer relation-ids, relation-list and relation-get as Juju does,
+        never listing the local unit"""
+        if cmd[0] == 'relation-ids':
+            return json.dumps(sorted(self.relations))
+        rid = cmd[cmd.index('-r') + 1]
+        if cmd[0] == 'relation-list':
+            return json.dumps(sorted(self.relations[rid]))
+        self.assertEqual(['relation-get', '--format=json', '-r', rid, '-'],
+                         cmd[:5])
+        return json.dumps(self.relations[rid][cmd[5]])
+
+    def test_snapshot(self):
+        """Relation ids map to related units, mapping to their settings"""
+        snapshot = hookenv.relation_snapshot('cluster')
+        self.assertEqual(['cluster:1', 'cluster:4'], list(snapshot))
+        self.assertEqual(
+            ['nova-cloud-controller/1', 'nova-cloud-controller/2'],
+            list(snapshot['cluster:1']))
+        self.assertEqual(self.relations, snapshot)
+
+    def test_local_unit_excluded(self):
+        """Peer relations do not include this unit's own settings"""
+        snapshot = hookenv.relation_snapshot('cluster')
+        for units in snapshot.values():
+            self.assertNotIn('nova-cloud-controller/0', units)
+        fetched = [call[0][0][5] for call in self.check_output.call_args_list
+                   if call[0][0][0] == 'relation-get']
+        self.assertNotIn('nova-cloud-controller/0', fetched)
+
+    def test_one_relation_get_per_unit(self):
+        hookenv.relation_snapshot('cluster')
+        tools = [call[0][0][0] for call in self.check_output.call_args_list]
+        self.assertEqual(2, tools.count('relation-get'))
+
+    def test_empty_settings(self):
+        """Units which have not set anything yet have empty settings"""
+        self.relations['cluster:4']['nova-cloud-controller/3'] = None
+        snapshot = hookenv.relation_snapshot('cluster')
+        self.assertEqual({}, snapshot['cluster:4']['nova-cloud-controller/3'])
+
+    def test_no_relations(self):
+        self.relations.clear()
+        self.assertEqual({}, hookenv.relation_snapshot('cluster'))
+
+
+class MemoTest(unittest.TestCase):
+
+    def test_get_set(self):
+        memo = hookenv.Memo()
+        key = (('amqp:0',), ())
+        self.assertRaises(KeyError, memo.get, key)
+        memo.set(key, 'value')
+        self.assertEqual('value', memo.get(key))
+        self.assertEqual(1, memo.hits)
+
+    def test_lru(self):
+        """The least recently used entry is evicted beyond maxsize"""
+        memo = hookenv.Memo(maxsize=2)
+        memo.set((('a',), ()), 1)
+        memo.set((('b',), ()), 2)
+        memo.get((('a',), ()))
+        memo.set((('c',), ()), 3)
+        self.assertEqual([(('a',), ()), (('c',), ())],
+                         list(memo.entries))
+        self.assertNotIn('b', memo.index)
+
+    def test_flush(self):
+        """Every entry having the value as an argument is flushed"""
+        memo = hookenv.Memo()
+        memo.set((('amqp:0', 'rabbitmq-server/0'), ()), 1)
+        memo.set(((), (('unit', 'rabbitmq-server/0'),)), 2)
+        memo.set((('amqp:0', 'rabbitmq-server/1'), ()), 3)
+        memo.flush('rabbitmq-server/0')
+        self.assertEqual([(('amqp:0', 'rabbitmq-server/1'), ())],
+                         list(memo.entries))
+        self.assertEqual(['amqp:0', 'rabbitmq-server/1'],
+                         sorted(memo.index))
+
+
+class CachedTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch.dict(hookenv.cache, {}, clear=True)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+        self.calls = []
+
+    def unit_settings(self, unit, rid=None):
+        self.calls.append((unit, rid))
+        return {'unit': unit}
+
+    def test_cached(self):
+        func = hookenv.cached(self.unit_settings)
+        self.assertEqual({'unit': 'mysql/0'}, func('mysql/0', rid='db:1'))
+        func('mysql/0', rid='db:1')
+        func('mysql/0', rid='db:2')
+        self.assertEqual([('mysql/0', 'db:1'), ('mysql/0', 'db:2')],
+                         self.calls)
+        self.assertEqual({'unit_settings': {'hits': 1, 'misses': 2,
+                                            'size': 2}},
+                         hookenv.cache_stats())
+
+    def test_maxsize(self):
+        func = hookenv.cached(maxsize=1)(self.unit_settings)
+        func('mysql/0')
+        func('mysql/1')
+        func('mysql/0')
+        self.assertEqual(3, len(self.calls))
+
+    def test_unhashable(self):
+        """Calls with unhashable arguments are not cached"""
+        func = hookenv.cached(self.unit_settings)
+        func(['mysql/0'])
+        func(['mysql/0'])
+        self.assertEqual(2, len(self.calls))
+
+    def test_flush(self):
+        func = hookenv.cached(self.unit_settings)
+        func('mysql/0', rid='db:1')
+        func('mysql/1', rid='db:1')
+        hookenv.flush('mysql/0')
+        func('mysql/0', rid='db:1')
+        func('mysql/1', rid='db:1')
+        self.assertEqual(
+            [('mysql/0', 'db:1'), ('mysql/1', 'db:1'), ('mysql/0', 'db:1')],
+            self.calls)
+
+
+class LogBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('charmhelpers.core.hookenv._juju_log')
+        self.addCleanup(patcher.stop)
+        self.juju_log = patcher.start()
+        patcher = patch('charmhelpers.core.hookenv.log_buffer', None)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_unbuffered(self):
+        hookenv.log('message', hookenv.WARNING)
+        self.juju_log.assert_called_once_with('message', hookenv.WARNING)
+
+    def test_batches(self):
+        """Consecutive messages of the same level are written together"""
+        hookenv.buffer_logs()
+        hookenv.log('one')
+        hookenv.log('two')
+        hookenv.log('three', hookenv.WARNING)
+        hookenv.log('four')
+        self.assertFalse(self.juju_log.called)
+        hookenv.flush_logs()
+        self.assertEqual(
+            [(('one\ntwo', None),), (('three', hookenv.WARNING),),
+             (('four', None),)],
+            self.juju_log.call_args_list)
+        hookenv.flush_logs()
+        self.assertEqual(3, self.juju_log.call_count)
+
+    def test_level(self):
+        hookenv.buffer_logs(hookenv.WARNING)
+        hookenv.log('debug', hookenv.DEBUG)
+        hookenv.log('info')
+        hookenv.log('warning', hookenv.WARNING)
+        hookenv.flush_logs()
+        self.juju_log.assert_called_once_with('warning', hookenv.WARNING)
+
+    def test_error_flushes(self):
+        """Errors are written straight away, after the pending messages"""
+        hookenv.buffer_logs()
+        hookenv.log('info')
+        hookenv.log('error', hookenv.ERROR)
+        self.assertEqual(
+            [(('info', None),), (('error', hookenv.ERROR),)],
+            self.juju_log.call_args_list)
+
+    def test_buffer_logs_flushes(self):
+        """Buffering again writes what the previous buffer held"""
+        hookenv.buffer_logs()
+        hookenv.log('info')
+        hookenv.buffer_logs(hookenv.ERROR)
+        self.juju_log.assert_called_once_with('info', None)
+
+    def test_handler(self):
+        logger = logging.getLogger('test_hookenv')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        handler = hookenv.JujuLogHandler()
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.warning('disk %s full', '/dev/sdb')
+        logger.log(25, 'custom level')
+        self.assertEqual(
+            [(('disk /dev/sdb full', hookenv.WARNING),),
+             (('custom level', None),)],
+            self.juju_log.call_args_list)
+
+
+class HookProfilingTest(HookenvTestCase):
+
+    def setUp(self):
+        super(HookProfilingTest, self).setUp()
+        self.profile_dir = os.path.join(self.charm_dir, 'profiles')
+        self.patch('charmhelpers.core.hookenv.PROFILE_DIR', self.profile_dir)
+        self.patch('charmhelpers.core.hookenv.log')
+        self.hooks = hookenv.Hooks()
+
+        @self.hooks.hook('config-changed')
+        def config_changed():
+            hookenv.config()
+            hookenv.relation_ids('amqp')
+            with hookenv.timed('render'):
+                pass
+
+        @self.hooks.hook('amqp-relation-changed')
+        def amqp_changed():
+            hookenv.relation_ids('amqp')
+
+    def execute(self, profile_hooks, hook='config-changed'):
+        self.check_output.side_effect = lambda cmd: json.dumps({
+            'config-get': {'profile-hooks': profile_hooks},
+            'relation-ids': ['amqp:0'],
+        }[cmd[0]])
+        self.hooks.execute(['hooks/' + hook])
+
+    def tools(self):
+        return [call[0][0][0] for call in self.check_output.call_args_list]
+
+    def test_execute_writes_report(self):
+        """Hooks are profiled when the profile-hooks option is set"""
+        self.execute(True)
+        reports = os.listdir(self.profile_dir)
+        self.assertEqual(1, len(reports))
+        self.assertTrue(
+            reports[0].startswith('nova-cloud-controller-0-config-changed-'))
+        with open(os.path.join(self.profile_dir, reports[0])) as report:
+            report = json.load(report)
+        self.assertEqual('config-changed', report['hook'])
+        self.assertEqual('nova-cloud-controller/0', report['unit'])
+        self.assertEqual(['config-get', 'relation-ids', 'render'],
+                         sorted(report['timings']))
+        self.assertEqual(1, report['timings']['render']['calls'])
+        self.assertEqual(None, hookenv.profiler)
+
+    def test_execute_not_profiled(self):
+        self.execute(False)
+        self.assertFalse(os.path.exists(self.profile_dir))
+        self.assertEqual(1, self.tools().count('config-get'))
+        self.assertEqual(None, hookenv.profiler)
+
+    def test_no_extra_config_get(self):
+        """Hooks not reading the charm config do not run config-get just to
+        decide whether to profile"""
+        self.execute(True, 'amqp-relation-changed')
+        self.assertEqual(['relation-ids'], self.tools())
+        self.assertFalse(os.path.exists(self.profile_dir))
+
+    def test_environment(self):
+        os.environ['CHARM_HELPERS_PROFILE'] = '1'
+        self.execute(False, 'amqp-relation-changed')
+        self.assertEqual(1, len(os.listdir(self.profile_dir)))
+        self.assertEqual(['relation-ids'], self.tools())
+
+    def test_environment_disabled(self):
+        """CHARM_HELPERS_PROFILE=0 overrides the profile-hooks option"""
+        os.environ['CHARM_HELPERS_PROFILE'] = '0'
+        self.execute(True)
+        self.assertFalse(os.path.exists(self.profile_dir))
+
+    def test_profile_hooks_option(self):
+        """The option is declared so that it can be set with juju set"""
+        self.assertEqual({'type': 'boolean', 'default': False},
+                         dict((k, v) for k, v in
+                              load_config()['profile-hooks'].items()
+                              if k != 'description'))
@@ -75,6 +75,7 @@ class NovaCCHooksTests(CharmTestCase):
         self.apt_install.assert_called_with(
             ['nova-scheduler', 'nova-api-ec2'], fatal=True)
         self.execd_preinstall.assert_called()
+        self.assertTrue(hooks.CONFIGS.precompile.called)
 
     @patch.object(hooks, 'configure_https')
     def test_config_changed_no_upgrade(self, conf_https):
@@ -0,0 +1,346 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from charmhelpers.contrib.openstack import templating
+
+
+class FakeContext(object):
+    """A context generator returning ctxt, counting its calls"""
+
+    def __init__(self, ctxt, interfaces=None, keys=None):
+        self.ctxt = ctxt
+        self.interfaces = interfaces or []
+        if keys is not None:
+            self.keys = keys
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return dict(self.ctxt)
+
+
+class TemplatingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.charm_dir = os.path.join(self.tmp_dir, 'charm')
+        self.templates_dir = os.path.join(self.tmp_dir, 'templates')
+        self.etc_dir = os.path.join(self.tmp_dir, 'etc')
+        for directory in (self.charm_dir, self.templates_dir, self.etc_dir):
+            os.mkdir(directory)
+        self.patch('log')
+        self.patch('charm_dir').return_value = self.charm_dir
+
+    def patch(self, target):
+        patcher = patch.object(templating, target)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def template(self, name, source, release=None):
+        directory = self.templates_dir
+        if release is not None:
+            directory = os.path.join(directory, release)
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+        with open(os.path.join(directory, name), 'w') as template:
+            template.write(source)
+
+    def config_file(self, name):
+        return os.path.join(self.etc_dir, name)
+
+    def read(self, config_file):
+        with open(config_file) as config:
+            return config.read()
+
+    def renderer(self, release='grizzly'):
+        return templating.OSConfigRenderer(templates_dir=self.templates_dir,
+                                           openstack_release=release)
+
+
+class RenderManifestTest(TemplatingTestCase):
+
+    def setUp(self):
+        super(RenderManifestTest, self).setUp()
+        self.nova_conf = self.config_file('nova.conf')
+        self.template('nova.conf', 'debug = {{ debug }}\n')
+        self.ctxt = FakeContext({'debug': False})
+        self.configs = self.renderer()
+        self.configs.register(self.nova_conf, [self.ctxt])
+
+    def renderer_for(self, *config_files):
+        """A renderer, as created by a later hook, for config_files"""
+        configs = self.renderer()
+        for config_file in config_files:
+            configs.register(config_file, self.configs.templates[
+                config_file].contexts)
+        return configs
+
+    def test_unchanged_not_rewritten(self):
+        self.assertTrue(self.configs.write(self.nova_conf))
+        self.assertEqual('debug = False', self.read(self.nova_conf))
+        self.assertFalse(self.configs.write(self.nova_conf))
+
+    def test_persisted(self):
+        """The manifest is kept in the charm dir for later hooks"""
+        self.configs.write(self.nova_conf)
+        self.assertTrue(os.path.exists(
+            os.path.join(self.charm_dir, templating.RENDER_MANIFEST)))
+        configs = self.renderer()
+        configs.register(self.nova_conf, [self.ctxt])
+        self.assertFalse(configs.write(self.nova_conf))
+
+    def test_context_changed(self):
+        self.configs.write(self.nova_conf)
+        self.ctxt.ctxt['debug'] = True
+        self.assertTrue(self.renderer_for(self.nova_conf).write(
+            self.nova_conf))
+        self.assertEqual('debug = True', self.read(self.nova_conf))
+
+    def test_template_changed(self):
+        self.configs.write(self.nova_conf)
+        self.template('nova.conf', 'verbose = {{ debug }}\n')
+        self.assertTrue(self.renderer_for(self.nova_conf).write(
+            self.nova_conf))
+        self.assertEqual('verbose = False', self.read(self.nova_conf))
+
+    def test_release_template(self):
+        """A release specific template is rendered after an upgrade"""
+        self.configs.write(self.nova_conf)
+        self.template('nova.conf', 'havana = {{ debug }}\n', 'havana')
+        configs = self.renderer_for(self.nova_conf)
+        configs.set_release('havana')
+        self.assertTrue(configs.write(self.nova_conf))
+        self.assertEqual('havana = False', self.read(self.nova_conf))
+
+    def test_file_modified(self):
+        """Config files changed behind our back are rendered again"""
+        self.configs.write(self.nova_conf)
+        with open(self.nova_conf, 'a') as config:
+            config.write('verbose = True\n')
+        self.assertTrue(self.configs.write(self.nova_conf))
+        self.assertEqual('debug = False', self.read(self.nova_conf))
+
+    def test_file_removed(self):
+        self.configs.write(self.nova_conf)
+        os.remove(self.nova_conf)
+        self.assertTrue(self.configs.write(self.nova_conf))
+
+    def test_corrupt_manifest(self):
+        with open(os.path.join(self.charm_dir, templating.RENDER_MANIFEST),
+                  'w') as manifest:
+            manifest.write('{')
+        self.assertTrue(self.renderer_for(self.nova_conf).write(
+            self.nova_conf))
+
+    def test_write_all(self):
+        """write_all() returns the config files actually written"""
+        api_paste = self.config_file('api-paste.ini')
+        self.template('api-paste.ini', '[pipeline:main]\n')
+        self.configs.register(api_paste, [])
+        self.assertEqual(set([self.nova_conf, api_paste]),
+                         self.configs.write_all())
+        self.ctxt.ctxt['debug'] = True
+        configs = self.renderer_for(self.nova_conf, api_paste)
+        self.assertEqual(set([self.nova_conf]), configs.write_all())
+
+    def test_saved_once(self):
+        """write_all() saves the manifest once, after writing every file"""
+        self.template('api-paste.ini', '[pipeline:main]\n')
+        self.configs.register(self.config_file('api-paste.ini'), [])
+        with patch.object(templating.RenderManifest, 'save',
+                          autospec=True) as save:
+            self.configs.write_all()
+        save.assert_called_once_with(self.configs.manifest)
+        with patch.object(templating.RenderManifest, 'save',
+                          autospec=True) as save:
+            self.configs.write(self.nova_conf)
+        save.assert_called_once_with(self.configs.manifest)
+
+    def test_outside_hooks(self):
+        """Without a charm dir, config files are always written"""
+        templating.charm_dir.return_value = None
+        configs = self.renderer_for(self.nova_conf)
+        self.assertTrue(configs.write(self.nova_conf))
+        self.assertTrue(configs.write(self.nova_conf))
+
+
+
+class ContextMemoTest(TemplatingTestCase):
+
+    def setUp(self):
+        super(ContextMemoTest, self).setUp()
+        self.nova_conf = self.config_file('nova.conf')
+        self.api_paste = self.config_file('api-paste.ini')
+        self.template('nova.conf', 'sql = {{ database }} {{ rabbit_host }}')
+        self.template('api-paste.ini', 'auth = {{ auth_host }}')
+        self.shared_db = FakeContext({'database': 'nova'}, ['shared-db'],
+                                     keys=['database'])
+        self.amqp = FakeContext({'rabbit_host': '10.0.0.1'}, ['amqp'],
+                                keys=['rabbit_host'])
+        self.identity = FakeContext({'auth_host': '10.0.0.2'},
+                                    ['identity-service'], keys=['auth_host'])
+        self.configs = self.renderer()
+        self.configs.register(self.nova_conf,
+                              [self.shared_db, self.amqp, self.identity])
+        self.configs.register(self.api_paste, [self.amqp, self.identity])
+
+    def calls(self):
+        return [c.calls for c in (self.shared_db, self.amqp, self.identity)]
+
+    def test_shared_between_templates(self):
+        self.configs.write_all()
+        self.assertEqual([1, 1, 1], self.calls())
+
+    def test_shared_with_complete_contexts(self):
+        """Checking complete contexts before writing in a single render pass
+        calls each generator once"""
+        with self.configs.render_pass():
+            self.assertIn('amqp', self.configs.complete_contexts())
+            self.configs.write_all()
+            self.configs.write(self.nova_conf)
+        self.assertEqual([1, 1, 1], self.calls())
+        self.assertEqual('auth = 10.0.0.2', self.read(self.api_paste))
+
+    def test_dropped_after_pass(self):
+        """Results are not reused by later passes, once the config, files
+        or services generators inspect may have changed"""
+        self.configs.complete_contexts()
+        self.configs.write_all()
+        self.assertEqual([2, 2, 2], self.calls())
+        self.amqp.ctxt['rabbit_host'] = '10.0.0.3'
+        self.configs.write(self.api_paste)
+        self.assertEqual('auth = 10.0.0.2', self.read(self.api_paste))
+        self.configs.write(self.nova_conf)
+        self.assertEqual('sql = nova 10.0.0.3', self.read(self.nova_conf))
+        self.assertTrue(self.configs._context_memo is None)
+
+    def test_skip_unreferenced(self):
+        """Generators providing no variable of the template are not called"""
+        self.configs.write(self.api_paste)
+        self.assertEqual([0, 0, 1], self.calls())
+        self.assertEqual('auth = 10.0.0.2', self.read(self.api_paste))
+
+    def test_skip_without_keys(self):
+        """Generators not declaring their keys are always called"""
+        del self.amqp.keys
+        self.configs.write(self.api_paste)
+        self.assertEqual([0, 1, 1], self.calls())
+
+    def test_skipped_not_complete(self):
+        """complete_contexts() calls the generators skipped when writing"""
+        with self.configs.render_pass():
+            self.configs.write(self.api_paste)
+            self.assertEqual(['shared-db', 'amqp', 'identity-service'],
+                             self.configs.templates[
+                                 self.nova_conf].complete_contexts(
+                                     self.configs._context_memo))
+        self.assertEqual([1, 1, 1], self.calls())
+
+    def test_variables_persisted(self):
+        """Later hooks reuse the variables recorded in the manifest rather
+        than parsing the templates again"""
+        self.configs.write_all()
+        configs = self.renderer()
+        configs.register(self.api_paste, [self.amqp, self.identity])
+        with patch.object(templating.meta,
+                          'find_undeclared_variables') as find:
+            configs.write(self.api_paste)
+        self.assertFalse(find.called)
+        self.assertEqual(set(['auth_host']),
+                         configs.template_variables(self.api_paste))
+        self.assertEqual([1, 1, 2], self.calls())
+
+    def test_variables_template_changed(self):
+        """Changed templates are parsed again"""
+        self.configs.write(self.api_paste)
+        self.template('api-paste.ini', 'amqp = {{ rabbit_host }}')
+        configs = self.renderer()
+        configs.register(self.api_paste, [self.amqp, self.identity])
+        configs.write(self.api_paste)
+        self.assertEqual('amqp = 10.0.0.1', self.read(self.api_paste))
+        self.assertEqual([0, 1, 1], self.calls())
+
+    def test_set_release(self):
+        """Variables referenced by the new release's templates are used"""
+        self.configs.write(self.api_paste)
+        self.template('api-paste.ini', 'amqp = {{ rabbit_host }}', 'havana')
+        self.configs.set_release('havana')
+        self.configs.write(self.api_paste)
+        self.assertEqual('amqp = 10.0.0.1', self.read(self.api_paste))
+        self.assertEqual([0, 1, 1], self.calls())
+
+
+class PrecompileTest(TemplatingTestCase):
+
+    def setUp(self):
+        super(PrecompileTest, self).setUp()
+        self.template('nova.conf', 'debug = {{ debug }}')
+        self.template('nova.conf', 'verbose = {{ debug }}', 'havana')
+        self.template('api-paste.ini', '[pipeline:main]')
+        self.bytecode_dir = os.path.join(self.charm_dir,
+                                         templating.BYTECODE_CACHE_DIR)
+
+    def renderer(self, release='grizzly'):
+        configs = super(PrecompileTest, self).renderer(release)
+        ctxt = FakeContext({'debug': True})
+        for name in ('nova.conf', 'api-paste.ini', 'missing.conf'):
+            configs.register(self.config_file(name), [ctxt])
+        return configs
+
+    def test_precompile(self):
+        compiled = self.renderer('havana').precompile()
+        self.assertEqual(
+            sorted([os.path.join(self.templates_dir, 'havana', 'nova.conf'),
+                    os.path.join(self.templates_dir, 'api-paste.ini')]),
+            sorted(compiled))
+        self.assertEqual(2, len(os.listdir(self.bytecode_dir)))
+
+    def test_compiled_code_loaded(self):
+        """Later hooks load the compiled templates"""
+        self.renderer().precompile()
+        with patch.object(templating.Environment, 'compile') as compile:
+            self.renderer().write(self.config_file('nova.conf'))
+        self.assertFalse(compile.called)
+        self.assertEqual('debug = True',
+                         self.read(self.config_file('nova.conf')))
+
+    def test_variables_recorded(self):
+        """Template variables are recorded for later hooks, replacing
+        those of previous templates"""
+        configs = self.renderer()
+        configs.manifest.update_variables('old', ['verbose'])
+        configs.precompile()
+        with patch.object(templating.meta,
+                          'find_undeclared_variables') as find:
+            configs = self.renderer()
+            self.assertEqual(set(['debug']), configs.template_variables(
+                self.config_file('nova.conf')))
+        self.assertFalse(find.called)
+        self.assertEqual(2, len(configs.manifest.variables))
+
+    def test_jinja2_installed_by_hook(self):
+        """Templates are compiled when jinja2 was only installed after the
+        module was imported, as in the install hook"""
+        jinja2_names = ('FileSystemLoader', 'ChoiceLoader', 'Environment',
+                        'exceptions', 'meta', 'FileSystemBytecodeCache',
+                        'ReleaseBytecodeCache')
+        for name in jinja2_names:
+            patcher = patch.object(templating, name, None)
+            self.addCleanup(patcher.stop)
+            patcher.start()
+        self.patch('apt_install')
+        configs = self.renderer()
+        templating.apt_install.assert_called_with('python-jinja2')
+        self.assertEqual(2, len(configs.precompile()))
+        self.assertEqual(2, len(os.listdir(self.bytecode_dir)))
+        self.assertTrue(templating.ReleaseBytecodeCache is not None)
+
+    def test_jinja2_not_installed(self):
+        self.patch('import_jinja2').return_value = False
+        self.assertEqual([], self.renderer().precompile())
+        self.assertFalse(os.path.exists(self.bytecode_dir))
@@ -63,6 +63,7 @@ def install():
     configure_installation_source(config('openstack-origin'))
     apt_update()
     apt_install(determine_packages(), fatal=True)
+    CONFIGS.precompile()
 
 
 @hooks.hook('config-changed')
@@ -201,6 +202,7 @@ def relation_broken():
 
 @hooks.hook('upgrade-charm')
 def upgrade_charm():
+    CONFIGS.precompile()
     for r_id in relation_ids('amqp'):
         amqp_joined(relation_id=r_id)
 
@@ -21,6 +21,7 @@ from charmhelpers.core.host import (
 
 from charmhelpers.fetch import (
     apt_install,
+    installed_version,
 )
 
 CLOUD_ARCHIVE_URL = "http://ubuntu-cloud.archive.canonical.com/ubuntu"
@@ -114,12 +115,9 @@ def get_os_version_codename(codename):
 
 def get_os_codename_package(package, fatal=True):
     '''Derive OpenStack release codename from an installed package.'''
-    apt.init()
-    cache = apt.Cache()
-
     try:
-        pkg = cache[package]
-    except:
+        installed = installed_version(package)
+    except KeyError:
         if not fatal:
             return None
         # the package is unknown to the current apt cache.
@@ -127,17 +125,18 @@ def get_os_codename_package(package, fatal=True):
             'candidate: %s' % package
         error_out(e)
 
-    if not pkg.current_ver:
+    if not installed:
         if not fatal:
             return None
         # package is known, but no version is currently installed.
         e = 'Could not determine version of uninstalled package: %s' % package
         error_out(e)
 
-    vers = apt.upstream_version(pkg.current_ver.ver_str)
+    apt.init()
+    vers = apt.upstream_version(installed)
 
     try:
-        if 'swift' in pkg.name:
+        if 'swift' in package:
             swift_vers = vers[:5]
             if swift_vers not in SWIFT_CODENAMES:
                 # Deal with 1.10.0 upward
@@ -44,6 +44,7 @@ def install():
     configure_installation_source(config('openstack-origin'))
     apt_update(fatal=True)
     apt_install(filter_installed_packages(PACKAGES), fatal=True)
+    CONFIGS.precompile()
 
 
 @hooks.hook('upgrade-charm')
@@ -51,6 +52,7 @@ def install():
 def upgrade_charm():
     execd_preinstall()
     apt_install(filter_installed_packages(PACKAGES), fatal=True)
+    CONFIGS.precompile()
     CONFIGS.write_all()
 
 
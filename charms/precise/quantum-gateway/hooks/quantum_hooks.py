@@ -72,6 +72,7 @@ def install():
     else:
         log('Please provide a valid plugin config', level=ERROR)
         sys.exit(1)
+    CONFIGS.precompile()
 
 
 @hooks.hook('config-changed')
@@ -1,26 +1,152 @@
 import os
+import json
+import hashlib
+import tempfile
+
+from contextlib import contextmanager
 
 from charmhelpers.fetch import apt_install
 
 from charmhelpers.core.hookenv import (
+    charm_dir,
     log,
+    timed,
     ERROR,
     INFO
 )
 
 from charmhelpers.contrib.openstack.utils import OPENSTACK_CODENAMES
 
-try:
-    from jinja2 import FileSystemLoader, ChoiceLoader, Environment, exceptions
-except ImportError:
-    # python-jinja2 may not be installed yet, or we're running unittests.
-    FileSystemLoader = ChoiceLoader = Environment = exceptions = None
+FileSystemLoader = ChoiceLoader = Environment = exceptions = meta = None
+FileSystemBytecodeCache = ReleaseBytecodeCache = None
 
 
 class OSConfigException(Exception):
     pass
 
 
+RENDER_MANIFEST = '.templating-manifest.json'
+BYTECODE_CACHE_DIR = '.templating-bytecode'
+
+
+def import_jinja2():
+    """
+    Import jinja2, which may have been installed by the running hook after
+    this module was imported, eg. by the install hook.  Returns whether
+    jinja2 is available.
+    """
+    global FileSystemLoader, ChoiceLoader, Environment, exceptions, meta
+    global FileSystemBytecodeCache, ReleaseBytecodeCache
+    if Environment is not None:
+        return True
+    try:
+        from jinja2 import FileSystemLoader, ChoiceLoader, Environment
+        from jinja2 import exceptions, meta, FileSystemBytecodeCache
+    except ImportError:
+        # python-jinja2 may not be installed yet, or we're running unittests.
+        return False
+
+    class ReleaseBytecodeCache(FileSystemBytecodeCache):
+        """
+        A jinja2 bytecode cache persisted across hook executions, with
+        entries keyed by the template path, its mtime and the OpenStack
+        release the templates are loaded for.
+        """
+        def __init__(self, directory, os_release):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            super(ReleaseBytecodeCache, self).__init__(directory)
+            self.os_release = os_release
+
+        def get_cache_key(self, name, filename=None):
+            key = [self.os_release, name]
+            if filename is not None:
+                try:
+                    key.extend([filename, repr(os.path.getmtime(filename))])
+                except OSError:
+                    key.append(filename)
+            return hashlib.sha1(
+                '|'.join(key).encode('utf-8')).hexdigest()
+
+    return True
+
+
+import_jinja2()
+
+
+class RenderManifest(object):
+    """
+    Records, for every config file written, a digest of the template source
+    and context it was rendered from along with the size and mtime of the
+    file written.  A config file whose digest is unchanged and which has
+    not been touched since does not need to be rendered again.
+
+    The variables referenced by each template source are recorded too,
+    keyed by a digest of the source, so that templates are only parsed
+    again once they changed.  Updates are only written out by save().
+    """
+    def __init__(self, path):
+        self.path = path
+        self.dirty = False
+        try:
+            with open(path) as manifest:
+                data = json.load(manifest)
+            self.entries = data['files']
+            self.variables = data['variables']
+        except (IOError, ValueError, KeyError, TypeError):
+            self.entries = {}
+            self.variables = {}
+
+    def unchanged(self, config_file, digest):
+        entry = self.entries.get(config_file)
+        if not entry or entry['digest'] != digest:
+            return False
+        try:
+            stat = os.stat(config_file)
+        except OSError:
+            return False
+        return (entry['size'] == stat.st_size and
+                entry['mtime'] == stat.st_mtime)
+
+    def update(self, config_file, digest):
+        stat = os.stat(config_file)
+        self.entries[config_file] = {
+            'digest': digest,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+        }
+        self.dirty = True
+
+    def template_variables(self, source_digest):
+        variables = self.variables.get(source_digest)
+        if variables is None:
+            return None
+        return set(variables)
+
+    def update_variables(self, source_digest, variables):
+        self.variables[source_digest] = sorted(variables)
+        self.dirty = True
+
+    def clear_variables(self):
+        if self.variables:
+            self.variables = {}
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path),
+                                       prefix=RENDER_MANIFEST)
+            with os.fdopen(fd, 'w') as manifest:
+                json.dump({'files': self.entries,
+                           'variables': self.variables}, manifest)
+            os.rename(tmp, self.path)
+            self.dirty = False
+        except (IOError, OSError) as e:
+            log('Could not save render manifest: %s' % e, level=ERROR)
+
+
 def get_loader(templates_dir, os_release):
     """
     Create a jinja2.ChoiceLoader containing template dirs up to
@@ -81,11 +207,32 @@ class OSConfigTemplate(object):
             self.contexts = contexts
 
         self._complete_contexts = []
+        self._skipped_contexts = False
 
-    def context(self):
+    def context(self, memo=None, variables=None):
+        """
+        Build the template context by calling every context generator.
+
+        :param memo     : dict: results of generators already called during
+                                this render pass, updated with new results.
+        :param variables: set: variables referenced by the template, if
+                               known.  Generators declaring the keys they
+                               provide are skipped when none is referenced.
+        """
         ctxt = {}
+        self._skipped_contexts = False
         for context in self.contexts:
-            _ctxt = context()
+            keys = getattr(context, 'keys', None)
+            if (variables is not None and keys is not None and
+                    not variables.intersection(keys)):
+                self._skipped_contexts = True
+                continue
+            if memo is not None and context in memo:
+                _ctxt = memo[context]
+            else:
+                _ctxt = context()
+                if memo is not None:
+                    memo[context] = _ctxt
             if _ctxt:
                 ctxt.update(_ctxt)
                 # track interfaces for every complete context.
@@ -94,13 +241,13 @@ class OSConfigTemplate(object):
                  if interface not in self._complete_contexts]
         return ctxt
 
-    def complete_contexts(self):
+    def complete_contexts(self, memo=None):
         '''
         Return a list of interfaces that have atisfied contexts.
         '''
-        if self._complete_contexts:
+        if self._complete_contexts and not self._skipped_contexts:
             return self._complete_contexts
-        self.context()
+        self.context(memo)
         return self._complete_contexts
 
 
@@ -188,11 +335,16 @@ class OSConfigRenderer(object):
         self.openstack_release = openstack_release
         self.templates = {}
         self._tmpl_env = None
+        self._context_memo = None
+        self._variables = {}
+        self.manifest = None
+        if charm_dir():
+            self.manifest = RenderManifest(os.path.join(charm_dir(),
+                                                        RENDER_MANIFEST))
 
         if None in [Environment, ChoiceLoader, FileSystemLoader]:
             # if this code is running, the object is created pre-install hook.
-            # jinja2 shouldn't get touched until the module is reloaded on next
-            # hook execution, with proper jinja2 bits successfully imported.
+            # jinja2 is imported once installed, see import_jinja2().
             apt_install('python-jinja2')
 
     def register(self, config_file, contexts):
@@ -206,8 +358,22 @@ class OSConfigRenderer(object):
 
     def _get_tmpl_env(self):
         if not self._tmpl_env:
+            import_jinja2()
             loader = get_loader(self.templates_dir, self.openstack_release)
-            self._tmpl_env = Environment(loader=loader)
+            self._tmpl_env = Environment(
+                loader=loader, bytecode_cache=self._get_bytecode_cache())
+
+    def _get_bytecode_cache(self):
+        if not charm_dir() or FileSystemBytecodeCache is None:
+            return None
+        try:
+            return ReleaseBytecodeCache(
+                os.path.join(charm_dir(), BYTECODE_CACHE_DIR),
+                self.openstack_release)
+        except OSError as e:
+            log('Could not create template bytecode cache: %s' % e,
+                level=ERROR)
+            return None
 
     def _get_template(self, template):
         self._get_tmpl_env()
@@ -215,11 +381,106 @@ class OSConfigRenderer(object):
         log('Loaded template from %s' % template.filename, level=INFO)
         return template
 
-    def render(self, config_file):
+    def _template_names(self, config_file):
+        # templates are looked up by basename first, then by a munged full
+        # path, eg: /etc/apache2/apache2.conf -> etc_apache2_apache2.conf
+        return [os.path.basename(config_file),
+                '_'.join(config_file.split('/')[1:])]
+
+    def _template_source(self, config_file):
+        self._get_tmpl_env()
+        for name in self._template_names(config_file):
+            try:
+                source, filename, _ = self._tmpl_env.loader.get_source(
+                    self._tmpl_env, name)
+            except exceptions.TemplateNotFound:
+                continue
+            return source, filename
+        return None, None
+
+    def template_variables(self, config_file):
+        """
+        Returns the set of variables referenced by the template for
+        config_file, or None if they cannot be determined.  Templates are
+        only parsed when the render manifest has no variables recorded for
+        their current source.
+        """
+        if config_file not in self._variables:
+            variables = None
+            source, _ = self._template_source(config_file)
+            if source is not None:
+                variables = self._source_variables(source)
+            self._variables[config_file] = variables
+        return self._variables[config_file]
+
+    def _source_variables(self, source):
+        source_digest = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        if self.manifest is not None:
+            variables = self.manifest.template_variables(source_digest)
+            if variables is not None:
+                return variables
+        if meta is None:
+            return None
+        ast = self._tmpl_env.parse(source)
+        variables = meta.find_undeclared_variables(ast)
+        if self.manifest is not None:
+            self.manifest.update_variables(source_digest, variables)
+        return variables
+
+    def digest(self, config_file, ctxt):
+        """
+        Returns a digest of the template source and context config_file
+        would be rendered from, or None if the template cannot be found.
+        """
+        source, filename = self._template_source(config_file)
+        if source is None:
+            return None
+        h = hashlib.sha256()
+        h.update(filename)
+        h.update('\0')
+        h.update(source.encode('utf-8'))
+        h.update('\0')
+        h.update(json.dumps(ctxt, sort_keys=True, default=repr))
+        return h.hexdigest()
+
+    @contextmanager
+    def render_pass(self):
+        """
+        Call each context generator at most once within the block, sharing
+        its result between every template registered with it.  write_all()
+        and complete_contexts() are render passes of their own; a charm
+        checking complete contexts before writing its configs can run both
+        in a single pass:
+
+            with configs.render_pass():
+                if 'shared-db' in configs.complete_contexts():
+                    configs.write_all()
+
+        Results are dropped at the end of the block, as generators also
+        inspect config, files and services which may change afterwards.
+        The render manifest is saved once, at the end of the block.
+        """
+        if self._context_memo is not None:
+            yield
+            return
+        self._context_memo = {}
+        try:
+            yield
+        finally:
+            self._context_memo = None
+            if self.manifest is not None:
+                self.manifest.save()
+
+    def _context(self, config_file):
+        return self.templates[config_file].context(
+            self._context_memo, self.template_variables(config_file))
+
+    def render(self, config_file, ctxt=None):
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
-        ctxt = self.templates[config_file].context()
+        if ctxt is None:
+            ctxt = self._context(config_file)
 
         _tmpl = os.path.basename(config_file)
         try:
@@ -240,26 +501,47 @@ class OSConfigRenderer(object):
         log('Rendering from template: %s' % _tmpl, level=INFO)
         return template.render(ctxt)
 
+    @timed('OSConfigRenderer.write')
     def write(self, config_file):
         """
         Write a single config file, raises if config file is not registered.
+
+        Rendering and writing are skipped when neither the template nor its
+        context changed since the file was last written.  Returns whether
+        the file was (re)written.
         """
         if config_file not in self.templates:
             log('Config not registered: %s' % config_file, level=ERROR)
             raise OSConfigException
 
-        _out = self.render(config_file)
+        with self.render_pass():
+            ctxt = self._context(config_file)
+            digest = None
+            if self.manifest is not None:
+                digest = self.digest(config_file, ctxt)
+                if digest and self.manifest.unchanged(config_file, digest):
+                    log('Template %s unchanged, not rewriting.' %
+                        config_file, level=INFO)
+                    return False
+
+            _out = self.render(config_file, ctxt)
 
-        with open(config_file, 'wb') as out:
-            out.write(_out)
+            with open(config_file, 'wb') as out:
+                out.write(_out)
 
-        log('Wrote template %s.' % config_file, level=INFO)
+            if digest:
+                self.manifest.update(config_file, digest)
+            log('Wrote template %s.' % config_file, level=INFO)
+            return True
 
     def write_all(self):
         """
-        Write out all registered config files.
+        Write out all registered config files.  Returns the set of config
+        files which actually changed.
         """
-        [self.write(k) for k in self.templates.iterkeys()]
+        with self.render_pass():
+            return set(k for k in self.templates.iterkeys()
+                       if self.write(k))
 
     def set_release(self, openstack_release):
         """
@@ -267,14 +549,56 @@ class OSConfigRenderer(object):
         based on a the new openstack release.
         """
         self._tmpl_env = None
+        self._variables = {}
         self.openstack_release = openstack_release
         self._get_tmpl_env()
 
+    def precompile(self):
+        """
+        Compile the templates of all registered config files for the current
+        release into the on-disk bytecode cache, discarding any previously
+        cached code.  The variables referenced by each template are recorded
+        in the render manifest as well.  Intended to be run from the install
+        and upgrade-charm hooks, once python-jinja2 is installed, so that
+        other hooks only load compiled templates.  Returns the list of
+        templates compiled.
+        """
+        if not import_jinja2():
+            log('jinja2 not available, not precompiling templates.',
+                level=INFO)
+            return []
+        self._get_tmpl_env()
+        if self._tmpl_env.bytecode_cache is None:
+            return []
+        self._tmpl_env.bytecode_cache.clear()
+        self._tmpl_env.cache.clear()
+        self._variables = {}
+        if self.manifest is not None:
+            self.manifest.clear_variables()
+        compiled = []
+        for config_file in self.templates.iterkeys():
+            for name in self._template_names(config_file):
+                try:
+                    template = self._tmpl_env.get_template(name)
+                except exceptions.TemplateNotFound:
+                    continue
+                compiled.append(template.filename)
+                self.template_variables(config_file)
+                break
+            else:
+                log('Could not find template for %s.' % config_file,
+                    level=ERROR)
+        if self.manifest is not None:
+            self.manifest.save()
+        log('Precompiled templates: %s' % compiled, level=INFO)
+        return compiled
+
     def complete_contexts(self):
         '''
         Returns a list of context interfaces that yield a complete context.
         '''
         interfaces = []
-        [interfaces.extend(i.complete_contexts())
-         for i in self.templates.itervalues()]
+        with self.render_pass():
+            [interfaces.extend(i.complete_contexts(self._context_memo))
+             for i in self.templates.itervalues()]
         return interfaces
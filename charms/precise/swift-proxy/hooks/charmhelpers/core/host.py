@@ -15,7 +15,7 @@ import hashlib
 
 from collections import OrderedDict
 
-from hookenv import log
+from hookenv import log, timed
 
 
 def service_start(service_name):
@@ -39,7 +39,8 @@ def service_reload(service_name, restart_on_failure=False):
 
 def service(action, service_name):
     cmd = ['service', service_name, action]
-    return subprocess.call(cmd) == 0
+    with timed('service {}'.format(action)):
+        return subprocess.call(cmd) == 0
 
 
 def service_running(service):
@@ -17,12 +17,8 @@ from swift_utils import (
     initialize_ring,
     swift_user,
     SWIFT_HA_RES,
-    balance_ring,
     SWIFT_CONF_DIR,
-    get_zone,
-    exists_in_ring,
-    add_to_ring,
-    should_balance,
+    SwiftRings,
     do_openstack_upgrade,
     write_rc_script
 )
@@ -85,6 +81,7 @@ def install():
         os.mkdir(WWW_DIR, 0755)
     uid, gid = swift_user()
     os.chown(WWW_DIR, uid, gid)
+    CONFIGS.precompile()
 
 
 @hooks.hook('identity-service-relation-joined')
@@ -116,14 +113,13 @@ def keystone_changed():
     configure_https()
 
 
-def balance_rings():
+def balance_rings(rings):
     '''handle doing ring balancing and distribution.'''
-    new_ring = False
-    for ring in SWIFT_RINGS.itervalues():
-        if balance_ring(ring):
-            log('Balanced ring %s' % ring)
-            new_ring = True
-    if not new_ring:
+    balanced = rings.balance_rings()
+    rings.save()
+    for name in balanced:
+        log('Balanced ring %s' % SWIFT_RINGS[name])
+    if not balanced:
         return
 
     for ring in SWIFT_RINGS.keys():
@@ -155,7 +151,8 @@ def balance_rings():
 @hooks.hook('swift-storage-relation-changed')
 @restart_on_change(restart_map())
 def storage_changed():
-    zone = get_zone(config('zone-assignment'))
+    rings = SwiftRings()
+    zone = rings.get_zone(config('zone-assignment'))
     node_settings = {
         'ip': openstack.get_host_ip(relation_get('private-address')),
         'zone': zone,
@@ -176,12 +173,20 @@ def storage_changed():
     devs = relation_get('device').split(':')
     for dev in devs:
         node_settings['device'] = dev
-        for ring in SWIFT_RINGS.itervalues():
-            if not exists_in_ring(ring, node_settings):
-                add_to_ring(ring, node_settings)
+        rings.add_node(node_settings)
 
-    if should_balance([r for r in SWIFT_RINGS.itervalues()]):
-        balance_rings()
+    commit_pending_devices(rings)
+
+
+def commit_pending_devices(rings):
+    '''Rebalance and publish the rings if the pending devices batch is ready
+       to be committed.'''
+    if (rings.batch_ready(config('rebalance-min-devices'),
+                          config('rebalance-settle-time')) and
+            rings.should_balance()):
+        balance_rings(rings)
+    else:
+        rings.save()
 
 
 @hooks.hook('swift-storage-relation-broken')
@@ -205,6 +210,11 @@ def config_changed():
         openstack.get_os_version_codename(installed)):
         pkgs = determine_packages(available)
         do_openstack_upgrade(src, pkgs)
+    # Commit the pending devices if the batch settings changed or the settle
+    # time elapsed.
+    rings = SwiftRings()
+    if rings.pending_devices()['devices']:
+        commit_pending_devices(rings)
 
 
 @hooks.hook('cluster-relation-changed',
@@ -1,6 +1,9 @@
+import copy
+import json
 import os
 import pwd
-import subprocess
+import tempfile
+import time
 import charmhelpers.contrib.openstack.utils as openstack
 import sys
 from collections import OrderedDict
@@ -40,6 +43,9 @@ SWIFT_RINGS = {
     'object': '/etc/swift/object.builder'
 }
 
+# Devices added to the ring builders since the last rebalance.
+PENDING_DEVICES = '/etc/swift/pending-devices.json'
+
 SSL_CERT = '/etc/swift/cert.crt'
 SSL_KEY = '/etc/swift/cert.key'
 
@@ -219,51 +225,24 @@ def initialize_ring(path, part_power, replicas, min_hours):
     _write_ring(ring, path)
 
 
-def exists_in_ring(ring_path, node):
-    ring = _load_builder(ring_path).to_dict()
-    node['port'] = ring_port(ring_path, node)
-
-    for dev in ring['devs']:
-        d = [(i, dev[i]) for i in dev if i in node and i != 'zone']
-        n = [(i, node[i]) for i in node if i in dev and i != 'zone']
-        if sorted(d) == sorted(n):
-
-            msg = 'Node already exists in ring (%s).' % ring_path
-            log(msg)
-            return True
-
-    return False
-
-
-def add_to_ring(ring_path, node):
-    ring = _load_builder(ring_path)
-    port = ring_port(ring_path, node)
-
-    devs = ring.to_dict()['devs']
-    next_id = 0
-    if devs:
-        next_id = len([d['id'] for d in devs])
-
-    new_dev = {
-        'id': next_id,
-        'zone': node['zone'],
-        'ip': node['ip'],
-        'port': port,
-        'device': node['device'],
-        'weight': 100,
-        'meta': '',
-    }
-    ring.add_dev(new_dev)
-    _write_ring(ring, ring_path)
-    msg = 'Added new device to ring %s: %s' %\
-        (ring_path,
-         [k for k in new_dev.iteritems()])
-    log(msg)
+def _write_ring_data(builder, ring_data_path):
+    '''Write the ring file (e.g. object.ring.gz) distributed to storage
+       nodes.'''
+    ring_data = builder.get_ring()
+    if hasattr(ring_data, 'save'):
+        ring_data.save(ring_data_path)
+    else:
+        # Older swift releases.
+        import cPickle as pickle
+        from gzip import GzipFile
+        gz_file = GzipFile(ring_data_path, 'wb')
+        pickle.dump(ring_data.to_dict(), gz_file, protocol=2)
+        gz_file.close()
 
 
 def _get_zone(ring_builder):
     replicas = ring_builder.replicas
-    zones = [d['zone'] for d in ring_builder.devs]
+    zones = [d['zone'] for d in ring_builder.devs if d]
     if not zones:
         return 1
     if len(zones) < replicas:
@@ -280,63 +259,198 @@ def _get_zone(ring_builder):
     return sorted(zone_distrib, key=zone_distrib.get).pop(0)
 
 
-def get_zone(assignment_policy):
-    ''' Determine the appropriate zone depending on configured assignment
-        policy.
+class SwiftRings(object):
+    '''A session on the swift ring builders.
 
-        Manual assignment relies on each storage zone being deployed as a
-        separate service unit with its desired zone set as a configuration
-        option.
+    Each builder is loaded at most once, when first used.  Devices are added
+    and rings rebalanced in memory: call save() once done to write the
+    modified builders and the rebalanced ring files.
 
-        Auto assignment distributes swift-storage machine units across a number
-        of zones equal to the configured minimum replicas.  This allows for a
-        single swift-storage service unit, with each 'add-unit'd machine unit
-        being assigned to a different zone.
+    Devices added since the last rebalance are recorded in pending_path, so
+    that they can be rebalanced in batches (see batch_ready()).
     '''
-    if assignment_policy == 'manual':
-        return relation_get('zone')
-    elif assignment_policy == 'auto':
-        potential_zones = []
-        for ring in SWIFT_RINGS.itervalues():
-            builder = _load_builder(ring)
-            potential_zones.append(_get_zone(builder))
-        return set(potential_zones).pop()
-    else:
-        log('Invalid zone assignment policy: %s' % assignment_policy,
-            level=ERROR)
-        sys.exit(1)
-
-
-def balance_ring(ring_path):
-    '''balance a ring.  return True if it needs redistribution'''
-    # shell out to swift-ring-builder instead, since the balancing code there
-    # does a bunch of un-importable validation.'''
-    cmd = ['swift-ring-builder', ring_path, 'rebalance']
-    p = subprocess.Popen(cmd)
-    p.communicate()
-    rc = p.returncode
-    if rc == 0:
-        return True
-    elif rc == 1:
-        # swift-ring-builder returns 1 on WARNING (ring didn't require balance)
+
+    def __init__(self, rings=SWIFT_RINGS, pending_path=PENDING_DEVICES):
+        self.rings = rings
+        self.pending_path = pending_path
+        self._builders = {}
+        self._modified = set()
+        self._rebalanced = set()
+        self._pending = None
+        self._pending_modified = False
+
+    def builder(self, name):
+        '''Return the builder of the named ring (account, container or
+           object).'''
+        if name not in self._builders:
+            self._builders[name] = _load_builder(self.rings[name])
+        return self._builders[name]
+
+    def exists_in_ring(self, name, node):
+        ring_path = self.rings[name]
+        node = dict(node, port=ring_port(ring_path, node))
+        for dev in self.builder(name).devs:
+            if not dev:
+                continue
+            d = [(i, dev[i]) for i in dev if i in node and i != 'zone']
+            n = [(i, node[i]) for i in node if i in dev and i != 'zone']
+            if sorted(d) == sorted(n):
+                log('Node already exists in ring (%s).' % ring_path)
+                return True
         return False
-    else:
-        log('balance_ring: %s returned %s' % (cmd, rc), level=ERROR)
-        sys.exit(1)
-
-
-def should_balance(rings):
-    '''Based on zones vs min. replicas, determine whether or not the rings
-       should be balanaced during initial configuration.'''
-    do_rebalance = True
-    for ring in rings:
-        zones = []
-        r = _load_builder(ring).to_dict()
-        replicas = r['replicas']
-        zones = [d['zone'] for d in r['devs']]
-        if len(set(zones)) < replicas:
-            do_rebalance = False
-    return do_rebalance
+
+    def add_to_ring(self, name, node):
+        ring_path = self.rings[name]
+        builder = self.builder(name)
+        new_dev = {
+            'id': len(builder.devs),
+            'zone': node['zone'],
+            'ip': node['ip'],
+            'port': ring_port(ring_path, node),
+            'device': node['device'],
+            'weight': 100,
+            'meta': '',
+        }
+        builder.add_dev(new_dev)
+        self._modified.add(name)
+        log('Added new device to ring %s: %s' %
+            (ring_path, [k for k in new_dev.iteritems()]))
+
+    def add_node(self, node):
+        '''Add the node device to the rings not including it yet.'''
+        added = False
+        for name in self.rings:
+            if not self.exists_in_ring(name, node):
+                self.add_to_ring(name, node)
+                added = True
+        if added:
+            pending = self.pending_devices()
+            if not pending['devices']:
+                pending['since'] = time.time()
+            pending['devices'].append('%s/%s' % (node['ip'], node['device']))
+            self._pending_modified = True
+
+    def pending_devices(self):
+        '''Return the devices added since the last rebalance, as a dict
+           {'devices': ['ip/device', ...], 'since': timestamp}.'''
+        if self._pending is None:
+            self._pending = {'devices': [], 'since': None}
+            if os.path.exists(self.pending_path):
+                with open(self.pending_path) as f:
+                    self._pending = json.load(f)
+        return self._pending
+
+    def batch_ready(self, min_devices, settle_time):
+        '''Return True if the pending devices should be rebalanced.
+
+        Batching is disabled if both min_devices and settle_time are 0.
+        Otherwise the batch is ready once min_devices devices are pending, or
+        settle_time seconds after the first pending device was added.'''
+        if not min_devices and not settle_time:
+            return True
+        pending = self.pending_devices()
+        if not pending['devices']:
+            return False
+        if min_devices and len(pending['devices']) >= min_devices:
+            return True
+        if settle_time and time.time() - pending['since'] >= settle_time:
+            return True
+        log('Deferring rebalance: %d devices pending since %s.' %
+            (len(pending['devices']), time.ctime(pending['since'])))
+        return False
+
+    def get_zone(self, assignment_policy):
+        ''' Determine the appropriate zone depending on configured assignment
+            policy.
+
+            Manual assignment relies on each storage zone being deployed as a
+            separate service unit with its desired zone set as a configuration
+            option.
+
+            Auto assignment distributes swift-storage machine units across a
+            number of zones equal to the configured minimum replicas.  This
+            allows for a single swift-storage service unit, with each
+            'add-unit'd machine unit being assigned to a different zone.
+        '''
+        if assignment_policy == 'manual':
+            return relation_get('zone')
+        elif assignment_policy == 'auto':
+            potential_zones = []
+            for name in self.rings:
+                potential_zones.append(_get_zone(self.builder(name)))
+            return set(potential_zones).pop()
+        else:
+            log('Invalid zone assignment policy: %s' % assignment_policy,
+                level=ERROR)
+            sys.exit(1)
+
+    def should_balance(self):
+        '''Based on zones vs min. replicas, determine whether or not the rings
+           should be balanaced during initial configuration.'''
+        for name in self.rings:
+            builder = self.builder(name)
+            zones = [d['zone'] for d in builder.devs if d]
+            if len(set(zones)) < builder.replicas:
+                return False
+        return True
+
+    def balance_ring(self, name):
+        '''Balance a ring.  Return True if it needs redistribution.
+
+        The checks made by "swift-ring-builder rebalance" are applied before
+        accepting the new partition assignment.  A rejected rebalance leaves
+        the builder as it was, as swift-ring-builder does not save it.'''
+        builder = self.builder(name)
+        devs_changed = builder.devs_changed
+        last_balance = builder.get_balance()
+        snapshot = copy.deepcopy(builder.to_dict())
+        parts, balance = builder.rebalance()
+        if not parts:
+            log('No partitions could be reassigned in ring %s.' %
+                self.rings[name])
+            builder.copy_from(snapshot)
+            return False
+        if not devs_changed and abs(last_balance - balance) < 1:
+            log('Ring %s was not rebalanced: balance would only change by '
+                '%.02f%%.' % (self.rings[name], abs(last_balance - balance)))
+            builder.copy_from(snapshot)
+            return False
+        builder.validate()
+        self._modified.add(name)
+        self._rebalanced.add(name)
+        return True
+
+    def balance_rings(self):
+        '''Balance all the rings, returning the names of the ones which need
+           redistribution.  The pending devices batch is committed once a
+           ring was rebalanced, and kept to be retried otherwise.'''
+        balanced = [name for name in self.rings if self.balance_ring(name)]
+        if balanced:
+            self._pending = {'devices': [], 'since': None}
+            self._pending_modified = True
+        return balanced
+
+    def save(self):
+        '''Write the modified builders and the rebalanced rings, once.'''
+        for name in self._modified:
+            _write_ring(self._builders[name], self.rings[name])
+        for name in self._rebalanced:
+            ring_data_path = os.path.join(
+                os.path.dirname(self.rings[name]), '%s.ring.gz' % name)
+            _write_ring_data(self._builders[name], ring_data_path)
+        self._modified.clear()
+        self._rebalanced.clear()
+        if self._pending_modified:
+            _write_json(self._pending, self.pending_path)
+            self._pending_modified = False
+
+
+def _write_json(data, path):
+    '''Atomically replace the file at path with data encoded as JSON.'''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
 
 
 def do_openstack_upgrade(source, packages):
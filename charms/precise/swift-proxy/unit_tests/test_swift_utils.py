@@ -0,0 +1,224 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+# swift_context reads the charm config when imported.
+with mock.patch('charmhelpers.core.hookenv.config') as config:
+    config.return_value = 8080
+    import swift_utils
+
+
+class FakeRingBuilder(object):
+    """A stand-in for swift.common.ring.RingBuilder."""
+
+    def __init__(self, replicas=3, devs=None, parts=10, balance=0):
+        self.replicas = replicas
+        self.devs = devs or []
+        self.devs_changed = False
+        self.parts = parts
+        self.balance = balance
+        self.validated = False
+
+    def add_dev(self, dev):
+        self.devs.append(dev)
+        self.devs_changed = True
+
+    def get_balance(self):
+        return 100
+
+    def rebalance(self):
+        self.devs_changed = False
+        for dev in self.devs:
+            dev['parts'] = self.parts
+        return self.parts, self.balance
+
+    def to_dict(self):
+        return {'replicas': self.replicas, 'devs': self.devs,
+                'devs_changed': self.devs_changed}
+
+    def copy_from(self, builder):
+        self.replicas = builder['replicas']
+        self.devs = builder['devs']
+        self.devs_changed = builder['devs_changed']
+
+    def validate(self):
+        self.validated = True
+
+
+def make_dev(dev_id, zone, ip='10.0.0.1', device='sdb'):
+    return {'id': dev_id, 'zone': zone, 'ip': ip, 'device': device,
+            'port': 6000 + dev_id, 'weight': 100, 'meta': ''}
+
+
+class SwiftRingsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.builders = {
+            'account': FakeRingBuilder(),
+            'container': FakeRingBuilder(),
+            'object': FakeRingBuilder(),
+        }
+        self.load_builder = self.patch('swift_utils._load_builder')
+        self.load_builder.side_effect = lambda path: self.builders[
+            path.split('/')[-1].split('.')[0]]
+        self.write_ring = self.patch('swift_utils._write_ring')
+        self.write_ring_data = self.patch('swift_utils._write_ring_data')
+        self.patch('swift_utils.log')
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.pending_path = os.path.join(self.tmp_dir, 'pending.json')
+        self.rings = swift_utils.SwiftRings(pending_path=self.pending_path)
+        self.node = {
+            'ip': '10.0.0.1',
+            'zone': 1,
+            'account_port': 6002,
+            'object_port': 6000,
+            'container_port': 6001,
+            'device': 'sdb',
+        }
+
+    def patch(self, target):
+        patcher = mock.patch(target)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def test_builders_loaded_once(self):
+        """Each builder is only unpickled once per session."""
+        self.rings.get_zone('auto')
+        self.rings.add_node(self.node)
+        self.rings.should_balance()
+        self.rings.balance_rings()
+        self.assertEqual(3, self.load_builder.call_count)
+
+    def test_add_node(self):
+        """Devices are added to every ring with the ring specific port."""
+        self.rings.add_node(self.node)
+        self.assertEqual(
+            [6002], [d['port'] for d in self.builders['account'].devs])
+        self.assertEqual(
+            [6000], [d['port'] for d in self.builders['object'].devs])
+        # The node is not added twice.
+        self.rings.add_node(self.node)
+        self.assertEqual(1, len(self.builders['container'].devs))
+        self.assertNotIn('port', self.node)
+
+    def test_save_once(self):
+        """Modified builders are written once, when saving."""
+        for device in ('sdb', 'sdc', 'sdd'):
+            self.rings.add_node(dict(self.node, device=device))
+        self.assertFalse(self.write_ring.called)
+        self.rings.save()
+        self.assertEqual(3, self.write_ring.call_count)
+        self.assertFalse(self.write_ring_data.called)
+        self.rings.save()
+        self.assertEqual(3, self.write_ring.call_count)
+
+    def test_get_zone_auto(self):
+        self.builders['account'].devs = [make_dev(0, 1)]
+        self.builders['container'].devs = [make_dev(0, 1)]
+        self.builders['object'].devs = [make_dev(0, 1)]
+        self.assertEqual(2, self.rings.get_zone('auto'))
+
+    def test_should_balance(self):
+        for builder in self.builders.values():
+            builder.devs = [make_dev(0, 1), make_dev(1, 2)]
+        self.assertFalse(self.rings.should_balance())
+        for builder in self.builders.values():
+            builder.devs.append(make_dev(2, 3))
+        self.assertTrue(self.rings.should_balance())
+
+    def test_balance_rings(self):
+        """Rebalanced builders and rings are written when saving."""
+        self.rings.add_node(self.node)
+        self.assertEqual(
+            ['account', 'container', 'object'],
+            sorted(self.rings.balance_rings()))
+        self.assertTrue(self.builders['object'].validated)
+        self.rings.save()
+        self.assertEqual(3, self.write_ring.call_count)
+        self.write_ring_data.assert_any_call(
+            self.builders['object'], '/etc/swift/object.ring.gz')
+        self.assertEqual(3, self.write_ring_data.call_count)
+
+    def test_balance_no_partitions_moved(self):
+        self.builders['object'].parts = 0
+        self.assertFalse(self.rings.balance_ring('object'))
+        self.rings.save()
+        self.assertFalse(self.write_ring_data.called)
+
+    def test_rejected_rebalance_undone(self):
+        """A rejected rebalance does not change the builders saved with the
+        devices added, so that it is attempted again later."""
+        self.rings.add_node(self.node)
+        builder = self.builders['object']
+        builder.parts = 0
+        self.assertFalse(self.rings.balance_ring('object'))
+        self.assertTrue(builder.devs_changed)
+        self.assertNotIn('parts', builder.devs[0])
+        self.rings.save()
+        self.write_ring.assert_any_call(builder, '/etc/swift/object.builder')
+        builder.parts = 10
+        self.assertTrue(self.rings.balance_ring('object'))
+
+    def test_balance_not_improved(self):
+        """Rings are not saved if balance barely changed and no device was
+        added, as swift-ring-builder does."""
+        self.builders['object'].balance = 99.5
+        self.assertFalse(self.rings.balance_ring('object'))
+        self.assertFalse(self.builders['object'].validated)
+
+    def test_pending_devices(self):
+        """Added devices are queued persistently until the next rebalance."""
+        with mock.patch('swift_utils.time.time', return_value=1000):
+            self.rings.add_node(self.node)
+            self.rings.add_node(dict(self.node, device='sdc'))
+        self.rings.add_node(self.node)
+        self.rings.save()
+        with open(self.pending_path) as f:
+            pending = json.load(f)
+        self.assertEqual(
+            {'devices': ['10.0.0.1/sdb', '10.0.0.1/sdc'], 'since': 1000},
+            pending)
+        rings = swift_utils.SwiftRings(pending_path=self.pending_path)
+        self.assertEqual(pending, rings.pending_devices())
+        rings.balance_rings()
+        rings.save()
+        rings = swift_utils.SwiftRings(pending_path=self.pending_path)
+        self.assertEqual([], rings.pending_devices()['devices'])
+
+    def test_pending_devices_kept(self):
+        """Devices stay pending if no ring could be rebalanced, so that the
+        next storage hook retries."""
+        self.rings.add_node(self.node)
+        for builder in self.builders.values():
+            builder.parts = 0
+        self.assertEqual([], self.rings.balance_rings())
+        self.rings.save()
+        rings = swift_utils.SwiftRings(pending_path=self.pending_path)
+        self.assertEqual(['10.0.0.1/sdb'], rings.pending_devices()['devices'])
+        self.assertTrue(rings.batch_ready(1, 0))
+
+    def test_batch_disabled(self):
+        """Without batching, rings are always rebalanced."""
+        self.assertTrue(self.rings.batch_ready(0, 0))
+
+    def test_batch_min_devices(self):
+        self.rings.add_node(self.node)
+        self.assertFalse(self.rings.batch_ready(2, 0))
+        self.rings.add_node(dict(self.node, device='sdc'))
+        self.assertTrue(self.rings.batch_ready(2, 0))
+
+    def test_batch_settle_time(self):
+        with mock.patch('swift_utils.time.time', return_value=1000):
+            self.rings.add_node(self.node)
+            self.assertFalse(self.rings.batch_ready(10, 60))
+        with mock.patch('swift_utils.time.time', return_value=1060):
+            self.rings.add_node(dict(self.node, device='sdc'))
+            self.assertTrue(self.rings.batch_ready(10, 60))
+
+    def test_batch_empty(self):
+        """Nothing is rebalanced if no devices are pending."""
+        self.assertFalse(self.rings.batch_ready(1, 60))
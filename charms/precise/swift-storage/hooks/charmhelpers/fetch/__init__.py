@@ -1,4 +1,6 @@
 import importlib
+import json
+import tempfile
 from yaml import safe_load
 from charmhelpers.core.host import (
     lsb_release
@@ -7,10 +9,13 @@ from urlparse import (
     urlparse,
     urlunparse,
 )
+import os
 import subprocess
 from charmhelpers.core.hookenv import (
+    charm_dir,
     config,
     log,
+    timed,
 )
 import apt_pkg
 
@@ -22,15 +27,102 @@ deb http://archive.ubuntu.com/ubuntu {}-proposed main universe multiverse restri
 """
 
 
+INSTALLED_VERSIONS = '.apt-installed-versions.json'
+DPKG_STATUS = '/var/lib/dpkg/status'
+
+_apt_cache = None
+_installed_versions = None
+
+
+def apt_cache():
+    """Returns an apt_pkg.Cache shared by every caller in this process.
+
+    The cache is opened on first use and kept until the installed packages
+    change: apt_install, apt_update and apt_purge invalidate it.
+    """
+    global _apt_cache
+    if _apt_cache is None:
+        apt_pkg.init()
+        _apt_cache = apt_pkg.Cache()
+    return _apt_cache
+
+
+def invalidate_apt_cache():
+    """Discards the shared apt cache and installed version index"""
+    global _apt_cache, _installed_versions
+    _apt_cache = None
+    _installed_versions = None
+
+
+def _installed_versions_path():
+    if charm_dir():
+        return os.path.join(charm_dir(), INSTALLED_VERSIONS)
+    return None
+
+
+def _load_installed_versions():
+    global _apt_cache, _installed_versions
+    try:
+        mtime = os.path.getmtime(DPKG_STATUS)
+    except OSError:
+        mtime = None
+    if (_installed_versions is not None and
+            _installed_versions['dpkg-status'] == mtime):
+        return _installed_versions
+    # The dpkg database changed underneath us, or nothing is loaded yet.
+    if _installed_versions is not None:
+        _apt_cache = None
+    _installed_versions = {'dpkg-status': mtime, 'versions': {}}
+    path = _installed_versions_path()
+    if mtime is not None and path and os.path.exists(path):
+        try:
+            with open(path) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        if index.get('dpkg-status') == mtime:
+            _installed_versions = index
+    return _installed_versions
+
+
+def _save_installed_versions(index):
+    path = _installed_versions_path()
+    if index['dpkg-status'] is None or not path:
+        return
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix=INSTALLED_VERSIONS)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp, path)
+    except (IOError, OSError) as e:
+        log('Could not save installed version index: {}'.format(e),
+            level='WARNING')
+
+
+def installed_version(package):
+    """Returns the installed version of package, or None if not installed.
+
+    Versions are looked up in an index persisted in the charm directory
+    which stays valid for as long as the dpkg status database is unchanged,
+    so the apt cache is only opened for packages not yet indexed.  Raises
+    KeyError if the package is unknown to apt.
+    """
+    index = _load_installed_versions()
+    versions = index['versions']
+    if package not in versions:
+        pkg = apt_cache()[package]
+        versions[package] = pkg.current_ver and pkg.current_ver.ver_str
+        _save_installed_versions(index)
+    return versions[package]
+
+
 def filter_installed_packages(packages):
     """Returns a list of packages that require installation"""
-    apt_pkg.init()
-    cache = apt_pkg.Cache()
     _pkgs = []
     for package in packages:
         try:
-            p = cache[package]
-            p.current_ver or _pkgs.append(package)
+            installed_version(package) or _pkgs.append(package)
         except KeyError:
             log('Package {} has no installation candidate.'.format(package),
                 level='WARNING')
@@ -38,6 +130,7 @@ def filter_installed_packages(packages):
     return _pkgs
 
 
+@timed('apt_install')
 def apt_install(packages, options=None, fatal=False):
     """Install one or more packages"""
     options = options or []
@@ -50,15 +143,18 @@ def apt_install(packages, options=None, fatal=False):
         cmd.extend(packages)
     log("Installing {} with options: {}".format(packages,
                                                 options))
+    invalidate_apt_cache()
     if fatal:
         subprocess.check_call(cmd)
     else:
         subprocess.call(cmd)
 
 
+@timed('apt_update')
 def apt_update(fatal=False):
     """Update local apt cache"""
     cmd = ['apt-get', 'update']
+    invalidate_apt_cache()
     if fatal:
         subprocess.check_call(cmd)
     else:
@@ -73,6 +169,7 @@ def apt_purge(packages, fatal=False):
     else:
         cmd.extend(packages)
     log("Purging {}".format(packages))
+    invalidate_apt_cache()
     if fatal:
         subprocess.check_call(cmd)
     else:
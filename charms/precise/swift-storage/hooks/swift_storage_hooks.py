@@ -44,6 +44,7 @@ def install():
     apt_install(PACKAGES, fatal=True)
     setup_storage()
     ensure_swift_directories()
+    CONFIGS.precompile()
 
 
 @hooks.hook('config-changed')
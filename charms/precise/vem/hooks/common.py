@@ -21,6 +21,10 @@ from os.path import exists
 from string import Template
 from yaml.constructor import ConstructorError
 from Cheetah.Template import Template
+from charmhelpers.core.hookenv import (
+    buffer_logs,
+    log,
+)
 
 ###############################################################################
 # Supporting functions
@@ -28,11 +32,16 @@ from Cheetah.Template import Template
 
 
 #------------------------------------------------------------------------------
-# juju_log:  calls juju-log and records the message defined by the message
-#            variable
+# juju_log:  records the message defined by the message variable in the juju
+#            log.  Messages are buffered and written with a single juju-log
+#            call when the hook exits (or straight away for errors).
 #------------------------------------------------------------------------------
+buffer_logs()
+
+
 def juju_log(message=None):
-    return (subprocess.call(['juju-log', str(message)]) == 0)
+    log(str(message))
+    return True
 
 
 #------------------------------------------------------------------------------
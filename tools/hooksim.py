@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+"""Offline Juju hook tool simulator and hook benchmark runner.
+
+Hooks are run against a copy of the charm with stand-ins for the Juju hook
+tools (config-get, relation-get, relation-set, relation-ids, relation-list,
+unit-get, juju-log, open-port, close-port) first on the PATH.  The stand-ins
+are this same script, invoked through symlinks, and answer from a YAML model
+of the environment:
+
+    charm: nova-cloud-controller      # directory under charms/precise
+    unit: nova-cloud-controller/0
+    private-address: 10.0.0.10
+    config:
+        openstack-origin: distro
+    relations:
+        cloud-compute:                # relation name, from metadata.yaml
+            service: nova-compute     # remote service
+            units: 100
+            settings:                 # values are formatted with the
+                private-address: 10.1.{index}.1   # unit name and index
+                hostname: compute-{index}
+    sequence:
+        - install
+        - config-changed
+        - relation: cloud-compute     # joined + changed for each unit
+    stubs: [apt-get, service]         # commands replaced by no-ops
+
+Every hook tool and stub invocation is counted.  Run:
+
+    tools/hooksim.py tools/models/*.yaml
+
+to get the wall time and subprocess counts of every hook in the sequence.
+"""
+
+import json
+import optparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+CHARMS_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'charms', 'precise')
+TOOLS = (
+    'close-port',
+    'config-get',
+    'juju-log',
+    'open-port',
+    'relation-get',
+    'relation-ids',
+    'relation-list',
+    'relation-set',
+    'unit-get',
+)
+DEFAULT_STUBS = (
+    'a2enmod',
+    'a2ensite',
+    'apt-add-repository',
+    'apt-get',
+    'apt-key',
+    'dpkg',
+    'service',
+    'update-ca-certificates',
+)
+
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def _format(value, unit, index):
+    if isinstance(value, basestring):
+        return value.format(unit=unit, index=index)
+    return value
+
+
+def charm_config_defaults(charm_dir):
+    """Return the default value of every option in the charm's config.yaml."""
+    import yaml
+    path = os.path.join(charm_dir, 'config.yaml')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        options = (yaml.safe_load(f) or {}).get('options', {})
+    return dict((name, option.get('default'))
+                for name, option in options.items())
+
+
+def build_state(model, defaults=None):
+    """Build the initial simulator state from a loaded model.
+
+    The model's config is laid over the charm's config defaults. Remote
+    units are listed in each relation but only become visible to
+    relation-list once they have joined.
+    """
+    unit = model['unit']
+    config = dict(defaults or {})
+    config.update(model.get('config', {}))
+    relations = {}
+    for index, (name, rel) in enumerate(
+            sorted(model.get('relations', {}).items())):
+        rid = '{}:{}'.format(name, index)
+        service = rel.get('service', name)
+        settings = {}
+        units = []
+        for i in range(rel.get('units', 1)):
+            remote = '{}/{}'.format(service, i)
+            units.append(remote)
+            settings[remote] = dict(
+                (key, _format(value, remote, i))
+                for key, value in rel.get('settings', {}).items())
+        settings[unit] = {
+            'private-address': model.get('private-address', '10.0.0.1')}
+        relations[rid] = {
+            'name': name,
+            'units': units,
+            'joined': [],
+            'settings': settings,
+        }
+    return {
+        'unit': unit,
+        'private-address': model.get('private-address', '10.0.0.1'),
+        'public-address': model.get('public-address', model.get(
+            'private-address', '10.0.0.1')),
+        'config': config,
+        'relations': relations,
+    }
+
+
+class State(object):
+    """The simulator state shared by the hook tool stand-ins."""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, 'state.json')
+        self.calls_path = os.path.join(directory, 'calls')
+
+    def load(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, state):
+        with open(self.path, 'w') as f:
+            json.dump(state, f)
+
+    def record(self, name):
+        with open(self.calls_path, 'a') as f:
+            f.write(name + '\n')
+
+    def calls(self):
+        """Return and reset the number of calls made by tool name."""
+        counts = {}
+        if os.path.exists(self.calls_path):
+            with open(self.calls_path) as f:
+                for line in f:
+                    name = line.strip()
+                    counts[name] = counts.get(name, 0) + 1
+            os.unlink(self.calls_path)
+        return counts
+
+
+def _parse_tool_args(args):
+    """Split hook tool arguments into options and positional arguments."""
+    options = {}
+    positional = []
+    args = list(args)
+    while args:
+        arg = args.pop(0)
+        if arg in ('-r', '-l', '--log-level'):
+            options[arg.lstrip('-')[0]] = args.pop(0)
+        elif arg.startswith('--format'):
+            options['format'] = arg.split('=', 1)[-1]
+        elif arg.startswith('-') and arg != '-':
+            continue
+        else:
+            positional.append(arg)
+    return options, positional
+
+
+def run_tool(name, args, state_dir):
+    """Answer a hook tool invocation from the model, returning the output."""
+    state = State(state_dir)
+    state.record(name)
+    if name not in TOOLS:
+        # A stubbed out system command.
+        return ''
+    options, positional = _parse_tool_args(args)
+    model = state.load()
+    rid = options.get('r', os.environ.get('JUJU_RELATION_ID'))
+    if name == 'config-get':
+        if positional:
+            return json.dumps(model['config'].get(positional[0]))
+        return json.dumps(model['config'])
+    if name == 'unit-get':
+        return json.dumps(model.get(positional[0]))
+    if name == 'relation-ids':
+        # Like Juju, default to the relation of the running hook.
+        reltype = (positional[0] if positional
+                   else os.environ.get('JUJU_RELATION'))
+        return json.dumps(sorted(
+            relid for relid, rel in model['relations'].items()
+            if rel['name'] == reltype and rel['joined']))
+    if name == 'relation-list':
+        rel = model['relations'].get(rid)
+        return json.dumps(rel['joined'] if rel else [])
+    if name == 'relation-get':
+        rel = model['relations'].get(rid)
+        attribute = positional[0] if positional else '-'
+        unit = (positional[1] if len(positional) > 1
+                else os.environ.get('JUJU_REMOTE_UNIT'))
+        if rel is None or unit not in rel['settings']:
+            sys.stderr.write('error: no relation data for {}\n'.format(unit))
+            sys.exit(2)
+        settings = rel['settings'][unit]
+        if attribute == '-':
+            return json.dumps(settings)
+        return json.dumps(settings.get(attribute))
+    if name == 'relation-set':
+        rel = model['relations'][rid]
+        settings = rel['settings'].setdefault(model['unit'], {})
+        for arg in positional:
+            key, value = arg.split('=', 1)
+            if value:
+                settings[key] = value
+            else:
+                settings.pop(key, None)
+        state.save(model)
+    return ''
+
+
+class Simulator(object):
+    """Runs the hooks of one charm against a model of its environment."""
+
+    def __init__(self, model, python=None, charms_dir=CHARMS_DIR):
+        self.model = model
+        self.python = python
+        self.workdir = tempfile.mkdtemp(prefix='hooksim-')
+        self.charm_dir = os.path.join(self.workdir, 'charm')
+        shutil.copytree(
+            os.path.join(charms_dir, model['charm']), self.charm_dir,
+            symlinks=True, ignore=shutil.ignore_patterns('.bzr', '*.pyc'))
+        self.bin_dir = os.path.join(self.workdir, 'bin')
+        os.mkdir(self.bin_dir)
+        for name in TOOLS + tuple(model.get('stubs', DEFAULT_STUBS)):
+            os.symlink(os.path.abspath(__file__),
+                       os.path.join(self.bin_dir, name))
+        self.state = State(self.workdir)
+        self.state.save(
+            build_state(model, charm_config_defaults(self.charm_dir)))
+        self.contexts = 0
+        self.results = []
+
+    def cleanup(self):
+        shutil.rmtree(self.workdir)
+
+    def run_hook(self, hook, relation_id=None, remote_unit=None):
+        """Run a single hook, recording its wall time and tool calls.
+
+        Hooks that the charm does not implement are skipped, like Juju does.
+        """
+        path = os.path.join(self.charm_dir, 'hooks', hook)
+        if not os.path.exists(path):
+            return None
+        self.contexts += 1
+        env = dict(os.environ)
+        env.update({
+            'PATH': self.bin_dir + os.pathsep + env.get('PATH', ''),
+            'HOOKSIM_DIR': self.workdir,
+            'CHARM_DIR': self.charm_dir,
+            'JUJU_UNIT_NAME': self.model['unit'],
+            'JUJU_ENV_UUID': 'hooksim',
+            'JUJU_CONTEXT_ID': '{}-{}'.format(
+                self.model['unit'], self.contexts),
+        })
+        if relation_id is not None:
+            env['JUJU_RELATION'] = relation_id.split(':')[0]
+            env['JUJU_RELATION_ID'] = relation_id
+            env['JUJU_REMOTE_UNIT'] = remote_unit
+        cmd = [path]
+        if self.python is not None:
+            with open(path) as f:
+                if 'python' in f.readline():
+                    cmd.insert(0, self.python)
+        with open(os.path.join(self.workdir, 'hooks.log'), 'a') as log:
+            start = time.time()
+            status = subprocess.call(
+                cmd, cwd=self.charm_dir, env=env, stdout=log, stderr=log)
+            elapsed = time.time() - start
+        result = {
+            'hook': hook,
+            'remote-unit': remote_unit,
+            'status': status,
+            'time': elapsed,
+            'calls': self.state.calls(),
+        }
+        self.results.append(result)
+        return result
+
+    def join(self, name, units=None):
+        """Join remote units of relation name, one at a time."""
+        state = self.state.load()
+        for rid, rel in sorted(state['relations'].items()):
+            if rel['name'] != name:
+                continue
+            remotes = rel['units'] if units is None else rel['units'][:units]
+            for remote in remotes:
+                state = self.state.load()
+                state['relations'][rid]['joined'].append(remote)
+                self.state.save(state)
+                self.run_hook('{}-relation-joined'.format(name), rid, remote)
+                self.run_hook('{}-relation-changed'.format(name), rid, remote)
+
+    def replay(self):
+        """Replay the model's hook sequence."""
+        for step in self.model.get('sequence', ['install', 'config-changed']):
+            if isinstance(step, dict):
+                self.join(step['relation'], step.get('units'))
+            else:
+                self.run_hook(step)
+        return self.results
+
+
+def summarize(charm, results):
+    """Format a per-hook and total report for the results of one charm."""
+    lines = ['{}:'.format(charm)]
+    grouped = {}
+    order = []
+    for result in results:
+        if result['hook'] not in grouped:
+            order.append(result['hook'])
+            grouped[result['hook']] = []
+        grouped[result['hook']].append(result)
+    total_time = total_calls = 0
+    for hook in order:
+        runs = grouped[hook]
+        elapsed = sum(r['time'] for r in runs)
+        calls = {}
+        for run in runs:
+            for name, count in run['calls'].items():
+                calls[name] = calls.get(name, 0) + count
+        failed = len([r for r in runs if r['status']])
+        total_time += elapsed
+        total_calls += sum(calls.values())
+        lines.append('  {:<40} {:>4} runs {:>8.2f}s {:>6} calls{}'.format(
+            hook, len(runs), elapsed, sum(calls.values()),
+            ' ({} failed)'.format(failed) if failed else ''))
+        lines.append('      ' + ', '.join(
+            '{} {}'.format(name, count)
+            for name, count in sorted(calls.items())))
+    lines.append('  {:<40} {:>4} runs {:>8.2f}s {:>6} calls'.format(
+        'total', len(results), total_time, total_calls))
+    return '\n'.join(lines)
+
+
+def main(argv):
+    import yaml
+    parser = optparse.OptionParser(
+        usage='%prog [options] MODEL.yaml [MODEL.yaml ...]')
+    parser.add_option(
+        '--python', help='interpreter used to run python hooks')
+    parser.add_option(
+        '--json', action='store_true', help='output raw results as json')
+    parser.add_option(
+        '--keep', action='store_true',
+        help='keep the working directories (and hooks.log) for inspection')
+    options, args = parser.parse_args(argv[1:])
+    if not args:
+        parser.error('at least one model is required')
+    reports = {}
+    for path in args:
+        with open(path) as f:
+            model = yaml.safe_load(f)
+        simulator = Simulator(model, python=options.python)
+        try:
+            reports[path] = simulator.replay()
+        finally:
+            if options.keep:
+                sys.stderr.write('{}: {}\n'.format(path, simulator.workdir))
+            else:
+                simulator.cleanup()
+        if not options.json:
+            print(summarize(model['charm'], reports[path]))
+    if options.json:
+        print(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    name = os.path.basename(sys.argv[0])
+    if name in TOOLS or 'HOOKSIM_DIR' in os.environ:
+        sys.stdout.write(run_tool(name, sys.argv[1:],
+                                  os.environ['HOOKSIM_DIR']))
+    else:
+        main(sys.argv)
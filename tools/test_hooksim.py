@@ -0,0 +1,261 @@
+"""Tests for the offline hook tool simulator.
+
+Run with:
+
+    python -m unittest discover -s tools
+"""
+
+import json
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+import hooksim
+
+
+MODEL = {
+    'charm': 'example',
+    'unit': 'example/0',
+    'private-address': '10.0.0.10',
+    'config': {'debug': True},
+    'relations': {
+        'amqp': {
+            'service': 'rabbitmq-server',
+            'units': 2,
+            'settings': {
+                'private-address': '10.1.{index}.1',
+                'hostname': '{unit}',
+                'port': 5672,
+            },
+        },
+        'shared-db': {'service': 'mysql'},
+    },
+}
+
+
+class SimulatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        for name in ('JUJU_RELATION', 'JUJU_RELATION_ID', 'JUJU_REMOTE_UNIT'):
+            os.environ.pop(name, None)
+
+
+class ParseToolArgsTest(unittest.TestCase):
+
+    def test_options(self):
+        self.assertEqual(
+            ({'r': 'amqp:0', 'format': 'json'}, ['password', 'rabbit/0']),
+            hooksim._parse_tool_args(
+                ['-r', 'amqp:0', '--format=json', 'password', 'rabbit/0']))
+
+    def test_log_level(self):
+        self.assertEqual(
+            ({'l': 'WARNING'}, ['message']),
+            hooksim._parse_tool_args(['-l', 'WARNING', 'message']))
+        self.assertEqual(
+            ({'l': 'DEBUG'}, ['message']),
+            hooksim._parse_tool_args(['--log-level', 'DEBUG', 'message']))
+
+    def test_all_settings(self):
+        """A lone dash is the relation-get 'all settings' argument"""
+        self.assertEqual(({}, ['-', 'rabbit/0']),
+                         hooksim._parse_tool_args(['-', 'rabbit/0']))
+
+    def test_unknown_flags_ignored(self):
+        self.assertEqual(({}, ['8080/TCP']),
+                         hooksim._parse_tool_args(['--verbose', '8080/TCP']))
+
+
+class BuildStateTest(unittest.TestCase):
+
+    def test_relations(self):
+        state = hooksim.build_state(MODEL)
+        self.assertEqual(['amqp:0', 'shared-db:1'],
+                         sorted(state['relations']))
+        amqp = state['relations']['amqp:0']
+        self.assertEqual('amqp', amqp['name'])
+        self.assertEqual(['rabbitmq-server/0', 'rabbitmq-server/1'],
+                         amqp['units'])
+        self.assertEqual([], amqp['joined'])
+        self.assertEqual(['mysql/0'], state['relations']['shared-db:1'][
+            'units'])
+
+    def test_settings_formatted(self):
+        """Remote settings are formatted with the unit name and index"""
+        settings = hooksim.build_state(MODEL)['relations']['amqp:0'][
+            'settings']
+        self.assertEqual({'private-address': '10.1.1.1',
+                          'hostname': 'rabbitmq-server/1',
+                          'port': 5672}, settings['rabbitmq-server/1'])
+        self.assertEqual({'private-address': '10.0.0.10'},
+                         settings['example/0'])
+
+    def test_config_defaults(self):
+        state = hooksim.build_state(MODEL, {'debug': False, 'port': 80})
+        self.assertEqual({'debug': True, 'port': 80}, state['config'])
+
+    def test_addresses(self):
+        state = hooksim.build_state({'unit': 'example/0'})
+        self.assertEqual('10.0.0.1', state['private-address'])
+        self.assertEqual('10.0.0.1', state['public-address'])
+
+
+class CharmConfigDefaultsTest(SimulatorTestCase):
+
+    def test_defaults(self):
+        with open(os.path.join(self.workdir, 'config.yaml'), 'w') as f:
+            f.write('options:\n'
+                    '  debug: {type: boolean, default: false}\n'
+                    '  origin: {type: string}\n')
+        self.assertEqual({'debug': False, 'origin': None},
+                         hooksim.charm_config_defaults(self.workdir))
+
+    def test_no_config(self):
+        self.assertEqual({}, hooksim.charm_config_defaults(self.workdir))
+
+
+class RunToolTest(SimulatorTestCase):
+
+    def setUp(self):
+        super(RunToolTest, self).setUp()
+        self.state = hooksim.State(self.workdir)
+        state = hooksim.build_state(MODEL)
+        state['relations']['amqp:0']['joined'] = ['rabbitmq-server/0']
+        self.state.save(state)
+
+    def run_tool(self, name, *args):
+        output = hooksim.run_tool(name, args, self.workdir)
+        return json.loads(output) if output else output
+
+    def test_config_get(self):
+        self.assertEqual({'debug': True},
+                         self.run_tool('config-get', '--format=json'))
+        self.assertEqual(True, self.run_tool('config-get', 'debug'))
+        self.assertEqual(None, self.run_tool('config-get', 'missing'))
+
+    def test_unit_get(self):
+        self.assertEqual('10.0.0.10',
+                         self.run_tool('unit-get', 'private-address'))
+
+    def test_relation_ids(self):
+        """Only relations with joined units are listed"""
+        self.assertEqual(['amqp:0'], self.run_tool('relation-ids', 'amqp'))
+        self.assertEqual([], self.run_tool('relation-ids', 'shared-db'))
+
+    def test_relation_ids_current_relation(self):
+        """Without a relation name, the hook's relation is used"""
+        os.environ['JUJU_RELATION'] = 'amqp'
+        self.assertEqual(['amqp:0'],
+                         self.run_tool('relation-ids', '--format=json'))
+
+    def test_relation_ids_outside_relation_hooks(self):
+        self.assertEqual([], self.run_tool('relation-ids'))
+
+    def test_relation_list(self):
+        self.assertEqual(['rabbitmq-server/0'],
+                         self.run_tool('relation-list', '-r', 'amqp:0'))
+        os.environ['JUJU_RELATION_ID'] = 'amqp:0'
+        self.assertEqual(['rabbitmq-server/0'],
+                         self.run_tool('relation-list'))
+        self.assertEqual([], self.run_tool('relation-list', '-r', 'amqp:9'))
+
+    def test_relation_get(self):
+        self.assertEqual('10.1.0.1', self.run_tool(
+            'relation-get', '-r', 'amqp:0', 'private-address',
+            'rabbitmq-server/0'))
+        os.environ['JUJU_RELATION_ID'] = 'amqp:0'
+        os.environ['JUJU_REMOTE_UNIT'] = 'rabbitmq-server/0'
+        self.assertEqual(5672, self.run_tool('relation-get', 'port'))
+        self.assertEqual('rabbitmq-server/0',
+                         self.run_tool('relation-get', '-')['hostname'])
+
+    def test_relation_get_unknown_unit(self):
+        with open(os.devnull, 'w') as devnull:
+            stderr, hooksim.sys.stderr = hooksim.sys.stderr, devnull
+            try:
+                with self.assertRaises(SystemExit):
+                    self.run_tool('relation-get', '-r', 'amqp:0', '-',
+                                  'mysql/0')
+            finally:
+                hooksim.sys.stderr = stderr
+
+    def test_relation_set(self):
+        """Settings are saved for later tools; empty values unset keys"""
+        self.run_tool('relation-set', '-r', 'amqp:0', 'username=nova',
+                      'vhost=openstack')
+        self.run_tool('relation-set', '-r', 'amqp:0', 'vhost=')
+        self.assertEqual(
+            {'private-address': '10.0.0.10', 'username': 'nova'},
+            self.run_tool('relation-get', '-r', 'amqp:0', '-', 'example/0'))
+
+    def test_calls_counted(self):
+        self.run_tool('config-get')
+        self.run_tool('config-get', 'debug')
+        self.run_tool('apt-get', 'install', 'nova-api')
+        self.assertEqual({'config-get': 2, 'apt-get': 1}, self.state.calls())
+        self.assertEqual({}, self.state.calls())
+
+    def test_stub(self):
+        """Stubbed system commands do nothing"""
+        self.assertEqual('', self.run_tool('service', 'nova-api', 'restart'))
+
+
+class SimulatorTest(SimulatorTestCase):
+
+    def setUp(self):
+        super(SimulatorTest, self).setUp()
+        charm_dir = os.path.join(self.workdir, 'example')
+        os.makedirs(os.path.join(charm_dir, 'hooks'))
+        self.hook('install', 'apt-get install example\n'
+                             'config-get debug\n')
+        self.hook('amqp-relation-changed',
+                  'relation-set username=$(config-get user)\n'
+                  'relation-get port\n')
+        with open(os.path.join(charm_dir, 'config.yaml'), 'w') as f:
+            f.write('options:\n  user: {type: string, default: example}\n')
+        self.simulator = hooksim.Simulator(
+            dict(MODEL, sequence=['install', 'config-changed',
+                                  {'relation': 'amqp'}]),
+            charms_dir=self.workdir)
+        self.addCleanup(self.simulator.cleanup)
+
+    def hook(self, name, script):
+        path = os.path.join(self.workdir, 'example', 'hooks', name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nset -e\n' + script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+
+    def test_replay(self):
+        results = self.simulator.replay()
+        # config-changed is not implemented, and amqp-relation-joined is
+        # skipped for both remote units.
+        self.assertEqual(
+            ['install', 'amqp-relation-changed', 'amqp-relation-changed'],
+            [result['hook'] for result in results])
+        self.assertEqual([0, 0, 0], [result['status'] for result in results])
+        self.assertEqual({'apt-get': 1, 'config-get': 1}, results[0]['calls'])
+        self.assertEqual('rabbitmq-server/1', results[2]['remote-unit'])
+        self.assertEqual(
+            {'relation-set': 1, 'config-get': 1, 'relation-get': 1},
+            results[2]['calls'])
+        state = self.simulator.state.load()
+        amqp = state['relations']['amqp:0']
+        self.assertEqual(['rabbitmq-server/0', 'rabbitmq-server/1'],
+                         amqp['joined'])
+        self.assertEqual('"example"', amqp['settings']['example/0'][
+            'username'])
+
+    def test_summarize(self):
+        report = hooksim.summarize('example', self.simulator.replay())
+        lines = report.splitlines()
+        self.assertEqual('example:', lines[0])
+        self.assertTrue(lines[1].split()[:3] == ['install', '1', 'runs'])
+        self.assertEqual('      apt-get 1, config-get 1', lines[2])
+        self.assertTrue(lines[-1].split()[:2] == ['total', '3'])